@@ -55,21 +55,29 @@ if 'data_loaded' not in st.session_state: st.session_state['data_loaded'] = Fals
 if 'current_df' not in st.session_state: st.session_state['current_df'] = None
 if 'original_token_map' not in st.session_state: st.session_state['original_token_map'] = {}
 
+# Kiểm tra / tạo các tab hệ thống 1 lần cho cả tiến trình (không lặp lại mỗi lần rerun)
+@st.cache_resource
+def init_database(): return be.init_database(st.secrets)
+
 with st.spinner("Kết nối Database..."):
-    be.init_database(st.secrets)
+    # Lỗi (mất mạng, quota, sai quyền...) -> bỏ kết quả khỏi cache để lần rerun sau kiểm tra lại
+    if not init_database(): init_database.clear()
 
 # --- CACHE ---
-@st.cache_data(ttl=300)
+# Blocks / links đọc từ master snapshot của backend, logs từ cache log của backend: dùng chung mọi phiên, rerun
+# lấy từ RAM. Các hàm ghi (create_block, delete_block, save_links_bulk, ...) tự đánh dấu đúng tab cần đọc lại.
 def get_cached_blocks(): return be.get_all_blocks(st.secrets)
-def clear_cache(): st.cache_data.clear()
+def get_cached_links(block_id): return be.get_links_by_block(st.secrets, block_id)
+def refresh_cache():
+    # Nút 🔄: ép đọc lại master + log (VD: sửa tay trên Google Sheets)
+    be.invalidate_master_snapshot(st.secrets)
+    be.invalidate_execution_logs(st.secrets)
 
 # --- HÀM LẤY LOG ---
 def get_logs_data():
     try:
-        sh, _ = be.get_connection(st.secrets)
-        wks = sh.worksheet("log_lan_thuc_thi")
-        data = wks.get_all_records()
-        df = pd.DataFrame(data)
+        header, rows = be.get_execution_logs(st.secrets)
+        df = pd.DataFrame([(r + [""] * len(header))[:len(header)] for r in rows], columns=header)
         if not df.empty: return df.iloc[::-1] 
         return df
     except: return pd.DataFrame()
@@ -115,7 +123,7 @@ def go_to_detail(b_id, b_name):
     st.session_state['current_df'] = None
 
 def go_to_list():
-    clear_cache(); st.session_state['view'] = 'list'; st.session_state['selected_block_id'] = None
+    st.session_state['view'] = 'list'; st.session_state['selected_block_id'] = None
 
 # ==========================================
 # VIEW: LIST (DANH SÁCH KHỐI)
@@ -135,44 +143,19 @@ if st.session_state['view'] == 'list':
         else:
             with st.status("🚀 Đang chạy toàn bộ hệ thống...", expanded=True) as status:
                 ctr = st.container()
+                items = []
                 for b in all_blocks:
                     bid, bname = b['Block ID'], b['Block Name']
-                    ctr.write(f"**📦 Khối: {bname}**")
-                    links = be.get_links_by_block(st.secrets, bid)
-                    for l in links:
-                        if l.get('Status') == "Đã chốt": continue
-                        sname = l['Sheet Name']
-                        
-                        # Xử lý Link sạch
-                        raw_url_run = l['Link Sheet']
-                        if "docs.google.com" in str(raw_url_run):
-                            try:
-                                fid = str(raw_url_run).split("/d/")[1].split("/")[0]
-                                final_link = f"https://docs.google.com/spreadsheets/d/{fid}"
-                            except: final_link = raw_url_run
-                        else: final_link = raw_url_run
-
-                        ds, de = None, None
-                        try:
-                            if l.get('Date Start'): ds = pd.to_datetime(l.get('Date Start'), dayfirst=True).date()
-                            if l.get('Date End'): de = pd.to_datetime(l.get('Date End'), dayfirst=True).date()
-                        except: pass
-                        
-                        data, msg = be.fetch_1office_data_smart(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None)
-                        if msg == "Success":
-                            r_str, w_msg = be.process_data_final_v11(st.secrets, final_link, sname, bid, l['Link ID'], data, l.get('Status'))
-                            if "Error" not in w_msg:
-                                be.update_link_last_range(st.secrets, l['Link ID'], bid, r_str)
-                                be.log_execution_history(st.secrets, bname, sname, "Thủ công (All)", "Success", r_str, "OK")
-                                ctr.write(f"&nbsp;&nbsp;✅ {sname}: {r_str}")
-                            else:
-                                be.log_execution_history(st.secrets, bname, sname, "Thủ công (All)", "Error", "Fail", w_msg)
-                                ctr.error(f"&nbsp;&nbsp;❌ {sname}: {w_msg}")
-                        else:
-                            be.log_execution_history(st.secrets, bname, sname, "Thủ công (All)", "Error", "Fail", msg)
-                            ctr.error(f"&nbsp;&nbsp;❌ {sname}: {msg}")
+                    for l in get_cached_links(bid):
+                        items.append((bid, bname, l, be.clean_sheet_link(l['Link Sheet'])))
+
+                # Link cùng tab đích được gom: đọc - gộp - ghi tab 1 lần
+                def report_all(res):
+                    if res["status"] == "Success": ctr.write(f"&nbsp;&nbsp;✅ {res['block_name']} / {res['sheet_name']}: {res['range']}")
+                    else: ctr.error(f"&nbsp;&nbsp;❌ {res['block_name']} / {res['sheet_name']}: {res['message']}")
+                be.run_link_jobs(st.secrets, items, "Thủ công (All)", report=report_all)
+                be.commit_status_updates(st.secrets)
                 status.update(label="✅ Đã chạy xong!", state="complete", expanded=False)
-                time.sleep(1)
 
     # 2. NÚT XEM LỊCH SỬ
     if c3.button("📜 XEM LỊCH SỬ"):
@@ -183,7 +166,7 @@ if st.session_state['view'] == 'list':
         show_user_guide()
     
     # Reload
-    if c5.button("🔄"): clear_cache(); st.rerun()
+    if c5.button("🔄"): refresh_cache(); st.rerun()
 
     # --- KHU VỰC HIỂN THỊ LOG (POPUP DƯỚI NÚT) ---
     if st.session_state['show_log']:
@@ -213,7 +196,7 @@ if st.session_state['view'] == 'list':
             if st.form_submit_button("Tạo ngay"):
                 if new_name:
                     be.create_block(st.secrets, new_name)
-                    clear_cache(); st.rerun()
+                    st.rerun()
 
     # --- DANH SÁCH KHỐI ---
     blocks = get_cached_blocks()
@@ -225,45 +208,20 @@ if st.session_state['view'] == 'list':
                 col2.info(format_schedule_display(b.get('Schedule Type'), b.get('Schedule Config')))
                 
                 if col3.button("▶️ Chạy Khối Này", key=f"run_{b['Block ID']}"):
-                    links = be.get_links_by_block(st.secrets, b['Block ID'])
+                    links = get_cached_links(b['Block ID'])
                     with st.status(f"Đang chạy {b['Block Name']}...", expanded=True):
-                        for l in links:
-                            if l.get('Status') == "Đã chốt": continue
-                            st.write(f"🔄 {l.get('Sheet Name')}")
-                            
-                            # Xử lý Link sạch
-                            raw_url_run = l['Link Sheet']
-                            if "docs.google.com" in str(raw_url_run):
-                                try:
-                                    fid = str(raw_url_run).split("/d/")[1].split("/")[0]
-                                    final_link = f"https://docs.google.com/spreadsheets/d/{fid}"
-                                except: final_link = raw_url_run
-                            else: final_link = raw_url_run
-
-                            ds, de = None, None
-                            try:
-                                if l.get('Date Start'): ds = pd.to_datetime(l.get('Date Start'), dayfirst=True).date()
-                                if l.get('Date End'): de = pd.to_datetime(l.get('Date End'), dayfirst=True).date()
-                            except: pass
-                            
-                            data, msg = be.fetch_1office_data_smart(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None)
-                            if msg == "Success":
-                                r_str, w_msg = be.process_data_final_v11(st.secrets, final_link, l['Sheet Name'], b['Block ID'], l['Link ID'], data, l.get('Status'))
-                                if "Error" not in w_msg:
-                                    be.update_link_last_range(st.secrets, l['Link ID'], b['Block ID'], r_str)
-                                    be.log_execution_history(st.secrets, b['Block Name'], l.get('Sheet Name'), "Thủ công (Block)", "Success", r_str, "OK")
-                                    st.write(f"✅ Xong: {r_str}")
-                                else:
-                                    be.log_execution_history(st.secrets, b['Block Name'], l.get('Sheet Name'), "Thủ công (Block)", "Error", "Fail", w_msg)
-                                    st.error(f"Lỗi: {w_msg}")
-                            else:
-                                be.log_execution_history(st.secrets, b['Block Name'], l.get('Sheet Name'), "Thủ công (Block)", "Error", "Fail", msg)
-                                st.error(f"Lỗi API: {msg}")
+                        items = [(b['Block ID'], b['Block Name'], l, be.clean_sheet_link(l['Link Sheet'])) for l in links]
+                        def report_block(res):
+                            if res["status"] == "Success": st.write(f"✅ {res['sheet_name']}: {res['range']}")
+                            elif res["stage"] == "write": st.error(f"Lỗi {res['sheet_name']}: {res['message']}")
+                            else: st.error(f"Lỗi API {res['sheet_name']}: {res['message']}")
+                        be.run_link_jobs(st.secrets, items, "Thủ công (Block)", report=report_block)
+                        be.commit_status_updates(st.secrets)
                     st.success("Xong!")
 
                 with col4:
                     if st.button("⚙️", key=f"dt_{b['Block ID']}"): go_to_detail(b['Block ID'], b['Block Name']); st.rerun()
-                    if st.button("🗑️", key=f"dl_{b['Block ID']}", type="secondary"): be.delete_block(st.secrets, b['Block ID']); clear_cache(); st.rerun()
+                    if st.button("🗑️", key=f"dl_{b['Block ID']}", type="secondary"): be.delete_block(st.secrets, b['Block ID']); st.rerun()
 
 # ==========================================
 # VIEW: DETAIL (CHI TIẾT & CẤU HÌNH)
@@ -336,55 +294,29 @@ elif st.session_state['view'] == 'detail':
             if st.button("💾 Lưu Cấu Hình Lịch", type="primary", use_container_width=True):
                 be.update_block_config_and_schedule(st.secrets, b_id, b_name, freq, sch_config)
                 st.success("✅ Đã lưu cấu hình lịch!")
-                time.sleep(1)
 
         # NÚT 2: CHẠY KHỐI NGAY (Lấy từ DB)
         with c_btn_run:
             if st.button("▶️ CHẠY KHỐI NGAY", type="secondary", use_container_width=True):
-                db_links = be.get_links_by_block(st.secrets, b_id)
+                db_links = get_cached_links(b_id)
                 if not db_links:
                     st.warning("⚠️ Khối này chưa có dữ liệu nào được lưu.")
                 else:
                     with st.status(f"🚀 Đang chạy khối: {b_name}...", expanded=True) as status:
-                        for l in db_links:
-                            if l.get('Status') == "Đã chốt": continue
-                            st.write(f"🔄 Xử lý: **{l.get('Sheet Name')}**")
-                            
-                            # Xử lý Link
-                            raw_url_run = l['Link Sheet']
-                            if "docs.google.com" in str(raw_url_run):
-                                try: fid = str(raw_url_run).split("/d/")[1].split("/")[0]; final_link = f"https://docs.google.com/spreadsheets/d/{fid}"
-                                except: final_link = raw_url_run
-                            else: final_link = raw_url_run
-
-                            # Ngày tháng
-                            ds, de = None, None
-                            try:
-                                if l.get('Date Start'): ds = pd.to_datetime(l.get('Date Start'), dayfirst=True).date()
-                                if l.get('Date End'): de = pd.to_datetime(l.get('Date End'), dayfirst=True).date()
-                            except: pass
-                            
-                            # API & Save
-                            data, msg = be.fetch_1office_data_smart(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None)
-                            if msg == "Success":
-                                r_str, w_msg = be.process_data_final_v11(st.secrets, final_link, l['Sheet Name'], b_id, l['Link ID'], data, l.get('Status'))
-                                if "Error" not in w_msg:
-                                    be.update_link_last_range(st.secrets, l['Link ID'], b_id, r_str)
-                                    be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Success", r_str, "OK")
-                                    st.write(f"✅ OK: {r_str}")
-                                else:
-                                    be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Error", "Fail", w_msg)
-                                    st.error(f"❌ Lỗi ghi: {w_msg}")
-                            else:
-                                be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Error", "Fail", msg)
-                                st.error(f"❌ Lỗi API: {msg}")
+                        items = [(b_id, b_name, l, be.clean_sheet_link(l['Link Sheet'])) for l in db_links]
+                        def report_detail(res):
+                            if res["status"] == "Success": st.write(f"✅ {res['sheet_name']}: {res['range']}")
+                            elif res["stage"] == "write": st.error(f"❌ Lỗi ghi {res['sheet_name']}: {res['message']}")
+                            else: st.error(f"❌ Lỗi API {res['sheet_name']}: {res['message']}")
+                        be.run_link_jobs(st.secrets, items, "Thủ công (Detail)", report=report_detail)
+                        be.commit_status_updates(st.secrets)
                         status.update(label="✅ Đã chạy xong!", state="complete", expanded=False)
 
     st.divider()
     
     # --- PHẦN 2: LOAD DATA & HIỂN THỊ BẢNG ---
     if not st.session_state['data_loaded']:
-        original_links = be.get_links_by_block(st.secrets, b_id)
+        original_links = get_cached_links(b_id)
         header_cols = ["Link ID", "Block ID", "Method", "API URL", "Access Token", "Link Sheet", "Sheet Name", "Filter Key", "Date Start", "Date End", "Status", "Last Range"]
         if original_links: df_temp = pd.DataFrame(original_links).drop_duplicates(subset=["Link ID"])
         else: df_temp = pd.DataFrame(columns=header_cols)
@@ -537,34 +469,15 @@ elif st.session_state['view'] == 'detail':
         else:
             prog = st.progress(0, text="Khởi động...")
             tot = len(valid)
-            for i, l in enumerate(valid):
-                prog.progress(int(((i)/tot)*100), text=f"Chạy: {l.get('Sheet Name')}")
-                ds, de = None, None
-                try: 
-                    if l.get('Date Start'): ds = pd.to_datetime(l.get('Date Start'), dayfirst=True).date()
-                    if l.get('Date End'): de = pd.to_datetime(l.get('Date End'), dayfirst=True).date()
-                except: pass
-                
-                # ... Xử lý link ...
-                r_url = l['Link Sheet']
-                if "docs.google.com" in str(r_url):
-                    try: fid = str(r_url).split("/d/")[1].split("/")[0]; f_link = f"https://docs.google.com/spreadsheets/d/{fid}"
-                    except: f_link = r_url
-                else: f_link = r_url
-
-                data, msg = be.fetch_1office_data_smart(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None)
-                if msg == "Success":
-                    r_str, w_msg = be.process_data_final_v11(st.secrets, f_link, l['Sheet Name'], b_id, l['Link ID'], data, l.get('Status'))
-                    if "Error" not in w_msg:
-                        be.update_link_last_range(st.secrets, l['Link ID'], b_id, r_str)
-                        be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Success", r_str, "OK")
-                    else:
-                        be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Error", "Fail", w_msg)
-                        st.error(f"Lỗi: {w_msg}")
-                else:
-                    be.log_execution_history(st.secrets, b_name, l.get('Sheet Name'), "Thủ công (Detail)", "Error", "Fail", msg)
-                    st.error(f"API Lỗi: {msg}")
-                time.sleep(0.5)
+            done = []
+            def report_run(res):
+                done.append(res)
+                prog.progress(int((len(done)/tot)*100), text=f"Xong: {res['sheet_name']}")
+                if res["stage"] == "write": st.error(f"Lỗi: {res['message']}")
+                elif res["stage"] == "api": st.error(f"API Lỗi: {res['message']}")
+            items = [(b_id, b_name, l, be.clean_sheet_link(l['Link Sheet'])) for l in valid]
+            be.run_link_jobs(st.secrets, items, "Thủ công (Detail)", report=report_run)
+            be.commit_status_updates(st.secrets)
             
             st.session_state['data_loaded'] = False 
             prog.progress(100, text="Hoàn tất!"); st.success("Xong!"); time.sleep(1); st.rerun()
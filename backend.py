@@ -1,74 +1,700 @@
-import gspread
-import requests
-import pandas as pd
 import math
 import time
 import json
 import uuid
+import os
+import hashlib
+import atexit
 import re
+import random
+import threading
+import queue
+import sqlite3
+import importlib
+import sys
+from numbers import Real
 from datetime import datetime, timedelta
-from google.oauth2.service_account import Credentials
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlencode, quote
-from gspread_dataframe import set_with_dataframe, get_as_dataframe
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from itertools import islice, chain
+from urllib.parse import urlencode, quote, urlsplit
+
+# --- IMPORT TRỄ (LAZY) ---
+# pandas / gspread / gspread_dataframe / google-auth / requests chỉ nạp ở lần dùng đầu tiên:
+# headless "không có block nào đến hạn" chỉ cần gspread cho 1 lần đọc master, không nạp pandas.
+# Lần dùng đầu import thật rồi thay luôn biến toàn cục bằng đối tượng thật -> các lần sau không qua proxy.
+class _Lazy:
+    def __init__(self, name, module, attr=None):
+        self._name, self._module, self._attr = name, module, attr
+
+    def _load(self):
+        obj = importlib.import_module(self._module)
+        if self._attr: obj = getattr(obj, self._attr)
+        globals()[self._name] = obj
+        return obj
+
+    def __getattr__(self, attr): return getattr(self._load(), attr)
+    def __call__(self, *args, **kwargs): return self._load()(*args, **kwargs)
+
+pd = _Lazy("pd", "pandas")
+gspread = _Lazy("gspread", "gspread")
+requests = _Lazy("requests", "requests")
+Credentials = _Lazy("Credentials", "google.oauth2.service_account", "Credentials")
+HTTPAdapter = _Lazy("HTTPAdapter", "requests.adapters", "HTTPAdapter")
+extract_id_from_url = _Lazy("extract_id_from_url", "gspread.utils", "extract_id_from_url")
+numericise_all = _Lazy("numericise_all", "gspread.utils", "numericise_all")
+rowcol_to_a1 = _Lazy("rowcol_to_a1", "gspread.utils", "rowcol_to_a1")
+get_as_dataframe = _Lazy("get_as_dataframe", "gspread_dataframe", "get_as_dataframe")
 
 # --- CẤU HÌNH ---
 SCOPE = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+# Số trang gọi song song cho mỗi host API: tự điều chỉnh (AIMD) trong khoảng [MIN, MAX]
+# secrets["system"]["fetch_concurrency_min" / "fetch_concurrency_max" / "fetch_latency_factor"] ghi đè (configure_fetch)
+FETCH_CONCURRENCY_MIN = 2
+FETCH_CONCURRENCY_MAX = 15
+FETCH_CONCURRENCY_START = 5
+FETCH_LATENCY_FACTOR = 2.5  # Độ trễ TB > hệ số x độ trễ tốt nhất -> coi như quá tải, giảm song song
+# Retry từng trang: backoff mũ có jitter, ngân sách retry = max(MIN, RATIO x số trang) cho mỗi link
+FETCH_PAGE_RETRIES = 4
+FETCH_BACKOFF_BASE = 1.0
+FETCH_BACKOFF_CAP = 30.0
+FETCH_RETRY_BUDGET_MIN = 10
+FETCH_RETRY_BUDGET_RATIO = 0.2
+HTTP_POOL_SIZE = None  # Số kết nối giữ sẵn cho mỗi host; None -> = FETCH_CONCURRENCY_MAX lúc tạo Session
+LINK_WORKERS = 4  # Số spreadsheet đích xử lý song song trong 1 lần chạy headless
+STREAM_BATCH_ROWS = 5000  # Số dòng mỗi lô khi chạy chế độ stream (giới hạn bộ nhớ đỉnh)
+# Quota Google Sheets API (mặc định): 60 request đọc + 60 request ghi / phút / user (service account)
+SHEETS_READ_PER_MIN = 60
+SHEETS_WRITE_PER_MIN = 60
+SHEETS_BURST = 10  # Số request được gửi dồn ngay không chờ (phần còn lại của quota nạp đều trong phút)
+SHEETS_MAX_RETRIES = 5  # Số lần gọi lại khi gặp 429 / 408 / 5xx (backoff mũ, ưu tiên Retry-After)
+
+# --- GIỚI HẠN QUOTA GOOGLE SHEETS (TOKEN BUCKET) ---
+# Mọi request của gspread đi qua SheetsHTTPClient: GET lấy token của bucket "read", còn lại lấy bucket "write".
+# Bucket chứa tối đa `burst` token, nạp (quota - burst)/phút -> trong mọi cửa sổ 60s trượt số request
+# không vượt burst + (quota - burst) = quota (bucket đầy = quota và nạp thêm quota/phút sẽ cho tới ~2x quota).
+class TokenBucket:
+    def __init__(self, per_min, burst=SHEETS_BURST):
+        burst = max(1, min(burst, per_min - 1))
+        self.rate = (per_min - burst) / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.hold_until = 0.0
+        self.waited = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Chặn tới khi có 1 token; trả về số giây đã chờ
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.hold_until - now
+                if delay <= 0:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.calls += 1
+                        self.waited += waited
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def hold(self, seconds):
+        # Bị 429: dừng cả bucket (mọi luồng) trong `seconds` giây, bỏ phần token đang dư, nạp lại từ lúc hết chờ
+        with self.lock:
+            self.hold_until = max(self.hold_until, time.monotonic() + seconds)
+            self.stamp = self.hold_until
+            self.tokens = 0.0
+
+_SHEET_ID_RE = re.compile(r"/(?:spreadsheets|files)/([a-zA-Z0-9_-]+)")
+SheetsHTTPClient = None  # Lớp con HTTPClient của gspread, dựng ở lần authorize đầu tiên (gspread nạp trễ)
+
+def _sheets_http_client_class():
+    global SheetsHTTPClient
+    if SheetsHTTPClient is not None: return SheetsHTTPClient
+    APIError = gspread.exceptions.APIError
+
+    class SheetsHTTPClient(gspread.http_client.HTTPClient):
+        limiter = None  # {"read": TokenBucket, "write": TokenBucket}, gán trong get_gspread_client
+
+        def request(self, method, endpoint, *args, **kwargs):
+            bucket = self.limiter["read" if method.upper() == "GET" else "write"]
+            attempt = 0
+            while True:
+                waited = bucket.acquire()
+                kind = "sheets_read" if bucket is self.limiter["read"] else "sheets_write"
+                try:
+                    resp = super().request(method, endpoint, *args, **kwargs)
+                    count_call(kind, len(resp.content), wait=waited)
+                    return resp
+                except APIError as e:
+                    count_call(kind, wait=waited)
+                    if (e.code not in (408, 429) and e.code < 500) or attempt >= SHEETS_MAX_RETRIES:
+                        # Handle Worksheet có thể đã cũ (tab bị xóa / đổi tên / đổi kích thước ngoài engine) -> bỏ cache
+                        m = _SHEET_ID_RE.search(str(endpoint))
+                        if m: invalidate_sheet_cache(m.group(1))
+                        raise
+                    try: retry_after = float(e.response.headers.get("Retry-After", 0) or 0)
+                    except (TypeError, ValueError): retry_after = 0
+                    delay = max(retry_after, random.uniform(0, min(FETCH_BACKOFF_CAP, FETCH_BACKOFF_BASE * (2 ** attempt))))
+                    _printer()(f"   ⏳ Google Sheets {e.code}: thử lại lần {attempt + 1} sau {delay:.1f}s")
+                    bucket.hold(delay)
+                    attempt += 1
+
+    return SheetsHTTPClient
+
+_sheets_limiters = {}
+
+def get_sheets_quota_stats():
+    return {ck[0]: {kind: {"calls": b.calls, "waited": round(b.waited, 1)} for kind, b in lim.items()}
+            for ck, lim in _sheets_limiters.items()}
+
+# --- GOOGLE CLIENT & HANDLE CACHE (DÙNG CHUNG TOÀN TIẾN TRÌNH) ---
+# Authorize 1 lần / service account; google-auth tự refresh token khi hết hạn nên client dùng lại được mãi.
+# Spreadsheet giữ theo key, Worksheet theo (spreadsheet id, title) -> không fetch metadata lại mỗi lần gọi.
+_gc_cache = {}
+_ss_cache = {}
+_ws_cache = {}
+_gs_lock = threading.Lock()
+
+def get_gspread_client(secrets_dict):
+    info = secrets_dict["gcp_service_account"]
+    ck = (info.get("client_email"), info.get("private_key_id"))
+    gc = _gc_cache.get(ck)
+    if gc is None:
+        with span("auth"):
+            creds = Credentials.from_service_account_info(info, scopes=SCOPE)
+            gc = gspread.authorize(creds, http_client=_sheets_http_client_class())
+        with _gs_lock:
+            # Quota tính theo user -> mỗi service account 1 cặp bucket, dùng chung mọi luồng
+            gc.http_client.limiter = _sheets_limiters.setdefault(ck, {"read": TokenBucket(SHEETS_READ_PER_MIN), "write": TokenBucket(SHEETS_WRITE_PER_MIN)})
+            gc = _gc_cache.setdefault(ck, gc)
+    return gc
+
+def open_spreadsheet(secrets_dict, key=None, url=None, refresh=False):
+    # refresh=True -> luôn mở lại (VD: kiểm tra quyền), kết quả vẫn được ghi vào cache
+    gc = get_gspread_client(secrets_dict)
+    if key is None: key = extract_id_from_url(str(url))
+    ck = (id(gc), key)
+    sh = None if refresh else _ss_cache.get(ck)
+    if sh is None:
+        sh = gc.open_by_key(key)
+        with _gs_lock:
+            if refresh: _ss_cache[ck] = sh
+            else: sh = _ss_cache.setdefault(ck, sh)
+    return sh
+
+def get_worksheet(sh, title, rows=None, cols=None):
+    # rows/cols khác None -> tạo tab mới nếu chưa có
+    ck = (sh.id, title)
+    wks = _ws_cache.get(ck)
+    if wks is not None: return wks
+    try: wks = sh.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        if rows is None: raise
+        return add_worksheet_cached(sh, title, rows, cols)
+    with _gs_lock: return _ws_cache.setdefault(ck, wks)
+
+def add_worksheet_cached(sh, title, rows, cols):
+    wks = sh.add_worksheet(title, rows, cols)
+    invalidate_sheet_cache(sh.id)
+    with _gs_lock: _ws_cache[(sh.id, title)] = wks
+    return wks
+
+def list_worksheet_titles(sh):
+    # Nạp toàn bộ tab 1 lần (1 request metadata) và đưa vào cache
+    wss = sh.worksheets()
+    with _gs_lock:
+        for w in wss: _ws_cache.setdefault((sh.id, w.title), w)
+    return [w.title for w in wss]
+
+def invalidate_sheet_cache(spreadsheet_id=None):
+    # Bỏ cache Worksheet của 1 spreadsheet (hoặc tất cả) khi cấu trúc tab thay đổi
+    with _gs_lock:
+        for ck in [k for k in _ws_cache if spreadsheet_id is None or k[0] == spreadsheet_id]: del _ws_cache[ck]
+        if spreadsheet_id is None: _ss_cache.clear()
+        else:
+            for ck in [k for k, v in _ss_cache.items() if v.id == spreadsheet_id]: del _ss_cache[ck]
 
 def get_connection(secrets_dict):
     try:
-        creds = Credentials.from_service_account_info(secrets_dict["gcp_service_account"], scopes=SCOPE)
-        gc = gspread.authorize(creds)
         master_id = secrets_dict["system"]["master_sheet_id"]
-        return gc.open_by_key(master_id), "Success"
+        return open_spreadsheet(secrets_dict, key=master_id), "Success"
     except Exception as e: return None, str(e)
 
+class FetchIncompleteError(Exception):
+    # Dữ liệu 1Office bị thiếu trang/dòng sau khi đã thử lại -> không được ghi xuống Sheet
+    pass
+
 # --- HELPER ---
 def clean_str_series(series):
     # Thêm .str.lstrip("'") để cắt bỏ dấu nháy đơn ở đầu nếu có
     return series.astype(str).str.strip().str.replace(r'\.0$', '', regex=True).str.lstrip("'")
 
+def _is_na(val):
+    # = pd.isna(val) cho 1 giá trị; chưa nạp pandas thì không thể có pd.NA / NaT -> không import pandas chỉ để kiểm tra
+    if val is None or (isinstance(val, float) and math.isnan(val)): return True
+    return "pandas" in sys.modules and pd.isna(val)
+
 def clean_str(val):
-    if pd.isna(val) or val is None: return ""
+    if _is_na(val): return ""
     # Thêm .lstrip("'") để cắt bỏ dấu nháy đơn khi lấy giá trị đơn lẻ
     return str(val).strip().replace(".0", "").lstrip("'")
 
+# In ra màn hình, hoặc gom vào buffer của luồng hiện tại khi run_link_jobs chạy song song
+_tls = threading.local()
+
+def _printer():
+    buf = getattr(_tls, "out", None)
+    return buf.append if buf is not None else print
+
+# --- ĐO THỜI GIAN TỪNG BƯỚC (SPAN) ---
+# with span("merge", link=...): đo thời gian 1 bước; tag (block/link/sheet...) kế thừa từ span cha trong cùng luồng.
+# Số request + số byte nhận về (1Office, Sheets đọc/ghi) được cộng vào MỌI span đang mở (tính gộp từ trong ra ngoài).
+# Luồng con (fetch trang, worker) nhận span cha qua current_spans() / span_parent().
+# Span chỉ được lưu khi đang có run report mở (span_report, vd. traced_run của headless / daemon); ngoài đó
+# (Streamlit, reload() của daemon giữa 2 lần chạy) span vẫn đo + đếm request nhưng không giữ lại -> bộ nhớ không phình.
+# write_run_report() ghi các span + bảng tổng theo stage (JSON lines) rồi xóa bộ nhớ span.
+_spans = []
+_span_lock = threading.Lock()
+_span_reports = 0  # Số run report đang mở
+
+def _span_stack():
+    st = getattr(_tls, "spans", None)
+    if st is None: st = _tls.spans = []
+    return st
+
+def current_spans():
+    return list(_span_stack())
+
+@contextmanager
+def span_parent(parents):
+    old = getattr(_tls, "spans", None)
+    _tls.spans = list(parents)
+    try: yield
+    finally: _tls.spans = old
+
+@contextmanager
+def span(stage, **tags):
+    stack = _span_stack()
+    if stack: tags = {**stack[-1]["tags"], **tags}
+    rec = {"stage": stage, "tags": tags, "start": round(time.time(), 3), "calls": {}, "bytes": 0, "wait": 0.0, "ok": True}
+    t0 = time.perf_counter()
+    stack.append(rec)
+    try: yield rec
+    except BaseException as e:
+        rec["ok"], rec["error"] = False, f"{type(e).__name__}: {e}"[:300]
+        raise
+    finally:
+        if stack and stack[-1] is rec: stack.pop()
+        rec["dur"] = round(time.perf_counter() - t0, 4)
+        with _span_lock:
+            if _span_reports: _spans.append(rec)
+
+@contextmanager
+def span_report(stage, **tags):
+    # Span gốc của 1 run report: mọi span mở/đóng bên trong (kể cả ở luồng con) được lưu tới write_run_report()
+    global _span_reports
+    with _span_lock: _span_reports += 1
+    try:
+        with span(stage, **tags) as rec: yield rec
+    finally:
+        with _span_lock: _span_reports -= 1
+
+def count_call(kind, nbytes=0, spans=None, wait=0.0):
+    with _span_lock:
+        for rec in (_span_stack() if spans is None else spans):
+            rec["calls"][kind] = rec["calls"].get(kind, 0) + 1
+            rec["bytes"] += nbytes
+            rec["wait"] += wait
+
+def reset_spans():
+    with _span_lock: _spans.clear()
+
+def summarize_spans(spans):
+    out = {}
+    for r in spans:
+        st = out.setdefault(r["stage"], {"count": 0, "dur": 0.0, "max": 0.0, "errors": 0, "calls": {}, "bytes": 0, "wait": 0.0})
+        st["count"] += 1
+        st["dur"] = round(st["dur"] + r["dur"], 4)
+        st["max"] = max(st["max"], r["dur"])
+        st["errors"] += 0 if r["ok"] else 1
+        st["bytes"] += r["bytes"]
+        st["wait"] = round(st["wait"] + r["wait"], 3)
+        for k, v in r["calls"].items(): st["calls"][k] = st["calls"].get(k, 0) + v
+    return out
+
+def write_run_report(path, **meta):
+    # Mỗi span 1 dòng {"type": "span"} + 1 dòng {"type": "summary"} (tổng theo stage, số liệu tính gộp span con)
+    with _span_lock: spans, _spans[:] = list(_spans), []
+    summary = summarize_spans(spans)
+    run_id = meta.pop("run_id", None) or uuid.uuid4().hex[:8]
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            for r in spans: f.write(json.dumps({"type": "span", "run_id": run_id, **r}, ensure_ascii=False, default=str) + "\n")
+            f.write(json.dumps({"type": "summary", "run_id": run_id, **meta, "stages": summary}, ensure_ascii=False, default=str) + "\n")
+    except Exception as e: print(f"⚠️ Không ghi được run report {path}: {e}")
+    return summary
+
+PROFILE_TOP = 30  # Số hàm in ra khi profile 1 link (secrets["system"]["profile_link"] = Link ID)
+
+def profile_call(name, fn, *args, **kwargs):
+    # cProfile cho đúng 1 lần gọi (chỉ luồng hiện tại): ghi <name>.prof + in top PROFILE_TOP hàm theo cumulative
+    import cProfile, pstats, io
+    prof = cProfile.Profile()
+    try: return prof.runcall(fn, *args, **kwargs)
+    finally:
+        prof.dump_stats(f"{name}.prof")
+        buf = io.StringIO()
+        pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        _printer()(f"   🔬 cProfile -> {name}.prof\n{buf.getvalue()}")
+
 def safe_get_records(wks):
     try: return wks.get_all_records()
     except: return []
 
+# --- HTTP POOL (KEEP-ALIVE, DÙNG CHUNG CẢ LẦN CHẠY) ---
+_http_sessions = {}
+_http_lock = threading.Lock()
+
+def get_http_session(url):
+    # Mỗi host API dùng 1 Session riêng -> các trang/link sau tái sử dụng kết nối TCP+TLS
+    host = _host_of(url)
+    with _http_lock:
+        sess = _http_sessions.get(host)
+        if sess is None:
+            sess = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE or FETCH_CONCURRENCY_MAX, pool_block=True)
+            sess.mount("https://", adapter)
+            sess.mount("http://", adapter)
+            _http_sessions[host] = sess
+        return sess
+
+def get_http_pool_stats():
+    # Trả về {host: {"requests", "connections", "reused"}} đọc từ urllib3 pool
+    stats = {}
+    with _http_lock:
+        for host, sess in _http_sessions.items():
+            n_req = n_conn = 0
+            for adapter in set(sess.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    try: pool = pools[key]
+                    except KeyError: continue
+                    n_req += pool.num_requests
+                    n_conn += pool.num_connections
+            stats[host] = {"requests": n_req, "connections": n_conn, "reused": max(n_req - n_conn, 0)}
+    return stats
+
+def close_http_sessions():
+    with _http_lock:
+        for sess in _http_sessions.values():
+            try: sess.close()
+            except: pass
+        _http_sessions.clear()
+
+# --- ĐIỀU CHỈNH SONG SONG THEO HOST (AIMD) ---
+# Tăng cộng (+1 mỗi "vòng" thành công), giảm nhân (x0.5) khi lỗi/429/độ trễ tăng vọt.
+# Giới hạn học được giữ theo host cho tới hết lần chạy (các link sau dùng lại).
+_concurrency = {}
+_concurrency_lock = threading.Lock()
+
+def _host_of(url):
+    return urlsplit(str(url)).netloc.lower()
+
+def _concurrency_state(host):
+    st = _concurrency.get(host)
+    if st is None:
+        st = {"limit": float(FETCH_CONCURRENCY_START), "lat_ewma": None, "lat_best": None, "last_cut": 0.0,
+              "ok": 0, "errors": 0, "throttled": 0, "inflight": 0}
+        _concurrency[host] = st
+    return st
+
+def get_fetch_limit(host):
+    with _concurrency_lock:
+        lim = int(_concurrency_state(host)["limit"])
+    return max(FETCH_CONCURRENCY_MIN, min(FETCH_CONCURRENCY_MAX, lim))
+
+def fetch_room(host, own):
+    # Số trang còn được gửi thêm: giới hạn AIMD trừ số request đang bay tới host (của MỌI link đang chạy song song).
+    # own = số trang link hiện tại đang chờ; link không còn trang nào đang chờ luôn được gửi ít nhất 1 (tránh treo).
+    with _concurrency_lock:
+        busy = max(_concurrency_state(host)["inflight"], own)
+    return max(get_fetch_limit(host) - busy, 0 if own else 1)
+
+def _track_inflight(host, delta):
+    with _concurrency_lock: _concurrency_state(host)["inflight"] += delta
+
+def record_fetch_result(host, latency, ok, throttled=False):
+    # Gọi sau mỗi request trang: latency (giây), ok = HTTP 200, throttled = HTTP 429
+    now = time.monotonic()
+    with _concurrency_lock:
+        st = _concurrency_state(host)
+        congested = not ok
+        if ok:
+            st["ok"] += 1
+            st["lat_ewma"] = latency if st["lat_ewma"] is None else 0.8 * st["lat_ewma"] + 0.2 * latency
+            # Mốc "tốt nhất" trôi lên chậm để 1 lần trả về nhanh bất thường không khóa giới hạn ở mức thấp
+            st["lat_best"] = latency if st["lat_best"] is None else min(st["lat_best"] * 1.01, latency)
+            congested = st["lat_ewma"] > FETCH_LATENCY_FACTOR * max(st["lat_best"], 0.05)
+        elif throttled: st["throttled"] += 1
+        else: st["errors"] += 1
+
+        if congested:
+            # Chỉ giảm 1 lần trong mỗi khoảng ~ độ trễ TB (nhiều request lỗi cùng lúc không làm giảm dồn)
+            if now - st["last_cut"] >= max(st["lat_ewma"] or 1.0, 1.0):
+                st["limit"] = max(float(FETCH_CONCURRENCY_MIN), st["limit"] * 0.5)
+                st["last_cut"] = now
+        else:
+            st["limit"] = min(float(FETCH_CONCURRENCY_MAX), st["limit"] + 1.0 / st["limit"])
+
+_FETCH_DEFAULTS = (FETCH_CONCURRENCY_MIN, FETCH_CONCURRENCY_MAX, FETCH_LATENCY_FACTOR)
+
+def configure_fetch(secrets_dict):
+    # Gọi đầu mỗi lần chạy: secrets["system"] ghi đè [MIN, MAX] / hệ số độ trễ, không có -> giá trị mặc định ở trên.
+    # MAX đổi -> đóng các Session để pool kết nối được tạo lại đúng cỡ mới
+    global FETCH_CONCURRENCY_MIN, FETCH_CONCURRENCY_MAX, FETCH_LATENCY_FACTOR
+    cfg, (d_min, d_max, d_lat) = secrets_dict.get("system", {}), _FETCH_DEFAULTS
+    hi = max(1, int(cfg.get("fetch_concurrency_max") or d_max))
+    lo = max(1, min(int(cfg.get("fetch_concurrency_min") or d_min), hi))
+    if hi != FETCH_CONCURRENCY_MAX and HTTP_POOL_SIZE is None: close_http_sessions()
+    FETCH_CONCURRENCY_MIN, FETCH_CONCURRENCY_MAX = lo, hi
+    FETCH_LATENCY_FACTOR = float(cfg.get("fetch_latency_factor") or d_lat)
+
+def get_concurrency_stats():
+    with _concurrency_lock:
+        return {h: {"limit": int(st["limit"]), "ok": st["ok"], "errors": st["errors"], "throttled": st["throttled"],
+                    "latency": round(st["lat_ewma"] or 0, 3)} for h, st in _concurrency.items()}
+
 # --- INIT DATABASE (SCHEMA V20 - LOG CHI TIẾT) ---
 def init_database(secrets_dict):
+    # True khi đủ các tab hệ thống (có sẵn hoặc vừa tạo); False khi lỗi kết nối / tạo tab -> lần sau thử lại
     sh, msg = get_connection(secrets_dict)
-    if not sh: return
+    if not sh: return False
     schemas = {
         "manager_blocks": ["Block ID", "Block Name", "Schedule Type", "Schedule Config", "Status", "Last Run"],
-        "manager_links": ["Link ID", "Block ID", "Method", "API URL", "Access Token", "Link Sheet", "Sheet Name", "Filter Key", "Date Start", "Date End", "Status", "Last Range"],
+        "manager_links": ["Link ID", "Block ID", "Method", "API URL", "Access Token", "Link Sheet", "Sheet Name", "Filter Key", "Date Start", "Date End", "Status", "Last Range", "Watermark", "Content Hash"],
         "log_system": ["Time", "Block", "Message", "Type"],
         "lich_chay_tu_dong": ["Block ID", "Block Name", "Frequency", "Config JSON", "Last Updated"],
         "log_lan_thuc_thi": ["Time", "Block Name", "Sheet Name", "Trigger Type", "Status", "Updated Range", "Message"]
     }
-    existing = [s.title for s in sh.worksheets()]
+    try: existing = list_worksheet_titles(sh)
+    except Exception: return False
+    ok = True
     for name, cols in schemas.items():
         if name not in existing:
-            try: wks = sh.add_worksheet(name, 100, 20); wks.append_row(cols)
-            except: pass
+            try: wks = add_worksheet_cached(sh, name, 100, 20); wks.append_row(cols)
+            except: ok = False
+    return ok
+
+# --- MASTER SNAPSHOT (manager_blocks + manager_links, ĐỌC 1 LẦN) ---
+# 1 request values_batch_get cho cả 2 tab, dựng index Block ID -> links và (Block ID, Link ID) -> số dòng.
+# Dùng chung mọi luồng / mọi phiên Streamlit trong tiến trình. Các hàm ghi vào 2 tab này phải gọi
+# invalidate_master_snapshot(secrets, tabs=(...)): chỉ tab đã ghi bị đọc lại (vẫn 1 request), tab kia giữ trong RAM.
+# refresh=True / hết TTL -> đọc lại cả 2.
+MASTER_SNAPSHOT_TTL = 300  # giây
+MASTER_TABS = ("manager_blocks", "manager_links")
+_master_snapshot = {}
+_master_lock = threading.Lock()
+
+def _records_from_values(values):
+    # Giống get_all_records(): dòng 1 là header, pad ô trống, ép số
+    if not values: return [], []
+    header = values[0]
+    recs = []
+    for row in values[1:]:
+        row = list(row) + [""] * (len(header) - len(row))
+        recs.append(dict(zip(header, numericise_all(row, False, ""))))
+    return header, recs
+
+def load_master_snapshot(secrets_dict, refresh=False):
+    master_id = secrets_dict["system"]["master_sheet_id"]
+    with _master_lock:
+        snap = _master_snapshot.get(master_id)
+        fresh = snap is not None and not refresh and time.time() - snap["loaded_at"] < MASTER_SNAPSHOT_TTL
+        if fresh and not snap["stale"]: return snap
+        tabs = [t for t in MASTER_TABS if t in snap["stale"]] if fresh else list(MASTER_TABS)
+    with span("master_read", tabs=len(tabs)):
+        # Gọi thẳng values:batchGet, không open_by_key -> đúng 1 request (không đọc thêm metadata)
+        res = get_gspread_client(secrets_dict).http_client.values_batch_get(master_id, tabs)
+    vrs = res.get("valueRanges", [])
+    parsed = {t: _records_from_values(vrs[i].get("values", []) if len(vrs) > i else []) for i, t in enumerate(tabs)}
+    b_header, blocks = parsed.get("manager_blocks") or (snap["blocks_header"], snap["blocks"])
+    l_header, links = parsed.get("manager_links") or (snap["links_header"], snap["links"])
+    snap = {"blocks": blocks, "links": links, "blocks_header": b_header, "links_header": l_header,
+            "block_row": {}, "links_by_block": {}, "link_row": {}, "stale": set(),
+            "loaded_at": snap["loaded_at"] if fresh else time.time()}
+    for i, b in enumerate(blocks, start=2):
+        snap["block_row"].setdefault(clean_str(b.get("Block ID", "")), i)
+    for i, l in enumerate(links, start=2):
+        tb, tl = clean_str(l.get("Block ID", "")), clean_str(l.get("Link ID", ""))
+        snap["links_by_block"].setdefault(tb, []).append(l)
+        snap["link_row"].setdefault((tb, tl), i)
+    with _master_lock: _master_snapshot[master_id] = snap
+    return snap
+
+def invalidate_master_snapshot(secrets_dict=None, tabs=None):
+    # tabs=None -> bỏ cả snapshot; tabs=("manager_links",) -> chỉ đánh dấu tab đó, lần đọc sau chỉ tải lại tab đó
+    with _master_lock:
+        if secrets_dict is None: _master_snapshot.clear()
+        elif tabs is None: _master_snapshot.pop(secrets_dict["system"]["master_sheet_id"], None)
+        else:
+            snap = _master_snapshot.get(secrets_dict["system"]["master_sheet_id"])
+            if snap: snap["stale"].update(tabs)
 
 # --- LOG FUNCTION (7 CỘT) ---
+# Mặc định ghi ngay từng dòng (UI). Trong buffered_execution_logs(): gom dòng trong RAM và ghi 1 lần bằng
+# append_rows khi đủ LOG_FLUSH_ROWS dòng, khi gọi flush_execution_logs (hết block) và khi thoát (kể cả lỗi).
+LOG_FLUSH_ROWS = 50
+_log_buffer = {"enabled": False, "secrets": None, "rows": []}
+_log_lock = threading.Lock()
+
 def log_execution_history(secrets_dict, block_name, sheet_name, trigger_type, status, range_val, message):
+    now_str = (datetime.utcnow() + timedelta(hours=7)).strftime("%H:%M:%S %d/%m/%Y")
+    row = [now_str, str(block_name), str(sheet_name), str(trigger_type), str(status), str(range_val), str(message)]
+    with _log_lock:
+        if _log_buffer["enabled"]:
+            _log_buffer["rows"].append(row)
+            if len(_log_buffer["rows"]) < LOG_FLUSH_ROWS: return
+            rows, _log_buffer["rows"] = _log_buffer["rows"], []
+        else: rows = [row]
+    _write_log_rows(secrets_dict, rows)
+
+def _write_log_rows(secrets_dict, rows, requeue=True):
     try:
-        sh, _ = get_connection(secrets_dict)
-        if not sh: return
-        wks = sh.worksheet("log_lan_thuc_thi")
-        now_str = (datetime.utcnow() + timedelta(hours=7)).strftime("%H:%M:%S %d/%m/%Y")
-        wks.append_row([now_str, str(block_name), str(sheet_name), str(trigger_type), str(status), str(range_val), str(message)])
-    except Exception as e: print(f"Log Error: {e}") 
+        with span("log_flush", rows=len(rows)):
+            sh, _ = get_connection(secrets_dict)
+            if not sh: raise RuntimeError("Không kết nối được Master Sheet")
+            wks = get_worksheet(sh, "log_lan_thuc_thi")
+            if len(rows) == 1: wks.append_row(rows[0])
+            else: wks.append_rows(rows)
+        master_id = secrets_dict["system"]["master_sheet_id"]
+        with _log_lock: _log_writes[master_id] = _log_writes.get(master_id, 0) + 1
+    except Exception as e:
+        print(f"Log Error: {e}")
+        # Đang buffer -> giữ lại để lần flush sau ghi tiếp
+        if requeue:
+            with _log_lock:
+                if _log_buffer["enabled"]: _log_buffer["rows"][:0] = rows
+
+def flush_execution_logs(final=False):
+    with _log_lock:
+        rows, _log_buffer["rows"] = _log_buffer["rows"], []
+        secrets_dict = _log_buffer["secrets"]
+    if rows and secrets_dict is not None: _write_log_rows(secrets_dict, rows, requeue=not final)
+
+@contextmanager
+def buffered_execution_logs(secrets_dict):
+    with _log_lock:
+        _log_buffer["enabled"] = True
+        _log_buffer["secrets"] = secrets_dict
+    try: yield
+    finally:
+        flush_execution_logs(final=True)
+        with _log_lock: _log_buffer["enabled"] = False
+
+def _flush_logs_at_exit():
+    if _log_buffer["rows"]: flush_execution_logs(final=True)
+
+atexit.register(_flush_logs_at_exit)
+
+# --- ĐỌC LOG CHO UI (CACHE DÙNG CHUNG, ĐỌC TĂNG DẦN) ---
+# Tab log chỉ nối thêm dòng -> giữ bản trong RAM cho mọi phiên; hết LOG_CACHE_TTL hoặc tiến trình vừa ghi log
+# thì chỉ đọc các dòng sau dòng cuối đã biết (1 request nhỏ). refresh=True / quá LOG_FULL_REFRESH -> đọc lại cả tab
+# (phòng khi tab bị sửa / xóa dòng trực tiếp trên Sheets).
+LOG_CACHE_TTL = 60  # giây
+LOG_FULL_REFRESH = 1800  # giây
+_log_cache = {}
+_log_writes = {}  # master_id -> số lần ghi log thành công (đổi -> cache cũ)
+
+def get_execution_logs(secrets_dict, refresh=False):
+    # Trả về (header, rows) của log_lan_thuc_thi theo thứ tự ghi; rows là list các dòng (chuỗi, có thể thiếu ô cuối)
+    master_id = secrets_dict["system"]["master_sheet_id"]
+    now = time.time()
+    with _log_lock:
+        c, writes = _log_cache.get(master_id), _log_writes.get(master_id, 0)
+        if c and not refresh and c["writes"] == writes and now - c["checked_at"] < LOG_CACHE_TTL: return c["header"], c["rows"]
+        full = c is None or refresh or not c["header"] or now - c["loaded_at"] >= LOG_FULL_REFRESH
+    if not full:
+        # Đọc từ dòng cuối đã biết (luôn nằm trong lưới tab); dòng đó khác bản trong RAM -> tab đã bị sửa, đọc lại cả tab
+        last = c["rows"][-1] if c["rows"] else c["header"]
+        with span("log_read", full=False):
+            res = get_gspread_client(secrets_dict).http_client.values_get(master_id, f"'log_lan_thuc_thi'!A{len(c['rows']) + 1}:G")
+        vals = res.get("values", [])
+        if vals and vals[0] == last: c = {"header": c["header"], "rows": c["rows"] + vals[1:], "loaded_at": c["loaded_at"]}
+        else: full = True
+    if full:
+        with span("log_read", full=True):
+            vals = get_gspread_client(secrets_dict).http_client.values_get(master_id, "'log_lan_thuc_thi'!A:G").get("values", [])
+        c = {"header": vals[0] if vals else [], "rows": vals[1:], "loaded_at": now}
+    c.update(checked_at=now, writes=writes)
+    with _log_lock: _log_cache[master_id] = c
+    return c["header"], c["rows"]
+
+def invalidate_execution_logs(secrets_dict=None):
+    with _log_lock:
+        if secrets_dict is None: _log_cache.clear()
+        else: _log_cache.pop(secrets_dict["system"]["master_sheet_id"], None)
+
+# --- ƯỚC TÍNH CHI PHÍ BLOCK (LỊCH SỬ log_lan_thuc_thi) ---
+# Message mỗi link kết thúc bằng "(12.3s)" = thời gian xử lý (thời gian tab chia đều cho các link trong tab),
+# Updated Range "a - b" -> số dòng. Chi phí 1 link = TB thời gian PLAN_HISTORY_RUNS lần Success gần nhất;
+# chưa có thời gian -> số dòng x (giây / dòng của cả lịch sử); chưa chạy bao giờ -> PLAN_DEFAULT_LINK_SECONDS.
+PLAN_HISTORY_RUNS = 3
+PLAN_HISTORY_TTL = 1800  # giây; log do chính lần chạy ghi thêm không cần đọc lại ngay
+PLAN_DEFAULT_LINK_SECONDS = 60
+_DURATION_RE = re.compile(r"\((\d+(?:\.\d+)?)s\)\s*$")
+_RANGE_RE = re.compile(r"^\s*(\d+)\s*-\s*(\d+)\s*$")
+_link_history = {}
+_history_lock = threading.Lock()
+
+def with_duration(message, dur):
+    return message if dur is None else f"{message} ({dur:.1f}s)"
+
+def load_link_history(secrets_dict, refresh=False):
+    # {"runs": {(Block Name, Sheet Name): [(giây | None, số dòng | None)] mới nhất trước}, "rate": giây / dòng | None}
+    master_id = secrets_dict["system"]["master_sheet_id"]
+    with _history_lock:
+        hist = _link_history.get(master_id)
+        if hist and not refresh and time.time() - hist["loaded_at"] < PLAN_HISTORY_TTL: return hist
+    with span("history_read"):
+        res = get_gspread_client(secrets_dict).http_client.values_get(master_id, "'log_lan_thuc_thi'!A:G")
+    runs, tot_s, tot_rows = {}, 0.0, 0
+    for row in reversed(res.get("values", [])[1:]):
+        row = list(row) + [""] * (7 - len(row))
+        if row[4] != "Success": continue
+        m, r = _DURATION_RE.search(row[6]), _RANGE_RE.match(row[5])
+        dur = float(m.group(1)) if m else None
+        n_rows = int(r.group(2)) - int(r.group(1)) + 1 if r else None
+        hist_runs = runs.setdefault((row[1], row[2]), [])
+        if len(hist_runs) < PLAN_HISTORY_RUNS: hist_runs.append((dur, n_rows))
+        if dur is not None and n_rows: tot_s, tot_rows = tot_s + dur, tot_rows + n_rows
+    hist = {"runs": runs, "rate": tot_s / tot_rows if tot_rows else None, "loaded_at": time.time()}
+    with _history_lock: _link_history[master_id] = hist
+    return hist
+
+def estimate_block_cost(secrets_dict, block, hist):
+    # Tổng giây ước tính của các link chưa chốt trong block
+    total = 0.0
+    for l in get_links_by_block(secrets_dict, block.get("Block ID")):
+        if l.get('Status') == "Đã chốt": continue
+        runs = hist["runs"].get((str(block.get("Block Name")), str(l.get('Sheet Name'))), [])
+        durs = [d for d, _ in runs if d is not None]
+        rows = [n for _, n in runs if n]
+        if durs: total += sum(durs) / len(durs)
+        elif rows and hist["rate"]: total += hist["rate"] * sum(rows) / len(rows)
+        else: total += PLAN_DEFAULT_LINK_SECONDS
+    return total
 
 # --- CORE FUNCTIONS ---
 def check_sheet_access(secrets_dict, sheet_url):
     try:
-        creds = Credentials.from_service_account_info(secrets_dict["gcp_service_account"], scopes=SCOPE)
-        gspread.authorize(creds).open_by_url(sheet_url)
+        open_spreadsheet(secrets_dict, url=sheet_url, refresh=True)
         # --- SỬA LỖI TẠI ĐÂY: Lấy email trực tiếp từ secrets_dict thay vì creds object ---
         bot_email = secrets_dict["gcp_service_account"]["client_email"]
         return True, "✅ OK", bot_email
@@ -77,52 +703,56 @@ def check_sheet_access(secrets_dict, sheet_url):
 def create_block(secrets_dict, block_name):
     sh, _ = get_connection(secrets_dict)
     if not sh: return False
-    sh.worksheet("manager_blocks").append_row([str(uuid.uuid4())[:8], block_name, "Thủ công", "{}", "Active", ""])
+    get_worksheet(sh, "manager_blocks").append_row([str(uuid.uuid4())[:8], block_name, "Thủ công", "{}", "Active", ""])
+    invalidate_master_snapshot(secrets_dict, tabs=("manager_blocks",))
     return True
 
 def delete_block(secrets_dict, block_id):
     sh, _ = get_connection(secrets_dict)
     if not sh: return False
-    wks = sh.worksheet("manager_blocks")
+    wks = get_worksheet(sh, "manager_blocks")
     cells = wks.findall(block_id)
     for r in sorted([c.row for c in cells], reverse=True): wks.delete_rows(r)
+    invalidate_master_snapshot(secrets_dict, tabs=("manager_blocks",))
     return True
 
 def get_all_blocks(secrets_dict):
-    sh, _ = get_connection(secrets_dict)
-    if not sh: return []
-    return safe_get_records(sh.worksheet("manager_blocks"))
+    try: return list(load_master_snapshot(secrets_dict)["blocks"])
+    except: return []
 
 def get_links_by_block(secrets_dict, block_id):
-    sh, _ = get_connection(secrets_dict)
-    if not sh: return []
-    try:
-        data = sh.worksheet("manager_links").get_all_records()
-        tid = clean_str(block_id)
-        return [l for l in data if clean_str(l.get("Block ID", "")) == tid]
+    try: return list(load_master_snapshot(secrets_dict)["links_by_block"].get(clean_str(block_id), []))
     except: return []
 
 def update_block_config_and_schedule(secrets_dict, block_id, block_name, schedule_type, schedule_config):
     sh, _ = get_connection(secrets_dict)
     if not sh: return False
     try:
-        wks = sh.worksheet("manager_blocks")
+        wks = get_worksheet(sh, "manager_blocks")
         cell = wks.find(block_id)
         if cell:
             wks.update_cell(cell.row, 3, schedule_type)
             wks.update_cell(cell.row, 4, json.dumps(schedule_config, ensure_ascii=False))
     except: pass
+    invalidate_master_snapshot(secrets_dict, tabs=("manager_blocks",))
     return True
 
 def update_link_last_range(secrets_dict, link_id, block_id, range_val):
     try:
         sh, _ = get_connection(secrets_dict)
-        wks = sh.worksheet("manager_links")
+        wks = get_worksheet(sh, "manager_links")
+        # Có sẵn số dòng trong snapshot -> ghi thẳng, không tải lại cả tab
+        snap = load_master_snapshot(secrets_dict)
+        tl, tb = clean_str(link_id), clean_str(block_id)
+        row_no = snap["link_row"].get((tb, tl))
+        if row_no and "Last Range" in snap["links_header"]:
+            wks.update_cell(row_no, snap["links_header"].index("Last Range") + 1, str(range_val))
+            snap["links"][row_no - 2]["Last Range"] = str(range_val)
+            return True
         all_rows = wks.get_all_values()
         if not all_rows: return False
         try: h = all_rows[0]; idx_r = h.index("Last Range") + 1; idx_l = h.index("Link ID"); idx_b = h.index("Block ID")
         except: idx_r=12; idx_l=0; idx_b=1
-        tl, tb = clean_str(link_id), clean_str(block_id)
         for i, row in enumerate(all_rows[1:], start=2):
             cl = clean_str(row[idx_l]) if len(row) > idx_l else ""
             cb = clean_str(row[idx_b]) if len(row) > idx_b else ""
@@ -130,11 +760,102 @@ def update_link_last_range(secrets_dict, link_id, block_id, range_val):
         return False
     except: return False
 
+# --- GOM CẬP NHẬT TRẠNG THÁI (Last Range / Last Run) ---
+# Trong 1 lần chạy chỉ ghi nhận vào RAM; commit_status_updates() ghi tất cả bằng 1 values_batch_update.
+# Số dòng lấy từ master đọc lại ngay trước khi ghi (1 values_batch_get): trong lúc chạy, lưu link trên app
+# (save_links_bulk) có thể dời dòng của block -> không dùng số dòng của snapshot đầu lần chạy.
+# Ghi lỗi -> trả các cập nhật lại hàng đợi, lần commit sau ghi tiếp.
+_status_updates = {}
+_status_lock = threading.Lock()
+# Cột trạng thái của link (sau Last Range): chỉ engine ghi, giữ lại khi lưu link nếu cấu hình lấy dữ liệu không đổi
+LINK_STATE_COLS = ["Watermark", "Content Hash"]
+LINK_STATE_KEEP_COLS = ["API URL", "Filter Key", "Date Start", "Date End", "Link Sheet", "Sheet Name", "Status"]
+LINK_DATE_COLS = ["Date Start", "Date End"]
+
+def link_date_key(v):
+    # Ngày cấu hình như lúc chạy đọc (parse_link_dates): Timestamp của app và chuỗi trên Sheet ("05/01/2026",
+    # "2026-01-05 00:00:00"...) cùng ra "2026-01-05"; ô trống / NaT -> ""; không đọc được -> giữ chuỗi
+    s = "" if v is None or (not isinstance(v, str) and pd.isna(v)) else str(v).strip()
+    if s.lower() in ("", "nan", "nat", "none"): return ""
+    d, _ = parse_link_dates({"Date Start": s})
+    return d.strftime("%Y-%m-%d") if d is not None and not pd.isna(d) else s
+
+def queue_link_last_range(secrets_dict, link_id, block_id, range_val):
+    with _status_lock:
+        _status_updates.setdefault(secrets_dict["system"]["master_sheet_id"], {})[("link", clean_str(block_id), clean_str(link_id))] = str(range_val)
+
+def queue_link_state(secrets_dict, link_id, block_id, column, value):
+    # Cột trạng thái của link (LINK_STATE_COLS: Watermark, Content Hash); ghi dạng text (') để Sheets không tự đổi định dạng
+    with _status_lock:
+        _status_updates.setdefault(secrets_dict["system"]["master_sheet_id"], {})[(column, clean_str(block_id), clean_str(link_id))] = "'" + str(value)
+
+def queue_block_last_run(secrets_dict, block_id, run_time_str):
+    with _status_lock:
+        _status_updates.setdefault(secrets_dict["system"]["master_sheet_id"], {})[("block", clean_str(block_id), "")] = str(run_time_str)
+
+def commit_status_updates(secrets_dict):
+    master_id = secrets_dict["system"]["master_sheet_id"]
+    with _status_lock: pending = _status_updates.pop(master_id, {})
+    if not pending: return 0
+    try:
+        with span("status_commit", updates=len(pending)):
+            return _commit_status_rows(secrets_dict, pending)
+    except Exception as e:
+        # Giá trị mới hơn được queue trong lúc ghi thì giữ giá trị mới
+        with _status_lock:
+            queue = _status_updates.setdefault(master_id, {})
+            for k, v in pending.items(): queue.setdefault(k, v)
+        print(f"⚠️ Không thể ghi Last Range / Last Run ({len(pending)} mục, giữ lại cho lần sau): {e}")
+        return 0
+
+def _commit_status_rows(secrets_dict, pending):
+    snap = load_master_snapshot(secrets_dict, refresh=True)
+    l_col = snap["links_header"].index("Last Range") + 1 if "Last Range" in snap["links_header"] else 12
+    b_col = snap["blocks_header"].index("Last Run") + 1 if "Last Run" in snap["blocks_header"] else 6
+    data, missing = [], []
+    for col in LINK_STATE_COLS:
+        if any(k[0] == col for k in pending) and col not in snap["links_header"]:
+            # DB cũ chưa có cột -> thêm header ở cột trống kế tiếp
+            snap["links_header"].append(col)
+            data.append({"range": f"'manager_links'!{rowcol_to_a1(1, len(snap['links_header']))}", "values": [[col]]})
+    for (kind, tb, tl), val in pending.items():
+        if kind in LINK_STATE_COLS:
+            # Dòng chưa có trong snapshot -> bỏ qua: lần sau chỉ là fetch/ghi đầy đủ như trước
+            row_no = snap["link_row"].get((tb, tl))
+            if row_no:
+                data.append({"range": f"'manager_links'!{rowcol_to_a1(row_no, snap['links_header'].index(kind) + 1)}", "values": [[val]]})
+                snap["links"][row_no - 2][kind] = val.lstrip("'")
+        elif kind == "link":
+            row_no = snap["link_row"].get((tb, tl))
+            if row_no:
+                data.append({"range": f"'manager_links'!{rowcol_to_a1(row_no, l_col)}", "values": [[val]]})
+                snap["links"][row_no - 2]["Last Range"] = val
+            else: missing.append((kind, tb, tl, val))
+        else:
+            row_no = snap["block_row"].get(tb)
+            if row_no:
+                data.append({"range": f"'manager_blocks'!{rowcol_to_a1(row_no, b_col)}", "values": [[val]]})
+                snap["blocks"][row_no - 2]["Last Run"] = val
+            else: missing.append((kind, tb, tl, val))
+    if data:
+        sh, _ = get_connection(secrets_dict)
+        sh.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})
+    # Dòng chưa có trong snapshot (VD: vừa thêm) -> ghi lẻ như cũ
+    for kind, tb, tl, val in missing:
+        if kind == "link": update_link_last_range(secrets_dict, tl, tb, val)
+        else:
+            try:
+                sh, _ = get_connection(secrets_dict)
+                cell = get_worksheet(sh, "manager_blocks").find(tb)
+                if cell: get_worksheet(sh, "manager_blocks").update_cell(cell.row, b_col, val)
+            except Exception as e: print(f"⚠️ Không thể update Last Run: {e}")
+    return len(data) + len(missing)
+
 def save_links_bulk(secrets_dict, block_id, df_links):
     # 1. Kết nối Google Sheet
     sh, _ = get_connection(secrets_dict)
     if not sh: return False
-    wks = sh.worksheet("manager_links")
+    wks = get_worksheet(sh, "manager_links")
     
     # 2. Lấy toàn bộ dữ liệu cũ đang có trên Sheet
     old_df = get_as_dataframe(wks, evaluate_formulas=True).dropna(how='all')
@@ -171,24 +892,54 @@ def save_links_bulk(secrets_dict, block_id, df_links):
         df_links['Access Token'] = df_links['Access Token'].apply(add_quote_token)
     # -----------------------------------------------
 
+    # Giữ Watermark / Content Hash của link khi cấu hình lấy dữ liệu không đổi
+    # (đổi URL/Filter/ngày/tab/trạng thái -> lần chạy sau fetch đủ cửa sổ và ghi lại đầy đủ)
+    state_cols = [c for c in LINK_STATE_COLS if c in old_df.columns]
+    kept = set()
+    if not old_df.empty and state_cols and 'Link ID' in old_df.columns and 'Link ID' in df_links.columns:
+        keys = [c for c in LINK_STATE_KEEP_COLS if c in df_links.columns and c in old_df.columns]
+        def norm(df):
+            out = df[keys].fillna("").astype(str).apply(lambda col: col.str.strip().str.replace(r"\.0$", "", regex=True))
+            for c in LINK_DATE_COLS:
+                if c in keys: out[c] = df[c].map(link_date_key)
+            return out
+        old_own = old_df[clean_str_series(old_df['Block ID']) == tb]
+        old_own = pd.concat([norm(old_own), old_own[state_cols]], axis=1).assign(_lid=clean_str_series(old_own['Link ID']))
+        prev = {r["_lid"]: r for _, r in old_own.drop_duplicates("_lid").iterrows()}
+        cur = norm(df_links).assign(**{'Link ID': df_links['Link ID']})
+        for c in state_cols:
+            def keep(row):
+                o = prev.get(clean_str(row['Link ID']))
+                if o is None or pd.isna(o[c]): return ""
+                return str(o[c]) if all(o[k] == row[k] for k in keys) else ""
+            df_links[c] = [keep(r) for _, r in cur.iterrows()]
+            kept.update(df_links[c])
+
     # 6. Gộp dữ liệu cũ và mới lại
     final_df = pd.concat([other_df, df_links], ignore_index=True)
     
-    # 7. Xóa sạch Sheet và Ghi lại từ đầu
-    wks.clear()
-    set_with_dataframe(wks, final_df)
+    # 7. Ghi lại từ đầu (ghi theo khối, xóa phần thừa cũ sau cùng)
+    # Watermark / Content Hash ghi dạng text (') để Sheets không đổi thành ngày/số
+    write_frame_chunked(wks, final_df, string_escaping=lambda v: v.startswith("'") or v in kept)
+    invalidate_master_snapshot(secrets_dict, tabs=("manager_links",))
     
     return True
 
-def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_start=None, date_end=None, status_callback=None):
-    all_data = []
+def open_1office_stream(url, token, method="GET", filter_key=None, date_start=None, date_end=None, status_callback=None, batch_rows=None, allow_empty=False, info=None):
+    # Chế độ stream: gọi trang 1 ngay, trả về (iterator, "Success") để duyệt các trang còn lại khi chúng về.
+    # batch_rows=None -> mỗi phần tử là 1 trang; batch_rows=N -> gom lại thành các lô N dòng.
+    # Lỗi ở trang 1 -> trả về (None, DEBUG LOG) giống fetch_1office_data_smart.
+    # allow_empty=True (fetch tăng dần theo watermark): API trả về rỗng (không lỗi) -> iterator rỗng, "Success".
+    # info (dict, tùy chọn): nhận info["total"] = total_item của trang 1.
     limit = 100
     filters = []
     
     # --- LOGGING SETUP ---
     logs = [f"🚀 BẮT ĐẦU GỌI API: {url}"]
+    out = _printer()
+    spans = current_spans()  # fetch() chạy ở luồng khác -> cộng request vào span của luồng gọi
     def log(msg):
-        print(msg)
+        out(msg)
         logs.append(msg)
 
     # 1. Xử lý Token (FIX QUAN TRỌNG: Cắt bỏ dấu ' ở đầu nếu có)
@@ -224,7 +975,12 @@ def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_sta
             filters.append(f)
             log(f"   🔹 Object Filter đã tạo: {f}")
 
-    # Hàm Fetch nội bộ
+    # Session keep-alive dùng chung theo host (giữa các trang và giữa các link)
+    sess = get_http_session(url)
+    host = _host_of(url)
+
+    # Hàm Fetch nội bộ: trả về (data, total, err, retry_after)
+    # err = None (OK) | "retry" (timeout, HTTP lỗi, 429 -> gọi lại được) | "fatal" (lỗi logic/token -> không gọi lại)
     def fetch(p):
         # SỬ DỤNG CLEAN TOKEN
         prms = {"access_token": clean_token, "limit": limit, "page": p}
@@ -241,10 +997,19 @@ def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_sta
             # (Tùy chọn) In URL ra console để debug, nhưng ẩn bớt token cho gọn
             # print(full_url) 
 
-            if method.upper() == "POST":
-                r = requests.post(full_url, json={}, timeout=60)
-            else:
-                r = requests.get(full_url, timeout=60)
+            t0 = time.monotonic()
+            _track_inflight(host, 1)
+            try:
+                if method.upper() == "POST":
+                    r = sess.post(full_url, json={}, timeout=60)
+                else:
+                    r = sess.get(full_url, timeout=60)
+            except Exception:
+                record_fetch_result(host, time.monotonic() - t0, False)
+                raise
+            finally: _track_inflight(host, -1)
+            record_fetch_result(host, time.monotonic() - t0, r.status_code == 200, r.status_code == 429)
+            count_call("1office" if r.status_code == 200 else f"1office_{r.status_code}", len(r.content), spans)
             
             log(f"   🔙 HTTP Status: {r.status_code}")
             
@@ -256,22 +1021,53 @@ def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_sta
                 # Check lỗi logic từ 1Office (dù HTTP 200)
                 if d.get("error") == True or d.get("code") == "token_not_valid":
                      log(f"   ⚠️ API TRẢ VỀ LỖI LOGIC: {d}")
-                     return [], 0
+                     return [], 0, "fatal", 0
 
                 if not data: log(f"   ℹ️ API trả về danh sách rỗng.")
                 else: log(f"   ✅ Đã lấy được {len(data)} dòng.")
-                return data, total
+                return data, total, None, 0
             else:
                 log(f"   ❌ HTTP Error: {r.text}")
-                return [], 0
+                try: retry_after = float(r.headers.get("Retry-After", 0) or 0)
+                except (TypeError, ValueError): retry_after = 0
+                return [], 0, "retry", retry_after
         except Exception as e:
             log(f"   ❌ Exception: {e}")
-            return [], 0
+            return [], 0, "retry", 0
+
+    # Ngân sách retry dùng chung cho cả link (tránh 1 endpoint hỏng kéo dài vô hạn)
+    budget = {"left": FETCH_RETRY_BUDGET_MIN}
+    budget_lock = threading.Lock()
+    def take_retry():
+        with budget_lock:
+            if budget["left"] <= 0: return False
+            budget["left"] -= 1
+            return True
+
+    def fetch_retry(p, expect_full=False):
+        # Gọi lại trang lỗi với backoff mũ + jitter; trang "thiếu" (ít hơn limit khi chưa phải trang cuối) cũng gọi lại.
+        # Trả về (data | None nếu vẫn lỗi, total, err)
+        attempt = 0
+        while True:
+            data, p_total, err, retry_after = fetch(p)
+            short = err is None and expect_full and len(data) < limit
+            if err is None and not short: return data, p_total, None
+            if err == "fatal" or attempt >= FETCH_PAGE_RETRIES or not take_retry():
+                if short: return data, p_total, None  # Giữ dữ liệu trang thiếu, kiểm tra tổng ở cuối
+                return None, 0, err
+            delay = max(retry_after, random.uniform(0, min(FETCH_BACKOFF_CAP, FETCH_BACKOFF_BASE * (2 ** attempt))))
+            log(f"   🔁 [Page {p}] Thử lại lần {attempt + 1} sau {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
 
     if status_callback: status_callback("📡 Đang gọi 1Office...")
     
     # 3. Thực thi
-    items, total = fetch(1)
+    items, total, err = fetch_retry(1)
+    if info is not None: info["total"] = total if err is None else 0
+    if allow_empty and err is None and not items:
+        log("   ℹ️ Không có dữ liệu mới kể từ watermark.")
+        return iter(()), "Success"
     
     # NẾU KHÔNG CÓ DATA HOẶC CÓ LỖI -> TRẢ VỀ LOG ĐỂ HIỆN MÀN HÌNH ĐỎ
     if not items:
@@ -279,84 +1075,1059 @@ def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_sta
         # Chỉ báo lỗi nếu thực sự là lỗi (HTTP != 200 hoặc token sai)
         # Nếu chỉ là không có dữ liệu (success nhưng rỗng) thì có thể coi là OK, 
         # nhưng hiện tại bạn đang cần debug nên cứ hiện ra hết.
-        return [], f"DEBUG LOG:\n{debug_log_str}"
-    
-    all_data.extend(items)
-    
-    if total > limit:
-        total_pages = math.ceil(total/limit)
-        with ThreadPoolExecutor(max_workers=5) as ex:
-            futures = {ex.submit(fetch, p): p for p in range(2, total_pages + 1)}
-            for f in as_completed(futures):
-                p_items, _ = f.result()
-                if p_items: all_data.extend(p_items)
-                    
+        return None, f"DEBUG LOG:\n{debug_log_str}"
+
+    total_pages = math.ceil(total/limit) if total > limit else 1
+    budget["left"] = max(FETCH_RETRY_BUDGET_MIN, int(total_pages * FETCH_RETRY_BUDGET_RATIO))
+
+    def pages(first):
+        got = len(first)
+        yield first
+        first = None
+        spans[:] = current_spans()  # Trang 2+ tính vào span của nơi đang đọc stream
+        failed = []
+        if total_pages > 1:
+            # Số trang đang chờ = giới hạn AIMD hiện tại của host (chia chung với các link chạy song song cùng host)
+            # -> bộ nhớ không phụ thuộc tổng số trang
+            todo = iter(range(2, total_pages + 1))
+            with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY_MAX) as ex:
+                submit = lambda p: ex.submit(fetch_retry, p, p < total_pages)
+                pending = {submit(p): p for p in islice(todo, fetch_room(host, 0))}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    done = [(f, pending.pop(f)) for f in done]
+                    for p in islice(todo, fetch_room(host, len(pending))): pending[submit(p)] = p
+                    for f, p in done:
+                        p_items, _, err = f.result()
+                        if p_items is None: failed.append(p); continue
+                        got += len(p_items)
+                        if p_items: yield p_items
+
+        # Lượt 2: chỉ gọi lại đúng các trang còn lỗi (không fetch lại cả link)
+        if failed:
+            log(f"   🔁 Gọi lại {len(failed)} trang lỗi: {sorted(failed)}")
+            still = []
+            for p in sorted(failed):
+                budget["left"] += 1  # Mỗi trang lỗi được thêm ít nhất 1 lượt ở vòng này
+                p_items, _, err = fetch_retry(p, p < total_pages)
+                if p_items is None: still.append(p); continue
+                got += len(p_items)
+                if p_items: yield p_items
+            if still: raise FetchIncompleteError(f"Thiếu {len(still)}/{total_pages} trang sau khi thử lại: {still}")
+
+        # Đối chiếu số dòng với total_item (total có thể đổi trong lúc phân trang -> hỏi lại trang 1)
+        if got < total:
+            _, new_total, err = fetch_retry(1)
+            if err is not None or got < min(total, new_total):
+                raise FetchIncompleteError(f"Chỉ lấy được {got}/{total} dòng (total hiện tại: {new_total if err is None else '?'})")
+            log(f"   ℹ️ total_item thay đổi khi đang lấy: {total} -> {new_total}, đã lấy {got} dòng.")
+
+        st_host = get_http_pool_stats().get(host, {})
+        if st_host: log(f"   🔌 HTTP pool: {st_host['requests']} request / {st_host['connections']} kết nối (tái sử dụng {st_host['reused']})")
+        st_cc = get_concurrency_stats().get(host, {})
+        if st_cc: log(f"   🎚️ Song song: {st_cc['limit']} (ok={st_cc['ok']}, lỗi={st_cc['errors']}, 429={st_cc['throttled']}, ~{st_cc['latency']}s/trang)")
+
+    stream = pages(items)
+    if batch_rows: stream = iter_row_batches(stream, batch_rows)
+    return stream, "Success"
+
+def iter_row_batches(pages, batch_rows):
+    # Gom các trang (độ dài bất kỳ) thành các lô đúng batch_rows dòng (lô cuối có thể ít hơn)
+    buf = []
+    for page in pages:
+        buf.extend(page)
+        while len(buf) >= batch_rows:
+            yield buf[:batch_rows]
+            buf = buf[batch_rows:]
+    if buf: yield buf
+
+# --- CHIA CỬA SỔ NGÀY (SHARD) CHO KẾT QUẢ LỚN ---
+# Thay vì phân trang sâu trên 1 filter, chia [Date Start, Date End] thành các cửa sổ con, mỗi cửa sổ phân trang nông
+# và chạy song song; dòng trùng khóa chính (cột đầu của dữ liệu API) giữa các cửa sổ chỉ giữ 1 lần.
+# "day" | "week" | "month": cửa sổ cố định; "auto": chia đôi cửa sổ tới khi total_item <= SHARD_MAX_ROWS.
+FETCH_SHARD = None  # secrets["system"]["fetch_shard"] ghi đè
+SHARD_WORKERS = 4
+SHARD_MAX_ROWS = 2000
+
+def split_date_windows(ds, de, unit):
+    # [ds, de] (date, tính cả 2 đầu) -> [(from, to)] liên tiếp, không chồng nhau, cắt theo ngày/tuần/tháng lịch
+    out, cur = [], ds
+    while cur <= de:
+        if unit == "day": end = cur
+        elif unit == "week": end = cur + timedelta(days=6 - cur.weekday())
+        else:
+            end = cur.replace(day=28) + timedelta(days=4)
+            end -= timedelta(days=end.day)
+        end = min(end, de)
+        out.append((cur, end))
+        cur = end + timedelta(days=1)
+    return out
+
+def open_1office_sharded(url, token, method="GET", filter_key=None, date_start=None, date_end=None, status_callback=None, batch_rows=None, allow_empty=False, shard="auto"):
+    # Cùng giao diện/kết quả với open_1office_stream. Không có Filter Key / Date Start -> không chia, gọi thẳng.
+    fk = str(filter_key).strip() if filter_key else ""
+    if not shard or not fk or not date_start:
+        return open_1office_stream(url, token, method, filter_key, date_start, date_end, status_callback, batch_rows, allow_empty)
+    out = _printer()
+    ds = pd.to_datetime(date_start, dayfirst=True).date()
+    de = pd.to_datetime(date_end, dayfirst=True).date() if date_end else (datetime.utcnow() + timedelta(hours=7)).date()
+    if status_callback: status_callback("📡 Đang gọi 1Office (chia cửa sổ ngày)...")
+    # Không có Date End: chia tới hôm nay nhưng cửa sổ cuối để mở (không gửi {fk}_to) như khi không chia
+    # -> vẫn lấy dòng có ngày trong tương lai (kế hoạch, lịch hẹn...)
+    windows = [(ds, de)] if shard == "auto" else split_date_windows(ds, de, shard)
+    if not date_end: windows = windows[:-1] + [(windows[-1][0] if windows else ds, None)]
+
+    parents = current_spans()
+    def open_win(w):
+        info = {}
+        with span_parent(parents): st, msg = open_1office_stream(url, token, method, fk, w[0], w[1], None, None, True, info)
+        return w, st, msg, info.get("total", 0)
+
+    # Mở trang 1 của mọi cửa sổ trước (song song): biết tổng số dòng, lỗi ở đâu thì dừng cả link như chế độ thường
+    streams, total, todo = [], 0, windows
+    with ThreadPoolExecutor(max_workers=SHARD_WORKERS) as ex:
+        while todo:
+            opened, todo = list(ex.map(open_win, todo)), []
+            for w, st, msg, n in opened:
+                if st is None: return None, msg
+                if shard == "auto" and n > SHARD_MAX_ROWS and w[0] < (w[1] or de):
+                    mid = w[0] + ((w[1] or de) - w[0]) // 2
+                    todo += [(w[0], mid), (mid + timedelta(days=1), w[1])]
+                else:
+                    streams.append((w, st))
+                    total += n
+    streams.sort(key=lambda x: x[0][0])
+    out(f"   🧩 Shard ({shard}): {len(streams)} cửa sổ {ds:%d/%m/%Y} - {de:%d/%m/%Y}{'' if date_end else '+'}, total_item ~{total}")
+    if not total and not allow_empty:
+        return None, f"DEBUG LOG:\n🚀 BẮT ĐẦU GỌI API: {url}\n   ℹ️ API trả về danh sách rỗng ở cả {len(streams)} cửa sổ."
+
+    def pages():
+        # Mỗi cửa sổ 1 luồng bơm trang vào hàng đợi có giới hạn (bộ nhớ không phụ thuộc tổng số dòng)
+        q, stop = queue.Queue(maxsize=SHARD_WORKERS * 2), threading.Event()
+        parents = current_spans()
+        def put(item):
+            while not stop.is_set():
+                try: q.put(item, timeout=0.5); return True
+                except queue.Full: pass
+            return False
+        def pump(st):
+            try:
+                with span_parent(parents):
+                    for page in st:
+                        if not put(("page", page)): return
+                    put(("done", None))
+            except Exception as e: put(("error", e))
+
+        seen, pk, dup, left = set(), None, 0, len(streams)
+        ex = ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+        try:
+            for _, st in streams: ex.submit(pump, st)
+            while left:
+                kind, val = q.get()
+                if kind == "done": left -= 1; continue
+                if kind == "error": raise val
+                rows = []
+                for r in val:
+                    if pk is None and r: pk = next(iter(r))
+                    key = r.get(pk) if pk is not None else None
+                    if key is not None and key != "":
+                        key = str(key)
+                        if key in seen: dup += 1; continue
+                        seen.add(key)
+                    rows.append(r)
+                if rows: yield rows
+            if dup: out(f"   🧩 Bỏ {dup} dòng trùng khóa giữa các cửa sổ")
+        finally:
+            stop.set()
+            ex.shutdown(wait=True)
+
+    stream = pages()
+    if batch_rows: stream = iter_row_batches(stream, batch_rows)
+    return stream, "Success"
+
+def fetch_1office_data_smart(url, token, method="GET", filter_key=None, date_start=None, date_end=None, status_callback=None, shard=None):
+    # shard: None (phân trang thường) | "day" | "week" | "month" | "auto" (xem open_1office_sharded)
+    if shard: stream, msg = open_1office_sharded(url, token, method, filter_key, date_start, date_end, status_callback, shard=shard)
+    else: stream, msg = open_1office_stream(url, token, method, filter_key, date_start, date_end, status_callback)
+    if stream is None: return [], msg
+    all_data = []
+    try:
+        for page in stream: all_data.extend(page)
+    except FetchIncompleteError as e: return [], f"Fetch Error: {e}"
     return all_data, "Success"
-def process_data_final_v11(secrets_dict, link_sheet_url, sheet_name, block_id, link_id_config, new_data, status_mode):
-    if not new_data and status_mode != "Chưa chốt & đang cập nhật": return "0", "No Data"
+
+def frame_from_batches(batches):
+    # Gom các lô rồi dựng 1 DataFrame (dạng str): kiểu mỗi cột suy ra trên toàn bộ dòng, đúng như
+    # pd.DataFrame(list).astype(str) của đường không stream. astype(str) từng lô thì cột int có None ở 1 lô
+    # thành "12.0" cạnh "12" của lô khác -> khóa so khớp khi gộp phụ thuộc chỗ cắt lô.
+    rows = []
+    for b in batches: rows.extend(b)
+    return pd.DataFrame(rows).astype(str) if rows else pd.DataFrame()
+
+# --- MERGE ENGINE (3 CHẾ ĐỘ CẬP NHẬT) ---
+# "pandas": logic gốc. "polars": cùng ngữ nghĩa, làm sạch chuỗi vector hóa + lọc theo hash set (is_in).
+# "sqlite": cùng ngữ nghĩa nhưng tab đích nằm trong SQLite trên đĩa (StagingTab), không dùng merge_link_frames.
+# Cả hai nhận/trả pandas DataFrame (đầu vào là chuỗi/NaN) để phần ghi Sheet dùng chung.
+MERGE_ENGINE = "pandas"
+META_COLS = ["Link Nguồn", "Sheet Nguồn", "Block ID", "Link ID Config", "Thời gian điền"]
+
+def merge_link_frames(old_df, new_df, tb, tl, pk, status_mode, engine=None):
+    # old_df: toàn bộ tab (đã có đủ META_COLS); new_df: dữ liệu API của link (tb, tl) đã gắn meta
+    if (engine or MERGE_ENGINE) == "polars": return _merge_frames_polars(old_df, new_df, tb, tl, pk, status_mode)
+    return _merge_frames_pandas(old_df, new_df, tb, tl, pk, status_mode)
+
+def _merge_frames_pandas(old_df, new_df, tb, tl, pk, status_mode):
+    mask = (clean_str_series(old_df["Block ID"]) == tb) & (clean_str_series(old_df["Link ID Config"]) == tl)
+    safe_df = old_df[~mask]
+    target_df = old_df[mask]
+
+    res_df = pd.DataFrame()
+    if status_mode == "Chưa chốt & đang cập nhật": res_df = new_df
+    elif status_mode == "Cập nhật dữ liệu cũ":
+        if target_df.empty or new_df.empty: res_df = target_df
+        else:
+            common = set(target_df[pk]).intersection(set(new_df[pk]))
+            res_df = pd.concat([target_df[~target_df[pk].isin(common)], new_df[new_df[pk].isin(common)]], ignore_index=True)
+    elif status_mode == "Cập nhật dữ liệu mới":
+        if target_df.empty: res_df = new_df
+        elif new_df.empty: res_df = target_df
+        else: res_df = pd.concat([target_df, new_df[~new_df[pk].isin(set(target_df[pk]))]], ignore_index=True)
+    else: res_df = target_df
+
+    final_df = pd.concat([safe_df, res_df], ignore_index=True)
+    final_df["_sort_id"] = pd.to_numeric(final_df["Link ID Config"], errors='coerce').fillna(999999)
+    # Sort ổn định: thứ tự dòng giữ nguyên giữa các lần chạy -> delta chỉ thấy dòng thật sự đổi
+    final_df = final_df.sort_values(by=["Block ID", "_sort_id"], kind="stable").drop(columns=["_sort_id"])
+
+    cols = list(final_df.columns)
+    f_cols = [c for c in cols if c not in META_COLS] + META_COLS
+    return final_df[[c for c in f_cols if c in final_df.columns]]
+
+def _merge_frames_polars(old_df, new_df, tb, tl, pk, status_mode):
+    import polars as pl
+
+    def to_pl(df):
+        if len(df.columns) == 0: return None
+        return pl.from_pandas(df, schema_overrides={c: pl.Utf8 for c in df.columns})
+
+    def clean(c):
+        # = clean_str_series: astype(str) (NaN -> "nan"), strip, bỏ ".0" cuối, bỏ ' đầu
+        return pl.col(c).fill_null("nan").str.strip_chars().str.replace(r"\.0$", "").str.strip_chars_start("'")
+
+    def in_keys(other):
+        # Dòng có key nằm trong key của `other` (key null không khớp gì; dữ liệu API luôn là chuỗi nên không có null)
+        return pl.col(pk).is_in(other.get_column(pk).drop_nulls().unique().to_list()).fill_null(False)
+
+    old = to_pl(old_df).with_columns(((clean("Block ID") == tb) & (clean("Link ID Config") == tl)).alias("_m"))
+    safe = old.filter(~pl.col("_m")).drop("_m")
+    target = old.filter(pl.col("_m")).drop("_m")
+    new = to_pl(new_df)
+    new_empty = new is None or new.height == 0
+
+    parts = [safe]
+    if status_mode == "Chưa chốt & đang cập nhật": parts.append(new)
+    elif status_mode == "Cập nhật dữ liệu cũ":
+        if target.height == 0 or new_empty: parts.append(target)
+        else:
+            # Chỉ giữ key có ở cả 2 bên: dòng cũ có key mới -> thay bằng dòng mới
+            parts += [target.filter(~in_keys(new)), new.filter(in_keys(target))]
+    elif status_mode == "Cập nhật dữ liệu mới":
+        if target.height == 0: parts.append(new)
+        elif new_empty: parts.append(target)
+        else: parts += [target, new.filter(~in_keys(target))]
+    else: parts.append(target)
+
+    final = pl.concat([p for p in parts if p is not None], how="diagonal_relaxed")
+    sort_id = pl.col("Link ID Config").str.strip_chars().cast(pl.Float64, strict=False).fill_nan(999999).fill_null(999999)
+    final = final.with_columns(sort_id.alias("_sort_id")).sort(["Block ID", "_sort_id"], nulls_last=True, maintain_order=True).drop("_sort_id")
+
+    f_cols = [c for c in final.columns if c not in META_COLS] + META_COLS
+    out = final.select([c for c in f_cols if c in final.columns]).to_pandas()
+    return out.mask(out.isna())
+
+# --- CACHE TAB ĐÍCH TRÊN ĐĨA (PARQUET) ---
+# Bản sao tab đích đúng như lần ghi gần nhất của engine: <TAB_CACHE_DIR>/<spreadsheet id>/<hash tên tab>.parquet
+# Lưu đúng frame get_as_dataframe sẽ đọc lại từ các ô vừa ghi (đủ cột, ô trống -> null); _read_dest_tab xử lý tiếp
+# (bỏ dòng/cột trống...) giống hệt lúc tải từ Sheet.
+# manifest.json giữ modifiedTime (Drive) của file ngay sau lần ghi đó. Lần chạy sau modifiedTime vẫn khớp
+# -> không ai sửa file ngoài engine -> dùng cache, bỏ qua lượt tải cả tab. Không khớp -> bỏ cache cả file, tải lại.
+# Cần polars (đọc/ghi parquet); thiếu polars thì tự tắt.
+# Chỉ nằm trên đĩa máy đang chạy (daemon dùng lại giữa các lần chạy): là bản sao dữ liệu khách hàng
+# -> không đưa lên kho cache / artifact của CI.
+TAB_CACHE = True
+TAB_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "tabs")
+
+def _tab_cache_manifest(sid):
     try:
-        creds = Credentials.from_service_account_info(secrets_dict["gcp_service_account"], scopes=SCOPE)
-        gc = gspread.authorize(creds)
-        dest_ss = gc.open_by_url(link_sheet_url)
-        try: wks = dest_ss.worksheet(sheet_name)
-        except: wks = dest_ss.add_worksheet(sheet_name, 1000, 20)
-        
-        old_df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str)
-        old_df = old_df.dropna(how='all').dropna(axis=1, how='all')
-        meta_cols = ["Link Nguồn", "Sheet Nguồn", "Block ID", "Link ID Config", "Thời gian điền"]
-        for c in meta_cols: 
-            if c not in old_df.columns: old_df[c] = ""
-
-        if "Block ID" in old_df.columns: old_df["_cb"] = clean_str_series(old_df["Block ID"])
-        else: old_df["_cb"] = ""
-        if "Link ID Config" in old_df.columns: old_df["_cl"] = clean_str_series(old_df["Link ID Config"])
-        else: old_df["_cl"] = ""
-
-        tb, tl = clean_str(block_id), clean_str(link_id_config)
-        mask = (old_df["_cb"] == tb) & (old_df["_cl"] == tl)
-        safe_df = old_df[~mask].copy()
-        target_df = old_df[mask].copy()
-        safe_df = safe_df.drop(columns=["_cb", "_cl"])
-        target_df = target_df.drop(columns=["_cb", "_cl"])
-
-        if new_data:
-            new_df = pd.DataFrame(new_data).astype(str)
-            api_cols = [c for c in new_df.columns if c not in meta_cols]
-            new_df["Link Nguồn"] = link_sheet_url
-            new_df["Sheet Nguồn"] = sheet_name
-            new_df["Block ID"] = tb
-            new_df["Link ID Config"] = tl
-            new_df["Thời gian điền"] = (datetime.utcnow() + timedelta(hours=7)).strftime("%H:%M:%S %d/%m/%Y")
-            pk = api_cols[0] if api_cols else new_df.columns[0]
-        else: new_df = pd.DataFrame(); pk = None
-
-        res_df = pd.DataFrame()
-        if status_mode == "Chưa chốt & đang cập nhật": res_df = new_df
+        with open(os.path.join(TAB_CACHE_DIR, sid, "manifest.json"), encoding="utf-8") as f: return json.load(f)
+    except Exception: return {}
+
+def _tab_cache_file(sid, title):
+    return os.path.join(TAB_CACHE_DIR, sid, hashlib.sha1(str(title).encode("utf-8")).hexdigest()[:16] + ".parquet")
+
+def _sheet_na_values():
+    # Chuỗi get_as_dataframe (TextParser, na_values mặc định) đọc thành NaN: "", "nan", "NA", "null"...
+    from pandas._libs.parsers import STR_NA_VALUES
+    return STR_NA_VALUES
+
+def load_cached_tab(sh, title):
+    # Trả về (df | None, modifiedTime hiện tại | None). df có cùng dạng get_as_dataframe(dtype=str, không bỏ
+    # dòng/cột trống): đủ cột đã ghi, chuỗi + NaN
+    if not TAB_CACHE: return None, None
+    try: modified = sh.get_lastUpdateTime()
+    except Exception: return None, None
+    man = _tab_cache_manifest(sh.id)
+    cols = man.get("tabs", {}).get(str(title)) if man.get("modified") == modified else None
+    if cols is None: return None, modified
+    try:
+        import polars as pl
+        df = pd.DataFrame(pl.read_parquet(_tab_cache_file(sh.id, title)).to_dict(as_series=False), columns=cols)
+    except Exception: return None, modified
+    return df.where(df.notna(), float("nan")), modified
+
+def store_cached_tab(sh, title, df, modified_before):
+    # Gọi sau khi ghi tab xong. modified_before = modifiedTime lúc đọc tab (load_cached_tab).
+    # Các tab khác của file chỉ còn hợp lệ nếu từ lần ghi trước tới giờ không ai sửa file (modified_before khớp manifest).
+    if not TAB_CACHE or modified_before is None: return
+    try:
+        import polars as pl
+        man = _tab_cache_manifest(sh.id)
+        if man.get("modified") != modified_before: man = {"tabs": {}}
+        from pandas.io.parsers import TextParser
+        cols = [str(c) for c in df.columns]
+        if not cols or len(set(cols)) != len(cols): man["tabs"].pop(str(title), None); return
+        # Chuỗi Sheets trả về cho các ô vừa ghi, qua đúng bộ đọc của get_as_dataframe(dtype=str):
+        # ô trống / "nan" / "NA"... -> NaN, header trống -> "Unnamed: n"
+        cell = lambda v: v if isinstance(v, str) else ("" if v is None or pd.isna(v) else str(v))
+        df = TextParser([cols] + [[cell(v) for v in r] for r in df.itertuples(index=False, name=None)], header=0, dtype=str).read()
+        cols = [str(c) for c in df.columns]
+        path = _tab_cache_file(sh.id, title)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pl.DataFrame({c: df[col].where(df[col].notna(), None).tolist() for c, col in zip(cols, df.columns)},
+                     schema={c: pl.Utf8 for c in cols}).write_parquet(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        _save_tab_manifest(sh, man, title, cols)
+    except Exception as e: _printer()(f"   ⚠️ Không lưu được cache tab {title}: {e}")
+
+def tab_unchanged_since(sh, modified_before):
+    # Gọi ngay trước khi ghi tab: file bị sửa ngoài engine từ lúc đọc tab (modifiedTime đã đổi) -> bỏ manifest
+    # của cả file (mọi tab) và trả False: không được đóng dấu lần ghi này là "bản của engine"
+    if not TAB_CACHE or modified_before is None: return False
+    try:
+        if sh.get_lastUpdateTime() == modified_before: return True
+    except Exception: pass
+    try: os.remove(os.path.join(TAB_CACHE_DIR, sh.id, "manifest.json"))
+    except OSError: pass
+    _printer()("   🔄 File đích đã đổi trong lúc xử lý -> bỏ cache tab của file")
+    return False
+
+def _save_tab_manifest(sh, man, title, cols=None):
+    # cols: cột của file parquet vừa lưu; None -> tab vừa ghi bằng staging SQLite (parquet của tab đó đã cũ, và ngược lại)
+    tabs, staged = man.setdefault("tabs", {}), set(man.get("staged", []))
+    if cols is None: tabs.pop(str(title), None); staged.add(str(title))
+    else: tabs[str(title)] = cols; staged.discard(str(title))
+    man["staged"] = sorted(staged)
+    man["modified"] = sh.get_lastUpdateTime()
+    path = os.path.join(TAB_CACHE_DIR, sh.id, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f: json.dump(man, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+# --- GHI TAB LỚN THEO KHỐI (CHUNKED WRITE) ---
+# Thay set_with_dataframe (1 request cho cả tab -> tab vài chục nghìn dòng x 30+ cột dễ vượt giới hạn payload/timeout):
+# nới lưới 1 lần, chia dữ liệu thành các khối theo số ô, ghi song song (vẫn qua token bucket ghi của tài khoản),
+# khối lỗi chỉ ghi lại đúng khối đó. Ô thừa của dữ liệu cũ chỉ bị xóa SAU khi mọi khối đã ghi xong.
+# Trước mỗi khối chụp lại các ô sắp bị ghi đè (1 request đọc, FORMULA); còn khối lỗi sau khi ghi lại -> ghi trả
+# mọi ô đã chụp rồi mới báo lỗi -> tab quay về đúng dữ liệu cũ, không còn nửa mới nửa cũ (dòng cũ bị dịch chỗ).
+WRITE_CHUNK_CELLS = 50000  # Số ô tối đa / request
+WRITE_WORKERS = 2  # Số khối ghi song song (quota ghi chung cho cả tài khoản nên để thấp)
+WRITE_CHUNK_RETRIES = 3
+WRITE_BACKOFF_BASE = 2.0
+WRITE_UNDO = True  # False -> không chụp ô cũ (đỡ 1 request đọc / khối), ghi hỏng giữa chừng để nguyên tab
+
+def _cell_value(v, esc):
+    # Giống _cellrepr của gspread_dataframe (allow_formulas=True): NaN -> "", số giữ nguyên, esc(v) -> thêm '
+    if not isinstance(v, str):
+        if v is None or pd.isna(v) is True: return ""
+        if isinstance(v, Real): return v
+        v = str(v)
+    return "'" + v if v and esc(v) else v
+
+def frame_values(df, string_escaping=None):
+    # DataFrame -> [header] + các dòng; string_escaping(v) -> True thì ghi dạng text (mặc định: chuỗi bắt đầu bằng ')
+    esc = string_escaping or (lambda v: v.startswith("'"))
+    cols = [[_cell_value(v, esc) for v in df[c].tolist()] for c in df.columns]
+    return [[_cell_value(c, esc) for c in df.columns]] + [list(r) for r in zip(*cols)]
+
+def pack_chunks(rows, n_cols):
+    # rows: iterable (số dòng trên Sheet, [giá trị]) theo thứ tự tăng -> sinh từng lô [{"range", "values"}] <= WRITE_CHUNK_CELLS ô;
+    # dòng liền nhau chung 1 range. Là generator: không cần giữ cả tab trong RAM.
+    per = max(1, WRITE_CHUNK_CELLS // max(n_cols, 1))
+    last_col = rowcol_to_a1(1, max(n_cols, 1))[:-1]
+    close = lambda runs: [{"range": f"A{a}:{last_col}{a + len(v) - 1}", "values": v} for a, v in runs]
+    runs, size = [], 0
+    for r, vals in rows:
+        if runs and r == runs[-1][0] + len(runs[-1][1]): runs[-1][1].append(vals)
+        else: runs.append((r, [vals]))
+        size += 1
+        if size >= per: yield close(runs); runs, size = [], 0
+    if runs: yield close(runs)
+
+def write_batches(wks, batches):
+    # Mỗi lô 1 request batch_update; lỗi -> backoff + ghi lại lô đó; còn lỗi -> lượt 2 tuần tự; vẫn lỗi -> RuntimeError.
+    # batches có thể là generator: chỉ giữ tối đa 2 x WRITE_WORKERS lô đang chờ. Trả về số lô đã ghi.
+    parents = current_spans()
+    undo, undo_lock = [], threading.Lock()
+    def retry(fn):
+        err = None
+        with span_parent(parents):
+            for attempt in range(WRITE_CHUNK_RETRIES + 1):
+                try:
+                    fn()
+                    return None
+                except Exception as e:
+                    # 4xx (range sai, vượt giới hạn ô...) ghi lại cũng vô ích
+                    if isinstance(e, gspread.exceptions.APIError) and 400 <= e.code < 500 and e.code not in (408, 429): return e
+                    err = e
+                if attempt < WRITE_CHUNK_RETRIES:
+                    time.sleep(random.uniform(0, min(FETCH_BACKOFF_CAP, WRITE_BACKOFF_BASE * (2 ** attempt))))
+        return err
+
+    def snapshot(batch):
+        # Ô cũ đúng kích thước từng range (Sheets bỏ ô trống ở cuối -> bù ""), ghi lại được bằng USER_ENTERED
+        old = wks.batch_get([d["range"] for d in batch], value_render_option="FORMULA")
+        esc = lambda v: "'" + v if isinstance(v, str) and v.startswith("'") else v
+        out = []
+        for d, vals in zip(batch, old):
+            vals, w = list(vals), len(d["values"][0])
+            rows = [[esc(v) for v in r] + [""] * (w - len(r)) for r in vals[:len(d["values"])]]
+            out.append({"range": d["range"], "values": rows + [[""] * w for _ in range(len(d["values"]) - len(rows))]})
+        with undo_lock: undo.append(out)
+
+    def put(batch):
+        if WRITE_UNDO:
+            # Không chụp được ô cũ -> không ghi khối này (ghi rồi sẽ không hoàn tác được)
+            err = retry(lambda: snapshot(batch))
+            if err is not None: return err
+        return retry(lambda: wks.batch_update(batch, value_input_option="USER_ENTERED"))
+
+    def restore():
+        # Ghi trả mọi khối đã chụp (kể cả khối báo lỗi: request có thể đã tới Sheets) -> trả về số khối không trả được.
+        # Ngược thứ tự chụp: khối chụp 2 lần (lượt ghi lại) thì bản chụp đầu tiên = dữ liệu cũ thật được ghi sau cùng
+        with undo_lock: olds = undo[::-1]
+        return sum(retry(lambda b=b: wks.batch_update(b, value_input_option="USER_ENTERED")) is not None for b in olds)
+
+    failed, total = [], 0
+    if WRITE_WORKERS <= 1:
+        for b in batches:
+            total += 1
+            e = put(b)
+            if e is not None: failed.append((b, e))
+    else:
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as ex:
+            pending = {}
+            def collect(done):
+                for f in done:
+                    b = pending.pop(f)
+                    if f.result() is not None: failed.append((b, f.result()))
+            for b in batches:
+                total += 1
+                pending[ex.submit(put, b)] = b
+                if len(pending) >= WRITE_WORKERS * 2: collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+            collect(list(pending))
+    if failed:
+        _printer()(f"   🔁 Ghi lại {len(failed)}/{total} khối lỗi")
+        failed = [(b, e) for b, e in failed if put(b) is not None]
+    if failed:
+        msg = f"Ghi thiếu {len(failed)}/{total} khối ({failed[0][0][0]['range']}...): {failed[0][1]}"
+        if WRITE_UNDO:
+            bad = restore()
+            _printer()(f"   ↩️ Khôi phục dữ liệu cũ: {len(undo) - bad}/{len(undo)} khối")
+            msg += " -> đã khôi phục dữ liệu cũ" if not bad else f" -> KHÔNG khôi phục được {bad} khối, tab đang dở dang"
+        raise RuntimeError(msg)
+    return total
+
+def write_rows_chunked(wks, rows, n_rows, n_cols):
+    # Ghi đè cả tab: rows = iterable đúng n_rows dòng giá trị (dòng đầu là header), n_cols cột. Trả về số lô.
+    # Nới lưới 1 lần (chỉ tăng, như set_with_dataframe)
+    if n_rows > wks.row_count or n_cols > wks.col_count:
+        wks.resize(max(n_rows, wks.row_count), max(n_cols, wks.col_count))
+    n = write_batches(wks, pack_chunks(enumerate(rows, start=1), n_cols))
+    extra = []
+    if wks.row_count > n_rows: extra.append(f"A{n_rows + 1}:{rowcol_to_a1(1, max(n_cols, wks.col_count))[:-1]}")
+    if wks.col_count > n_cols: extra.append(f"{rowcol_to_a1(1, n_cols + 1)[:-1]}1:{rowcol_to_a1(1, wks.col_count)[:-1]}{n_rows}")
+    if extra: wks.batch_clear(extra)
+    if n > 1: _printer()(f"   ✏️ Ghi {n_rows - 1} dòng / {n} khối")
+    return n
+
+def write_frame_chunked(wks, df, string_escaping=None):
+    # Ghi đè cả tab bằng df (header ở dòng 1), thay cho wks.clear() + set_with_dataframe
+    if not len(df.columns): wks.clear(); return
+    values = frame_values(df, string_escaping)
+    write_rows_chunked(wks, values, len(values), len(df.columns))
+
+# --- DELTA WRITE (CHỈ GHI PHẦN THAY ĐỔI) ---
+# So final_df với dữ liệu vừa đọc từ Sheet: chỉ ghi các dải dòng khác, dòng thêm mới và xóa phần đuôi thừa.
+# Header (tập cột / thứ tự cột) khác -> trả None để ghi đè toàn bộ như cũ.
+DELTA_WRITE = True
+DELTA_ROW_GAP = 3  # Các dải dòng đổi cách nhau <= GAP dòng thì gộp thành 1 range
+
+def plan_delta_writes(sheet_df, final_df):
+    if list(sheet_df.columns) != list(final_df.columns) or sheet_df.empty: return None
+    n_old, n_new = len(sheet_df), len(final_df)
+    last_col = rowcol_to_a1(1, len(final_df.columns))[:-1]
+    old_v = sheet_df.fillna("").astype(str).to_numpy()
+    new_v = final_df.fillna("").astype(str).to_numpy()
+    n = min(n_old, n_new)
+    changed = (old_v[:n] != new_v[:n]).any(axis=1).nonzero()[0].tolist() + list(range(n, n_new))
+
+    runs = []
+    for i in changed:
+        if runs and i - runs[-1][1] <= DELTA_ROW_GAP + 1: runs[-1][1] = i
+        else: runs.append([i, i])
+    # Escape giống set_with_dataframe: chuỗi bắt đầu bằng ' được thêm 1 dấu ' (USER_ENTERED)
+    esc = lambda v: "'" + v if v.startswith("'") else v
+    data = [(a + 2, [[esc(v) for v in row] for row in new_v[a:b + 1].tolist()]) for a, b in runs]
+    clear = [f"A{n_new + 2}:{last_col}{n_old + 1}"] if n_old > n_new else []
+    return {"data": data, "clear": clear, "rows": n_new + 1, "cols": len(final_df.columns), "changed": len(changed)}
+
+def apply_delta_writes(wks, plan):
+    # Dải dòng lớn (VD: cả tab đổi "Thời gian điền") cũng chia khối như write_frame_chunked; xóa đuôi sau khi ghi xong
+    if plan["rows"] > wks.row_count: wks.add_rows(plan["rows"] - wks.row_count)
+    n = write_batches(wks, pack_chunks(((a + k, row) for a, rows in plan["data"] for k, row in enumerate(rows)), plan["cols"]))
+    if plan["clear"]: wks.batch_clear(plan["clear"])
+    _printer()(f"   ✏️ Delta write: {plan['changed']} dòng đổi / {len(plan['data'])} range / {n} khối, xóa đuôi: {len(plan['clear'])}")
+
+# --- STAGING SQLITE (ENGINE "sqlite") ---
+# Thay DataFrame cả tab bằng 1 file SQLite / tab đích (<TAB_CACHE_DIR>/<spreadsheet id>/<hash tên tab>.sqlite):
+#   rows : các dòng của tab (JSON theo danh sách cột meta "cols"); index (Block ID, Link ID Config, khóa) cho 3 chế độ cập nhật,
+#          index thứ tự xuất (Block ID, Link ID dạng số, seq) -> xuất theo cursor, không sort / giữ cả tab trong RAM
+#   sheet: bản sao các dòng đang nằm trên Sheet -> delta write so từng dòng theo vị trí
+# Cùng kết quả, cùng thứ tự dòng với engine pandas: seq tăng = thứ tự concat, dòng target giữ lại được đánh seq mới (xuống cuối).
+# File còn hợp lệ ở lần chạy sau khi modifiedTime khớp manifest (như cache parquet) -> không tải lại cả tab.
+# Mọi thay đổi nằm trong 1 transaction, chỉ COMMIT sau khi ghi Sheet xong; lỗi -> ROLLBACK.
+STAGING_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)",
+    "CREATE TABLE IF NOT EXISTS rows (seq INTEGER PRIMARY KEY, blk_null INTEGER, blk_raw TEXT, sort_id REAL, blk TEXT, lnk TEXT, pk TEXT, data TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_rows_key ON rows (blk, lnk, pk)",
+    "CREATE INDEX IF NOT EXISTS ix_rows_order ON rows (blk_null, blk_raw, sort_id, seq)",
+    "CREATE TABLE IF NOT EXISTS link_pk (blk TEXT, lnk TEXT, col TEXT, PRIMARY KEY (blk, lnk))",
+    "CREATE TABLE IF NOT EXISTS sheet (pos INTEGER PRIMARY KEY, data TEXT)",
+    "CREATE TEMP TABLE new_rows (i INTEGER PRIMARY KEY, pk TEXT, data TEXT)",
+    "CREATE INDEX temp.ix_new_pk ON new_rows (pk)",
+]
+_ROW_COLS = "blk_null, blk_raw, sort_id, blk, lnk, pk, data"
+
+def _json_row(values):
+    return json.dumps([v if isinstance(v, str) else (None if pd.isna(v) else str(v)) for v in values], ensure_ascii=False)
+
+class StagingTab:
+    def __init__(self, secrets_dict, link_sheet_url, sheet_name):
+        self.title = str(sheet_name)
+        self.sh = open_spreadsheet(secrets_dict, url=link_sheet_url)
+        self.wks = get_worksheet(self.sh, sheet_name, 1000, 20)
+        self.path = _tab_cache_file(self.sh.id, sheet_name)[:-len(".parquet")] + ".sqlite"
+        self.modified = None
+        if TAB_CACHE:
+            try: self.modified = self.sh.get_lastUpdateTime()
+            except Exception: pass
+        man = _tab_cache_manifest(self.sh.id)
+        fresh = not (self.modified and man.get("modified") == self.modified and self.title in man.get("staged", [])
+                     and os.path.exists(self.path))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if fresh and os.path.exists(self.path): os.remove(self.path)
+        self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=MEMORY")
+        self.db.execute("PRAGMA synchronous=OFF")
+        for sql in STAGING_SCHEMA: self.db.execute(sql)
+        self.db.execute("BEGIN")
+        if fresh: self._load(secrets_dict, link_sheet_url, sheet_name)
+        self.cols = json.loads(self._meta("cols"))
+        if not fresh: _printer()(f"   💾 Dùng staging SQLite tab {sheet_name} ({self.count('rows')} dòng)")
+
+    def _meta(self, k, v=None):
+        if v is None:
+            row = self.db.execute("SELECT v FROM meta WHERE k = ?", (k,)).fetchone()
+            return row[0] if row else None
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (k, v))
+
+    def count(self, table):
+        return self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def _load(self, secrets_dict, link_sheet_url, sheet_name):
+        # Tải tab 1 lần (như engine pandas) rồi chuyển hết vào SQLite
+        _, old_df, sheet_cols, _ = _read_dest_tab(secrets_dict, link_sheet_url, sheet_name)
+        blk_raw = old_df["Block ID"].tolist()
+        blk, lnk = clean_str_series(old_df["Block ID"]).tolist(), clean_str_series(old_df["Link ID Config"]).tolist()
+        sort_id = pd.to_numeric(old_df["Link ID Config"], errors="coerce").fillna(999999).tolist()
+        self.db.executemany(f"INSERT INTO rows ({_ROW_COLS}) VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                            ((0, r, sid, b, l, _json_row(v)) if isinstance(r, str) else (1, None, sid, b, l, _json_row(v))
+                             for r, sid, b, l, v in zip(blk_raw, sort_id, blk, lnk, old_df.itertuples(index=False, name=None))))
+        self._meta("cols", json.dumps([str(c) for c in old_df.columns], ensure_ascii=False))
+        # Dòng/cột của old_df khớp đúng ô trên Sheet -> lưu bản sao để lần ghi sau chỉ ghi phần đổi
+        if sheet_cols is not None:
+            self.db.executemany("INSERT INTO sheet VALUES (?, ?)",
+                                ((i, _json_row(v)) for i, v in enumerate(old_df[sheet_cols].fillna("").astype(str).itertuples(index=False, name=None), start=1)))
+            self._meta("header", json.dumps([str(c) for c in sheet_cols], ensure_ascii=False))
+        _printer()(f"   🗄️ Nạp {len(old_df)} dòng tab {sheet_name} vào staging SQLite")
+
+    def merge(self, new_df, tb, tl, pk, status_mode):
+        # Như merge_link_frames; lỗi -> hoàn tác riêng link này
+        self.db.execute("SAVEPOINT link")
+        try:
+            self._merge(new_df, tb, tl, pk, status_mode)
+            self.db.execute("RELEASE link")
+        except Exception:
+            self.db.execute("ROLLBACK TO link")
+            self.db.execute("RELEASE link")
+            self.cols = json.loads(self._meta("cols"))
+            raise
+
+    def _index_pk(self, tb, tl, pk):
+        # Cột pk của các dòng target = giá trị cột khóa hiện tại của link (dòng mới nạp từ Sheet / link đổi cột khóa)
+        if pk not in self.cols: raise KeyError(pk)  # Như target_df[pk] của engine pandas
+        row = self.db.execute("SELECT col FROM link_pk WHERE blk = ? AND lnk = ?", (tb, tl)).fetchone()
+        if row and row[0] == pk: return
+        i = self.cols.index(pk)
+        cur = self.db.execute("SELECT seq, data FROM rows WHERE blk = ? AND lnk = ?", (tb, tl)).fetchall()
+        upd = []
+        for seq, data in cur:
+            v = json.loads(data)
+            upd.append((v[i] if i < len(v) else None, seq))
+        self.db.executemany("UPDATE rows SET pk = ? WHERE seq = ?", upd)
+        self.db.execute("INSERT OR REPLACE INTO link_pk VALUES (?, ?, ?)", (tb, tl, pk))
+
+    def _merge(self, new_df, tb, tl, pk, status_mode):
+        db = self.db
+        top = db.execute("SELECT COALESCE(MAX(seq), 0) FROM rows").fetchone()[0]
+        has_target = db.execute("SELECT 1 FROM rows WHERE blk = ? AND lnk = ? LIMIT 1", (tb, tl)).fetchone() is not None
+        new_empty = new_df is None or new_df.empty
+        cols = self.cols + [str(c) for c in (new_df.columns if new_df is not None else []) if str(c) not in self.cols]
+        db.execute("DELETE FROM new_rows")
+        if not new_empty:
+            pos = [cols.index(str(c)) for c in new_df.columns]
+            i_pk = list(new_df.columns).index(pk)
+            def rows():
+                for v in new_df.itertuples(index=False, name=None):
+                    out = [None] * len(cols)
+                    for p, x in zip(pos, v): out[p] = x
+                    yield (v[i_pk] if isinstance(v[i_pk], str) else None, _json_row(out))
+            db.executemany("INSERT INTO new_rows (pk, data) VALUES (?, ?)", rows())
+        sort_id = pd.to_numeric(pd.Series([tl]), errors="coerce").fillna(999999).iloc[0]
+        target = "blk = ? AND lnk = ? AND seq <= ?"
+
+        def keep_target(cond="1", args=()):
+            # Dòng target giữ lại -> đánh seq mới (như concat [safe, res]), giữ nguyên thứ tự
+            db.execute(f"INSERT INTO rows ({_ROW_COLS}) SELECT {_ROW_COLS} FROM rows WHERE {target} AND ({cond}) ORDER BY seq",
+                       (tb, tl, top) + args)
+        def add_new(cond="1", args=()):
+            self.cols = cols
+            self._meta("cols", json.dumps(cols, ensure_ascii=False))
+            db.execute(f"INSERT INTO rows ({_ROW_COLS}) SELECT 0, ?, ?, ?, ?, pk, data FROM new_rows WHERE {cond} ORDER BY i",
+                       (tb, float(sort_id), tb, tl) + args)
+            db.execute("INSERT OR REPLACE INTO link_pk VALUES (?, ?, ?)", (tb, tl, pk))
+
+        if status_mode == "Chưa chốt & đang cập nhật":
+            if new_df is not None and len(new_df.columns): add_new()
         elif status_mode == "Cập nhật dữ liệu cũ":
-            if target_df.empty or new_df.empty: res_df = target_df
+            if not has_target or new_empty: keep_target()
             else:
-                common = set(target_df[pk]).intersection(set(new_df[pk]))
-                res_df = pd.concat([target_df[~target_df[pk].isin(common)], new_df[new_df[pk].isin(common)]], ignore_index=True)
+                # Chỉ key có ở cả 2 bên: dòng cũ có key mới -> thay bằng dòng mới
+                self._index_pk(tb, tl, pk)
+                keep_target("pk IS NULL OR pk NOT IN (SELECT pk FROM new_rows WHERE pk IS NOT NULL)")
+                add_new(f"pk IN (SELECT pk FROM rows WHERE {target} AND pk IS NOT NULL)", (tb, tl, top))
         elif status_mode == "Cập nhật dữ liệu mới":
-            if target_df.empty: res_df = new_df
-            elif new_df.empty: res_df = target_df
-            else: res_df = pd.concat([target_df, new_df[~new_df[pk].isin(set(target_df[pk]))]], ignore_index=True)
-        else: res_df = target_df
-
-        final_df = pd.concat([safe_df, res_df], ignore_index=True)
-        final_df["_sort_id"] = pd.to_numeric(final_df["Link ID Config"], errors='coerce').fillna(999999)
-        final_df = final_df.sort_values(by=["Block ID", "_sort_id"]).drop(columns=["_sort_id"])
-
-        cols = list(final_df.columns)
-        f_cols = [c for c in cols if c not in meta_cols] + meta_cols
-        final_df = final_df[[c for c in f_cols if c in final_df.columns]]
-
-        wks.clear(); set_with_dataframe(wks, final_df)
-        final_df = final_df.reset_index(drop=True)
-        clean_links = clean_str_series(final_df["Link ID Config"])
-        clean_blocks = clean_str_series(final_df["Block ID"])
-        match_idx = final_df.index[(clean_links == tl) & (clean_blocks == tb)].tolist()
-        
-        if match_idx: return f"{min(match_idx)+2} - {max(match_idx)+2}", "Success"
-        return "No Data", "Success"
-    except Exception as e: return "0", str(e)
+            if not has_target: add_new()
+            elif new_empty: keep_target()
+            else:
+                self._index_pk(tb, tl, pk)
+                keep_target()
+                add_new(f"pk IS NULL OR pk NOT IN (SELECT pk FROM rows WHERE {target} AND pk IS NOT NULL)", (tb, tl, top))
+        else: keep_target()
+        db.execute(f"DELETE FROM rows WHERE {target}", (tb, tl, top))
+
+    def _export(self):
+        # (blk, lnk, [giá trị hiển thị]) theo đúng thứ tự dòng / cột của engine pandas
+        f_cols = [c for c in self.cols if c not in META_COLS] + [c for c in META_COLS if c in self.cols]
+        idx = [self.cols.index(c) for c in f_cols]
+        for blk, lnk, data in self.db.execute("SELECT blk, lnk, data FROM rows ORDER BY blk_null, blk_raw, sort_id, seq"):
+            v = json.loads(data)
+            yield blk, lnk, [("" if i >= len(v) or v[i] is None else v[i]) for i in idx]
+
+    def write(self):
+        # Ghi tab từ SQLite theo khối; header giống lần trước -> chỉ ghi dòng khác bản sao "sheet". Trả về {(blk, lnk): (dòng đầu, dòng cuối)}
+        db, wks = self.db, self.wks
+        f_cols = [c for c in self.cols if c not in META_COLS] + [c for c in META_COLS if c in self.cols]
+        esc = lambda v: "'" + v if v.startswith("'") else v
+        n_new, n_old = self.count("rows"), self.count("sheet")
+        full = not DELTA_WRITE or not n_old or json.loads(self._meta("header") or "null") != f_cols
+        ranges, stat = {}, {"changed": 0}
+
+        def rows():
+            last, gap = None, []
+            for pos, (blk, lnk, vals) in enumerate(self._export(), start=1):
+                r = ranges.setdefault((blk, lnk), [pos, pos])
+                r[1] = pos
+                js = json.dumps(vals, ensure_ascii=False)
+                if not full:
+                    old = db.execute("SELECT data FROM sheet WHERE pos = ?", (pos,)).fetchone()
+                    if old is not None and old[0] == js:
+                        if last is not None and pos - last <= DELTA_ROW_GAP: gap.append((pos + 1, [esc(v) for v in vals]))
+                        continue
+                    if last is not None and pos - last <= DELTA_ROW_GAP + 1: yield from gap
+                    gap, last = [], pos
+                    stat["changed"] += 1
+                db.execute("INSERT OR REPLACE INTO sheet VALUES (?, ?)", (pos, js))
+                yield pos + 1, [esc(v) for v in vals]
+
+        if full:
+            header = [_cell_value(c, lambda v: v.startswith("'")) for c in f_cols]
+            write_rows_chunked(wks, chain([header], (v for _, v in rows())), n_new + 1, len(f_cols))
+        else:
+            if n_new + 1 > wks.row_count: wks.add_rows(n_new + 1 - wks.row_count)
+            n = write_batches(wks, pack_chunks(rows(), len(f_cols)))
+            last_col = rowcol_to_a1(1, len(f_cols))[:-1]
+            if n_old > n_new: wks.batch_clear([f"A{n_new + 2}:{last_col}{n_old + 1}"])
+            _printer()(f"   ✏️ Delta write (SQLite): {stat['changed']} dòng đổi / {n} khối, xóa đuôi: {int(n_old > n_new)}")
+        db.execute("DELETE FROM sheet WHERE pos > ?", (n_new,))
+        self._meta("header", json.dumps(f_cols, ensure_ascii=False))
+        return {k: (a + 1, b + 1) for k, (a, b) in ranges.items()}
+
+    def invalidate(self):
+        # File đích bị sửa ngoài engine sau lúc mở: bản sao Sheet không còn đúng -> ghi đủ cả tab, không đóng dấu manifest
+        self.db.execute("DELETE FROM sheet")
+        self.modified = None
+
+    def _settle(self):
+        # Đưa bản SQLite về đúng dạng _load sẽ nạp lại từ Sheet: ô "" / "nan" / "NA"... -> null, bỏ cột trống
+        # (trừ cột meta), pk của link tính lại từ dữ liệu -> lần chạy sau dùng bản này cho kết quả như tải lại tab
+        db, na = self.db, _sheet_na_values()
+        keep, upd = set(), []
+        for seq, data in db.execute("SELECT seq, data FROM rows").fetchall():
+            v = json.loads(data)
+            w = [None if x in na else x for x in v]
+            keep.update(i for i, x in enumerate(w) if x is not None)
+            if w != v: upd.append((json.dumps(w, ensure_ascii=False), seq))
+        db.executemany("UPDATE rows SET data = ? WHERE seq = ?", upd)
+        db.execute("DELETE FROM link_pk")
+        drop = {i for i, c in enumerate(self.cols) if i not in keep and c not in META_COLS}
+        if drop:
+            # Cột bị bỏ khi đọc lại -> header khác, lần ghi sau ghi đủ cả tab (như engine pandas)
+            cut = lambda v: [x for i, x in enumerate(v) if i not in drop]
+            db.executemany("UPDATE rows SET data = ? WHERE seq = ?", [(json.dumps(cut(json.loads(d)), ensure_ascii=False), seq)
+                                                                     for seq, d in db.execute("SELECT seq, data FROM rows").fetchall()])
+            self.cols = cut(self.cols)
+            self._meta("cols", json.dumps(self.cols, ensure_ascii=False))
+            db.execute("DELETE FROM sheet")
+            db.execute("DELETE FROM meta WHERE k = 'header'")
+            return
+        upd = []
+        for pos, data in db.execute("SELECT pos, data FROM sheet").fetchall():
+            v = json.loads(data)
+            w = ["" if x in na else x for x in v]
+            if w != v: upd.append((json.dumps(w, ensure_ascii=False), pos))
+        db.executemany("UPDATE sheet SET data = ? WHERE pos = ?", upd)
+
+    def commit(self):
+        if TAB_CACHE and self.modified is not None: self._settle()
+        self.db.execute("COMMIT")
+        if not TAB_CACHE or self.modified is None: return
+        try:
+            man = _tab_cache_manifest(self.sh.id)
+            if man.get("modified") != self.modified: man = {"tabs": {}}
+            _save_tab_manifest(self.sh, man, self.title)
+        except Exception as e: _printer()(f"   ⚠️ Không lưu được manifest staging {self.title}: {e}")
+
+    def close(self):
+        if self.db.in_transaction: self.db.execute("ROLLBACK")
+        self.db.close()
+
+def process_data_final_v11(secrets_dict, link_sheet_url, sheet_name, block_id, link_id_config, new_data, status_mode, engine=None):
+    # new_data: list dict, DataFrame, hoặc iterator các lô (open_1office_stream)
+    # engine: "pandas" | "polars" | "sqlite" (None -> MERGE_ENGINE)
+    job = {"block_id": block_id, "link_id": link_id_config, "data": new_data, "status": status_mode}
+    return process_links_to_sheet(secrets_dict, link_sheet_url, sheet_name, [job], engine)[0]
+
+def _read_dest_tab(secrets_dict, link_sheet_url, sheet_name):
+    # Trả về (wks, old_df, sheet_cols, modified): modified dùng cho store_cached_tab sau khi ghi
+    dest_ss = open_spreadsheet(secrets_dict, url=link_sheet_url)
+    wks = get_worksheet(dest_ss, sheet_name, 1000, 20)
+
+    old_df, modified = load_cached_tab(dest_ss, sheet_name)
+    if old_df is not None: _printer()(f"   💾 Dùng cache tab {sheet_name} ({len(old_df)} dòng)")
+    else: old_df = get_as_dataframe(wks, evaluate_formulas=True, dtype=str, drop_empty_rows=False, drop_empty_columns=False)
+    all_cols = list(old_df.columns)
+    old_df = old_df.dropna(how='all').dropna(axis=1, how='all')
+    # Dòng i / cột j của old_df khớp đúng ô trên Sheet chỉ khi phần bị bỏ chỉ là dòng/cột trống ở cuối
+    # (cột bỏ đi không có header) -> mới ghi delta được
+    sheet_cols = list(old_df.columns)
+    if not (old_df.index.equals(pd.RangeIndex(len(old_df))) and all_cols[:len(sheet_cols)] == sheet_cols
+            and all(str(c).startswith("Unnamed:") for c in all_cols[len(sheet_cols):])): sheet_cols = None
+    for c in META_COLS:
+        if c not in old_df.columns: old_df[c] = ""
+    return wks, old_df, sheet_cols, modified
+
+def _prepare_new_frame(new_data, link_sheet_url, sheet_name, tb, tl):
+    if isinstance(new_data, pd.DataFrame): new_df = new_data
+    elif new_data: new_df = pd.DataFrame(new_data).astype(str)
+    else: return pd.DataFrame(), None
+    api_cols = [c for c in new_df.columns if c not in META_COLS]
+    new_df["Link Nguồn"] = link_sheet_url
+    new_df["Sheet Nguồn"] = sheet_name
+    new_df["Block ID"] = tb
+    new_df["Link ID Config"] = tl
+    new_df["Thời gian điền"] = (datetime.utcnow() + timedelta(hours=7)).strftime("%H:%M:%S %d/%m/%Y")
+    pk = api_cols[0] if api_cols else new_df.columns[0]
+    return new_df, pk
+
+# Hash nội dung dữ liệu API của link (không phụ thuộc thứ tự dòng/cột) lưu ở cột Content Hash của manager_links:
+# lần sau trùng hash -> dữ liệu không đổi, bỏ qua đọc/gộp/ghi (không đổi "Thời gian điền", không tốn quota ghi).
+CONTENT_HASH_SKIP = True
+
+def payload_hash(data, *extra):
+    df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data or [])
+    df = df[sorted(df.columns, key=str)].astype(str)
+    rows = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    rows.sort()
+    h = hashlib.sha1(json.dumps([[str(c) for c in df.columns]] + [str(x) for x in extra], ensure_ascii=False).encode("utf-8"))
+    h.update(rows.tobytes())
+    return h.hexdigest()[:20]
+
+def process_links_to_sheet(secrets_dict, link_sheet_url, sheet_name, jobs, engine=None):
+    # Nhiều link cùng ghi vào 1 tab: đọc tab 1 lần, gộp lần lượt từng link trên cùng 1 DataFrame, ghi 1 lần.
+    # jobs: [{"block_id", "link_id", "data", "status", "url" (tùy chọn, giá trị cột Link Nguồn), "hash_prev" (tùy chọn)}]
+    # Trả về [(range_str, msg)] theo đúng thứ tự jobs, giống kết quả process_data_final_v11 cho từng link.
+    # Mỗi job được gán j["content_hash"]; trùng hash_prev -> (range | None, "Unchanged"), không gộp/ghi link đó.
+    # engine "sqlite": tab nằm trong StagingTab thay vì DataFrame (xem STAGING SQLITE)
+    results = [None] * len(jobs)
+    merged, unchanged = [], []
+    wks = sheet_df = final_df = stage = None
+    try:
+        for i, j in enumerate(jobs):
+            data = j.get("data")
+            # Đọc hết stream TRƯỚC khi đụng vào Sheet -> thiếu trang thì không ghi đè dữ liệu thiếu
+            if data is not None and not isinstance(data, (list, pd.DataFrame)):
+                try:
+                    with span("fetch_pages", link=clean_str(j.get("link_id"))): data = frame_from_batches(data)
+                except FetchIncompleteError as e: results[i] = ("0", f"Fetch Error: {e}"); continue
+            has_data = (not data.empty) if isinstance(data, pd.DataFrame) else bool(data)
+            if not has_data and j.get("status") != "Chưa chốt & đang cập nhật": results[i] = ("0", "No Data"); continue
+            if CONTENT_HASH_SKIP:
+                j["content_hash"] = payload_hash(data, j.get("status"), sheet_name, j.get("url") or link_sheet_url)
+                if j["content_hash"] == j.get("hash_prev"):
+                    _printer()(f"   💤 Link {j.get('link_id')}: dữ liệu không đổi (unchanged), bỏ qua ghi")
+                    results[i] = (None, "Unchanged"); unchanged.append(i); continue
+
+            if wks is None and (engine or MERGE_ENGINE) == "sqlite":
+                with span("read_tab"): stage = StagingTab(secrets_dict, link_sheet_url, sheet_name)
+                wks = stage.wks
+            elif wks is None:
+                with span("read_tab"): wks, final_df, sheet_cols, modified = _read_dest_tab(secrets_dict, link_sheet_url, sheet_name)
+                sheet_df = final_df[sheet_cols] if sheet_cols is not None else None
+            if j.get("watermark_key"): j["watermark"] = max_watermark(data, j["watermark_key"], j.get("watermark"))
+            tb, tl = clean_str(j.get("block_id")), clean_str(j.get("link_id"))
+            new_df, pk = _prepare_new_frame(data, j.get("url") or link_sheet_url, sheet_name, tb, tl)
+            data = None
+            # Lỗi gộp của 1 link chỉ làm hỏng link đó, các link khác vẫn ghi bình thường
+            try:
+                with span("merge", link=tl, rows=len(new_df)):
+                    if stage is not None: stage.merge(new_df, tb, tl, pk, j.get("status"))
+                    else: final_df = merge_link_frames(final_df, new_df, tb, tl, pk, j.get("status"), engine)
+            except Exception as e: results[i] = ("0", str(e)); continue
+            merged.append(i)
+
+        if not merged: return results
+        if stage is not None:
+            if stage.modified is not None and not tab_unchanged_since(stage.sh, stage.modified): stage.invalidate()
+            with span("write", rows=stage.count("rows")): row_ranges = stage.write()
+            with span("cache_store"): stage.commit()
+            locate = lambda tb, tl: row_ranges.get((tb, tl))
+        else:
+            # Tab có thể đã bị sửa sau lúc đọc -> ghi đủ cả tab, không lưu cache
+            if modified is not None and not tab_unchanged_since(wks.spreadsheet, modified): modified = sheet_df = None
+            with span("write", rows=len(final_df)):
+                plan = plan_delta_writes(sheet_df, final_df) if DELTA_WRITE and sheet_df is not None else None
+                if plan is None: write_frame_chunked(wks, final_df)
+                else: apply_delta_writes(wks, plan)
+
+            final_df = final_df.reset_index(drop=True)
+            with span("cache_store"): store_cached_tab(wks.spreadsheet, sheet_name, final_df, modified)
+            clean_links = clean_str_series(final_df["Link ID Config"])
+            clean_blocks = clean_str_series(final_df["Block ID"])
+            def locate(tb, tl):
+                match_idx = final_df.index[(clean_links == tl) & (clean_blocks == tb)]
+                return (match_idx.min() + 2, match_idx.max() + 2) if len(match_idx) else None
+        for i in merged + unchanged:
+            r = locate(clean_str(jobs[i].get("block_id")), clean_str(jobs[i].get("link_id")))
+            if i in unchanged:
+                # Dòng của link không đổi nhưng có thể đã dịch chỗ do link khác trong cùng tab
+                if r: results[i] = (f"{r[0]} - {r[1]}", "Unchanged")
+            elif r: results[i] = (f"{r[0]} - {r[1]}", "Success")
+            else: results[i] = ("No Data", "Success")
+    except Exception as e:
+        # Lỗi đọc/ghi tab -> mọi link chưa có kết quả đều lỗi (chưa ghi gì)
+        for i in range(len(jobs)):
+            if results[i] is None or i in merged: results[i] = ("0", str(e))
+    finally:
+        if stage is not None: stage.close()
+    return results
+
+# --- CHẠY NHIỀU LINK (GOM THEO TAB ĐÍCH) ---
+def clean_sheet_link(raw_url):
+    # Link Google Sheet -> dạng chuẩn https://docs.google.com/spreadsheets/d/<id>
+    if "docs.google.com" in str(raw_url):
+        try:
+            fid = str(raw_url).split("/d/")[1].split("/")[0]
+            return f"https://docs.google.com/spreadsheets/d/{fid}"
+        except: return raw_url
+    return raw_url
+
+def _link_date(v):
+    # "05/01/2026" -> ngày trước tháng; "2026-01-05" (app ghi Timestamp dạng ISO) -> đọc đúng ISO, không đảo ngày/tháng
+    s = str(v).strip()
+    return pd.to_datetime(s, dayfirst=not re.match(r"\d{4}-\d{1,2}-\d{1,2}", s)).date()
+
+def parse_link_dates(link):
+    ds, de = None, None
+    try:
+        if link.get('Date Start'): ds = _link_date(link.get('Date Start'))
+        if link.get('Date End'): de = _link_date(link.get('Date End'))
+    except: pass
+    return ds, de
+
+# --- FETCH TĂNG DẦN THEO WATERMARK (CHẾ ĐỘ "Cập nhật dữ liệu mới") ---
+# Watermark = ngày mới nhất (theo cột Filter Key của dữ liệu API) đã ghi thành công, lưu ở cột Watermark của manager_links.
+# Lần sau {fk}_from = max(Date Start, watermark - overlap): dòng trùng khóa bị merge bỏ qua nên lùi vài ngày là an toàn.
+WATERMARK_OVERLAP_DAYS = 1  # secrets["system"]["watermark_overlap_days"] ghi đè
+
+def incremental_start(link, ds, overlap_days):
+    # Trả về (date_start dùng để fetch, có dùng watermark không)
+    if link.get('Status') != "Cập nhật dữ liệu mới" or not str(link.get('Filter Key') or "").strip(): return ds, False
+    wm = pd.to_datetime(str(link.get('Watermark') or "").strip().lstrip("'"), errors="coerce")
+    if pd.isna(wm): return ds, False
+    start = (wm - timedelta(days=overlap_days)).date()
+    return (max(ds, start) if ds else start), True
+
+def max_watermark(data, fk, prev=None):
+    # Ngày lớn nhất của cột fk trong dữ liệu vừa lấy (YYYY-MM-DD), không vượt quá hôm nay (giờ VN);
+    # không đọc được -> giữ prev
+    col = str(fk).strip()
+    if not isinstance(data, pd.DataFrame): data = pd.DataFrame(data or [])
+    if col not in data.columns: return prev
+    d = pd.to_datetime(data[col].astype(str), dayfirst=True, errors="coerce", format="mixed").max()
+    if pd.isna(d): return prev
+    d = min(d.date(), (datetime.utcnow() + timedelta(hours=7)).date())
+    p = pd.to_datetime(prev, errors="coerce") if prev else None
+    if p is not None and not pd.isna(p): d = max(d, p.date())
+    return d.strftime("%Y-%m-%d")
+
+def destination_key(link_sheet_url, sheet_name):
+    try: sid = extract_id_from_url(str(link_sheet_url))
+    except Exception: sid = str(link_sheet_url).strip()
+    return sid, str(sheet_name)
+
+def group_links_by_destination(items):
+    # items: [(block_id, block_name, link, link_sheet_url)] -> {(spreadsheet id, sheet name): [items]} (giữ thứ tự)
+    groups = {}
+    for it in items: groups.setdefault(destination_key(it[3], it[2].get('Sheet Name')), []).append(it)
+    return groups
+
+def _run_tab_group(secrets_dict, sheet_name, group, engine):
+    # 1 tab đích: fetch từng link (stream) -> process_links_to_sheet 1 lần. Trả về [res] theo thứ tự link.
+    t0 = time.perf_counter()
+    with span("tab", sheet=str(sheet_name), links=len(group)):
+        out = _run_tab_group_inner(secrets_dict, sheet_name, group, engine)
+    # Thời gian tab chia đều cho các link -> ghi vào log, dùng để ước tính chi phí block (estimate_block_cost)
+    dur = (time.perf_counter() - t0) / max(len(out), 1)
+    for res in out: res["dur"] = dur
+    return out
+
+def _run_tab_group_inner(secrets_dict, sheet_name, group, engine):
+    overlap = float(secrets_dict.get("system", {}).get("watermark_overlap_days", WATERMARK_OVERLAP_DAYS))
+    shard = secrets_dict.get("system", {}).get("fetch_shard", FETCH_SHARD)
+    tasks, jobs = [], []
+    for block_id, block_name, l, url in group:
+        ds, de = parse_link_dates(l)
+        ds, incremental = incremental_start(l, ds, overlap)
+        with span("fetch_open", block=clean_str(block_id), link=clean_str(l['Link ID'])):
+            data, msg = open_1office_sharded(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None, STREAM_BATCH_ROWS, incremental, shard)
+        t = {"block_id": block_id, "block_name": block_name, "link_id": l['Link ID'], "sheet_name": l.get('Sheet Name'), "msg": msg}
+        tasks.append(t)
+        if msg == "Success":
+            t["job"] = len(jobs)
+            job = {"block_id": block_id, "link_id": l['Link ID'], "data": data, "status": l.get('Status'), "url": url}
+            if l.get('Status') == "Cập nhật dữ liệu mới" and str(l.get('Filter Key') or "").strip():
+                job["watermark_key"] = l['Filter Key']
+                job["watermark"] = job["watermark_prev"] = str(l.get('Watermark') or "").strip().lstrip("'") or None
+            job["hash_prev"] = str(l.get('Content Hash') or "").strip().lstrip("'") or None
+            job["last_range"] = str(l.get('Last Range') or "")
+            jobs.append(job)
+    outs = process_links_to_sheet(secrets_dict, group[0][3], sheet_name, jobs, engine) if jobs else []
+
+    out = []
+    for t in tasks:
+        res = {"block_id": t["block_id"], "link_id": t["link_id"], "block_name": t["block_name"], "sheet_name": t["sheet_name"]}
+        if "job" not in t:
+            res.update(status="Error", range="Fail", message=t["msg"], stage="api")
+        else:
+            r_str, w_msg = outs[t["job"]]
+            j = jobs[t["job"]]
+            if w_msg == "Unchanged":
+                # Dữ liệu API giống hệt lần ghi trước -> không đọc/gộp/ghi; Last Range chỉ đổi nếu tab vừa được ghi lại vì link khác
+                res.update(status="Success", range=r_str or j.get("last_range", ""), message="Unchanged", stage=None, keep_range=r_str is None)
+            elif w_msg in ("Success", "No Data"):
+                # No Data (VD: watermark chưa có dòng mới) -> giữ nguyên Last Range cũ
+                res.update(status="Success", range=r_str, message="OK" if w_msg == "Success" else w_msg, stage=None, keep_range=w_msg == "No Data")
+                # Watermark / Content Hash chỉ cập nhật sau khi ghi tab thành công
+                if j.get("watermark") and j["watermark"] != j.get("watermark_prev"): res["watermark"] = j["watermark"]
+                if w_msg == "Success" and j.get("content_hash") and j["content_hash"] != j.get("hash_prev"): res["content_hash"] = j["content_hash"]
+            else: res.update(status="Error", range="Fail", message=w_msg, stage="write")
+        out.append(res)
+    return out
+
+def run_link_jobs(secrets_dict, items, trigger_type, engine=None, report=None, workers=1):
+    # items: [(block_id, block_name, link dict, link_sheet_url)]; link "Đã chốt" bị bỏ qua.
+    # Mỗi tab đích: fetch từng link (stream) -> process_links_to_sheet 1 lần -> ghi log + queue Last Range.
+    # workers > 1: các spreadsheet đích khác nhau chạy song song; các tab trong CÙNG 1 spreadsheet luôn tuần tự
+    # trong 1 worker (không có 2 luồng ghi cùng 1 file). Log/print của mỗi worker được giữ lại và in ra
+    # theo đúng thứ tự spreadsheet -> kết quả giống hệt nhau giữa các lần chạy.
+    # report(res) được gọi cho từng link (UI, luôn ở luồng gọi); res = {"block_name", "sheet_name", "status", "range", "message", "stage"}
+    items = [it for it in items if it[2].get('Status') != "Đã chốt"]
+    clusters = {}
+    for (sid, sheet_name), group in group_links_by_destination(items).items():
+        clusters.setdefault(sid, []).append((sheet_name, group))
+
+    results = []
+    def emit(out, lines=()):
+        for ln in lines: print(ln)
+        for res in out:
+            if res["status"] == "Success" and not res.get("keep_range"): queue_link_last_range(secrets_dict, res["link_id"], res["block_id"], res["range"])
+            if res.get("watermark"): queue_link_state(secrets_dict, res["link_id"], res["block_id"], "Watermark", res["watermark"])
+            if res.get("content_hash"): queue_link_state(secrets_dict, res["link_id"], res["block_id"], "Content Hash", res["content_hash"])
+            log_execution_history(secrets_dict, res["block_name"], res["sheet_name"], trigger_type, res["status"], res["range"], with_duration(res["message"], res.get("dur")))
+            results.append(res)
+            if report: report(res)
+
+    profile_link = clean_str(secrets_dict.get("system", {}).get("profile_link"))
+    parents = current_spans()
+    def run_cluster(tabs, sink=None):
+        # sink=None: chạy trong worker, gom print + kết quả lại; ngược lại đẩy kết quả từng tab ra ngay
+        if sink is None: _tls.out = []
+        try:
+            out = []
+            with span_parent(parents), span("spreadsheet", spreadsheet=destination_key(tabs[0][1][0][3], "")[0]):
+                for sheet_name, group in tabs:
+                    if profile_link and any(clean_str(it[2].get('Link ID')) == profile_link for it in group):
+                        res = profile_call(f"profile_link_{profile_link}", _run_tab_group, secrets_dict, sheet_name, group, engine)
+                    else: res = _run_tab_group(secrets_dict, sheet_name, group, engine)
+                    if sink: sink(res)
+                    else: out += res
+            return out, (getattr(_tls, "out", None) or [])
+        finally: _tls.out = None
+
+    if workers <= 1 or len(clusters) <= 1:
+        for tabs in clusters.values(): run_cluster(tabs, emit)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(run_cluster, tabs) for tabs in clusters.values()]
+            for f in futures: emit(*f.result())
+    return results
@@ -0,0 +1,440 @@
+# --- BENCHMARK OFFLINE (KHÔNG GỌI 1OFFICE / GOOGLE THẬT) ---
+# Server 1Office giả (HTTP local, tiến trình riêng) + Google Sheets giả trong RAM, chạy lại đúng các hàm của backend:
+#   fetch_1office_data_smart, process_data_final_v11, run_headless.main
+# Mỗi stage in: thời gian, số dòng/giây, bộ nhớ đỉnh (tracemalloc, gồm cả bản sao tab trong Sheets giả),
+# số request 1Office (tổng / 429 / lỗi) và số lệnh Sheets (đọc / ghi).
+# Sheets giả không đi qua bộ giới hạn quota -> cột "quota" = số phút tối thiểu nếu chạy thật (60 đọc + 60 ghi / phút).
+#
+#   python bench.py                                   # 1k, 10k, 100k dòng
+#   python bench.py --rows 1000 500000 --latency 0.05 --error-rate 0.01 --out bench.jsonl
+#   python bench.py --importtime --import-budget 150 --out bench.jsonl   # thời gian import (-X importtime)
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from gspread.exceptions import WorksheetNotFound
+from gspread.utils import a1_range_to_grid_range
+
+import backend as be
+import run_headless
+
+DATA_START = date(2025, 1, 1)
+DATA_DAYS = 365
+
+# --- SERVER 1OFFICE GIẢ ---
+# GET /ds/<n>?access_token=&limit=&page=&filters=[{"created_from": "dd/mm/YYYY", "created_to": ...}]
+# Dòng i sinh theo công thức (không giữ dataset trong RAM); "created" tăng dần theo i -> lọc ngày = cắt đoạn chỉ số.
+def fake_row(i, n):
+    d = DATA_START + timedelta(days=i * DATA_DAYS // max(n, 1))
+    return {"id": str(100000 + i), "created": d.strftime("%d/%m/%Y"), "code": f"DH{i:07d}", "name": f"Khách hàng {i % 997}",
+            "amount": str((i * 7919) % 100000), "status": ("Mới", "Đang xử lý", "Hoàn thành")[i % 3], "note": "x" * (i % 20)}
+
+def _index_of_day(d, n):
+    # Chỉ số dòng đầu tiên có created >= d
+    k = (d - DATA_START).days
+    if k <= 0: return 0
+    return min(n, -(-k * n // DATA_DAYS))
+
+class FakeOfficeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive như 1Office thật
+
+    def log_message(self, *a): pass
+
+    def _send(self, code, body, headers=None):
+        raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        srv, parts = self.server, urlsplit(self.path)
+        if parts.path == "/__stats": return self._send(200, srv.stats)
+        if parts.path == "/__reset":
+            with srv.lock: srv.stats = {"requests": 0, "throttled": 0, "errors": 0, "rows": 0}
+            return self._send(200, {})
+        q = parse_qs(parts.query)
+        n = int(parts.path.rsplit("/", 1)[-1])
+        limit, page = int(q.get("limit", ["100"])[0]), int(q.get("page", ["1"])[0])
+        with srv.lock: srv.stats["requests"] += 1
+        time.sleep(srv.opts["latency"] + srv.opts["depth_latency"] * (page - 1))
+        r = srv.rng.random()
+        if r < srv.opts["throttle_rate"]:
+            with srv.lock: srv.stats["throttled"] += 1
+            return self._send(429, {"error": True, "message": "Too many requests"}, {"Retry-After": str(srv.opts["retry_after"])})
+        if r < srv.opts["throttle_rate"] + srv.opts["error_rate"]:
+            with srv.lock: srv.stats["errors"] += 1
+            return self._send(500, {"error": True, "message": "Internal error"})
+
+        lo, hi = 0, n
+        if "filters" in q:
+            for f in json.loads(q["filters"][0]):
+                if f.get("created_from"): lo = max(lo, _index_of_day(datetime.strptime(f["created_from"], "%d/%m/%Y").date(), n))
+                if f.get("created_to"): hi = min(hi, _index_of_day(datetime.strptime(f["created_to"], "%d/%m/%Y").date() + timedelta(days=1), n))
+        total = max(hi - lo, 0)
+        a = lo + (page - 1) * limit
+        rows = [fake_row(i, n) for i in range(a, min(a + limit, hi))]
+        with srv.lock: srv.stats["rows"] += len(rows)
+        self._send(200, {"data": rows, "total_item": total})
+
+def _serve(opts, conn):
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), FakeOfficeHandler)
+    srv.daemon_threads = True
+    srv.opts, srv.lock, srv.rng = opts, threading.Lock(), random.Random(opts["seed"])
+    srv.stats = {"requests": 0, "throttled": 0, "errors": 0, "rows": 0}
+    conn.send(srv.server_address[1])
+    srv.serve_forever()
+
+def start_fake_office(opts):
+    # Tiến trình riêng -> bộ nhớ/CPU của server không lẫn vào số đo của backend
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_serve, args=(opts, child), daemon=True)
+    proc.start()
+    return proc, f"http://127.0.0.1:{parent.recv()}"
+
+def office_stats(base):
+    sess = be.get_http_session(base)
+    return sess.get(f"{base}/__stats", timeout=10).json()
+
+# --- GOOGLE SHEETS GIẢ (TRONG RAM) ---
+# Đủ phần API mà backend + gspread_dataframe dùng. Giá trị lưu dạng chuỗi như Sheets trả về (bỏ 1 dấu ' escape).
+SHEETS_READS = {"open_by_key", "worksheet", "worksheets", "values_get", "values_batch_get", "get_all_values", "batch_get",
+                "get_all_records", "find", "findall", "get_lastUpdateTime"}
+SHEETS_CALLS = {}
+_calls_lock = threading.Lock()
+
+def _count(name):
+    with _calls_lock: SHEETS_CALLS[name] = SHEETS_CALLS.get(name, 0) + 1
+
+def _cell(v):
+    v = "" if v is None else str(v)
+    return v[1:] if v.startswith("'") else v
+
+class FakeCell:
+    def __init__(self, row, col, value): self.row, self.col, self.value = row, col, value
+
+class FakeWorksheet:
+    def __init__(self, sh, title, rows, cols):
+        self.spreadsheet, self.title, self.row_count, self.col_count = sh, title, rows, cols
+        self.id = abs(hash((sh.id, title))) % 10 ** 9
+        self.rows = []
+
+    def _touch(self, name):
+        _count(name)
+        self.spreadsheet.version += 1
+
+    def _set(self, r, c, v):
+        if r > self.row_count or c > self.col_count: raise Exception(f"Range exceeds grid limits ({self.title})")
+        while len(self.rows) < r: self.rows.append([])
+        row = self.rows[r - 1]
+        if len(row) < c: row.extend([""] * (c - len(row)))
+        row[c - 1] = _cell(v)
+
+    def _values(self):
+        out = [list(r) for r in self.rows]
+        for r in out:
+            while r and r[-1] == "": r.pop()
+        while out and not out[-1]: out.pop()
+        return out
+
+    def _grid(self, a1):
+        g = a1_range_to_grid_range(a1)
+        return (g.get("startRowIndex", 0) + 1, g.get("endRowIndex", self.row_count),
+                g.get("startColumnIndex", 0) + 1, g.get("endColumnIndex", self.col_count))
+
+    def get_all_values(self, **k): _count("get_all_values"); return self._values()
+    def batch_get(self, ranges, **k):
+        _count("batch_get")
+        out = []
+        for a1 in ranges:
+            r1, r2, c1, c2 = self._grid(a1)
+            out.append([r[c1 - 1:c2] for r in self._values()[r1 - 1:r2]])
+        return out
+    def get_all_records(self, **k):
+        _count("get_all_records")
+        v = self._values()
+        if not v: return []
+        return [dict(zip(v[0], r + [""] * (len(v[0]) - len(r)))) for r in v[1:]]
+    def find(self, query, **k):
+        _count("find")
+        for i, r in enumerate(self.rows, start=1):
+            for j, v in enumerate(r, start=1):
+                if v == str(query): return FakeCell(i, j, v)
+        return None
+    def findall(self, query, **k):
+        _count("findall")
+        return [FakeCell(i, j, v) for i, r in enumerate(self.rows, start=1) for j, v in enumerate(r, start=1) if v == str(query)]
+    def clear(self): self._touch("clear"); self.rows = []
+    def resize(self, rows=None, cols=None):
+        self._touch("resize")
+        if rows: self.row_count = rows; del self.rows[rows:]
+        if cols: self.col_count = cols
+    def add_rows(self, n): self._touch("add_rows"); self.row_count += n
+    def delete_rows(self, start, end=None):
+        self._touch("delete_rows")
+        del self.rows[start - 1:(end or start)]
+        self.row_count -= (end or start) - start + 1
+    def update_cell(self, r, c, v): self._touch("update_cell"); self._set(r, c, v)
+    def update_cells(self, cells, value_input_option=None):
+        self._touch("update_cells")
+        for c in cells: self._set(c.row, c.col, c.value)
+    def batch_update(self, data, value_input_option=None, **k):
+        self._touch("batch_update")
+        for d in data:
+            r1, _, c1, _ = self._grid(d["range"])
+            for i, row in enumerate(d["values"]):
+                for j, v in enumerate(row): self._set(r1 + i, c1 + j, v)
+    def batch_clear(self, ranges):
+        self._touch("batch_clear")
+        for a1 in ranges:
+            r1, r2, c1, c2 = self._grid(a1)
+            for r in self.rows[r1 - 1:r2]:
+                for j in range(c1 - 1, min(c2, len(r))): r[j] = ""
+    def append_row(self, row, **k): self.append_rows([row], **k)
+    def append_rows(self, rows, **k):
+        self._touch("append_rows")
+        n = len(self._values())
+        if n + len(rows) > self.row_count: self.row_count = n + len(rows)
+        for i, row in enumerate(rows):
+            for j, v in enumerate(row): self._set(n + 1 + i, j + 1, v)
+
+class FakeSpreadsheet:
+    def __init__(self, key):
+        self.id, self.title, self.version, self.tabs = key, key, 0, {}
+
+    def _tab(self, rng):
+        return self.tabs[rng.split("!")[0].strip("'").replace("''", "'")]
+
+    def worksheet(self, title):
+        _count("worksheet")
+        if title not in self.tabs: raise WorksheetNotFound(title)
+        return self.tabs[title]
+    def worksheets(self): _count("worksheets"); return list(self.tabs.values())
+    def add_worksheet(self, title, rows, cols, **k):
+        _count("add_worksheet")
+        self.tabs[title] = FakeWorksheet(self, title, int(rows), int(cols))
+        return self.tabs[title]
+    def get_lastUpdateTime(self): _count("get_lastUpdateTime"); return f"v{self.version}"
+    def values_get(self, rng, params=None):
+        _count("values_get")
+        wks = self._tab(rng)
+        r1 = wks._grid(rng.rsplit("!", 1)[1])[0] if "!" in rng else 1
+        return {"values": wks._values()[r1 - 1:]}
+    def values_batch_get(self, ranges, params=None):
+        _count("values_batch_get")
+        return {"valueRanges": [{"values": self._tab(r)._values()} if r.split("!")[0].strip("'") in self.tabs else {} for r in ranges]}
+    def values_batch_update(self, body):
+        _count("values_batch_update")
+        self.version += 1
+        for d in body["data"]:
+            wks = self._tab(d["range"])
+            r1, _, c1, _ = wks._grid(d["range"].rsplit("!", 1)[1])
+            for i, row in enumerate(d["values"]):
+                for j, v in enumerate(row): wks._set(r1 + i, c1 + j, v)
+
+class FakeHTTPClient:
+    # gc.http_client: gọi thẳng API theo id, không qua open_by_key (không tốn lần đọc metadata)
+    def __init__(self, gc): self.gc = gc
+    def values_batch_get(self, id, ranges, params=None):
+        return self.gc.files.setdefault(id, FakeSpreadsheet(id)).values_batch_get(ranges, params)
+    def values_get(self, id, range, params=None):
+        return self.gc.files.setdefault(id, FakeSpreadsheet(id)).values_get(range, params)
+
+class FakeClient:
+    def __init__(self): self.files, self.http_client = {}, FakeHTTPClient(self)
+    def open_by_key(self, key):
+        _count("open_by_key")
+        return self.files.setdefault(key, FakeSpreadsheet(key))
+
+# --- ĐO TỪNG STAGE ---
+def sheets_totals(calls):
+    reads = sum(v for k, v in calls.items() if k in SHEETS_READS)
+    return reads, sum(calls.values()) - reads
+
+@contextlib.contextmanager
+def stage(name, rows, base, results):
+    before_calls, before_http = dict(SHEETS_CALLS), office_stats(base)
+    tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): yield
+    wall = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    http = office_stats(base)
+    calls = {k: v - before_calls.get(k, 0) for k, v in SHEETS_CALLS.items() if v - before_calls.get(k, 0)}
+    reads, writes = sheets_totals(calls)
+    res = {"stage": name, "rows": rows, "wall_s": round(wall, 3), "rows_per_s": round(rows / wall) if wall else 0,
+           "peak_mb": round(peak / 2 ** 20, 1), "http": http["requests"] - before_http["requests"],
+           "http_429": http["throttled"] - before_http["throttled"], "http_err": http["errors"] - before_http["errors"],
+           "sheets_read": reads, "sheets_write": writes, "quota_min": round(max(reads, writes) / 60, 1), "sheets_calls": calls}
+    results.append(res)
+    print(f"{name:<18}{rows:>9}{res['wall_s']:>9.2f}{res['rows_per_s']:>10}{res['peak_mb']:>9.1f}"
+          f"{res['http']:>7}{res['http_429']:>6}{res['http_err']:>6}{reads:>7}{writes:>7}{res['quota_min']:>7.1f}")
+
+def master_rows(base, n_rows, n_links, n_files):
+    links = [["Link ID", "Block ID", "Method", "API URL", "Access Token", "Link Sheet", "Sheet Name", "Filter Key",
+              "Date Start", "Date End", "Status", "Last Range"]]
+    for i in range(n_links):
+        links.append([str(i + 1), "B1", "GET", f"{base}/ds/{max(n_rows // n_links, 1)}", "bench-token",
+                      f"https://docs.google.com/spreadsheets/d/BENCH_DEST_{i % n_files}", f"Tab {i // n_files}", "created",
+                      "", "", "Chưa chốt & đang cập nhật", ""])
+    return {
+        "manager_blocks": [["Block ID", "Block Name", "Schedule Type", "Schedule Config", "Status", "Last Run"],
+                           ["B1", "Bench", "Hàng ngày", json.dumps({"loop_minutes": 1}), "Active", ""]],
+        "manager_links": links,
+        "log_lan_thuc_thi": [["Time", "Block Name", "Sheet Name", "Trigger Type", "Status", "Updated Range", "Message"]],
+    }
+
+def run_size(n, base, args, results):
+    gc = FakeClient()
+    be.get_gspread_client = lambda secrets: gc
+    be.invalidate_sheet_cache()
+    be.invalidate_master_snapshot()
+    secrets = {"gcp_service_account": {}, "system": {"master_sheet_id": "BENCH_MASTER", "link_workers": args.workers,
+                                                     "run_report": f"{be.TAB_CACHE_DIR}/run_report.jsonl"}}
+    if args.shard: secrets["system"]["fetch_shard"] = args.shard
+    url, dest = f"{base}/ds/{n}", "https://docs.google.com/spreadsheets/d/BENCH_DEST"
+
+    with stage("fetch", n, base, results):
+        data, msg = be.fetch_1office_data_smart(url, "bench-token")
+    if msg != "Success": print(f"   ⚠️ fetch lỗi: {msg.splitlines()[-1]}")
+    if args.shard:
+        with stage(f"fetch[{args.shard}]", n, base, results):
+            be.fetch_1office_data_smart(url, "bench-token", "GET", "created", DATA_START, DATA_START + timedelta(days=DATA_DAYS), shard=args.shard)
+    with stage("process (mới)", n, base, results):
+        be.process_data_final_v11(secrets, dest, "Bench", "B1", "1", data, "Chưa chốt & đang cập nhật", args.engine)
+    with stage("process (lặp lại)", n, base, results):
+        be.process_data_final_v11(secrets, dest, "Bench", "B1", "1", data, "Chưa chốt & đang cập nhật", args.engine)
+    data = None
+
+    master = gc.open_by_key("BENCH_MASTER")
+    for title, rows in master_rows(base, n, args.links, args.files).items():
+        wks = master.add_worksheet(title, max(len(rows) + 100, 1000), 20)
+        wks.update_cells([FakeCell(i + 1, j + 1, v) for i, r in enumerate(rows) for j, v in enumerate(r)])
+    run_headless.load_secrets_local = lambda: secrets
+    if args.engine: secrets["system"]["merge_engine"] = args.engine
+    with stage("headless (lần 1)", n, base, results): run_headless.main()
+    # Xóa Last Run để block đến hạn lại: lần 2 = giờ "yên tĩnh", dữ liệu API không đổi
+    master.tabs["manager_blocks"].rows[1][5] = ""
+    with stage("headless (lần 2)", n, base, results): run_headless.main()
+
+# --- THỜI GIAN IMPORT (python -X importtime) ---
+# Đo import run_headless trong tiến trình mới (lấy lần nhanh nhất) + chạy thử lượt headless "không có block đến hạn"
+# trên Sheets giả: phải nằm trong ngân sách ms, chỉ 1 lần đọc master và không nạp module nặng (pandas...).
+IMPORT_BUDGET_MS = 150
+IMPORT_REPEAT = 3
+HEAVY_MODULES = ("pandas", "numpy", "polars", "gspread_dataframe")
+
+def import_times(module):
+    # Trả về (ms cumulative của `module`, [(ms, tên)] các import trực tiếp tốn nhất)
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True).stderr
+    total, children, pending = 0.0, [], []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        _, cum, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1: pending.append((int(cum) / 1000, name.strip()))
+        elif depth == 0:
+            # -X importtime in module con trước module cha
+            if name.strip() == module: total, children = int(cum) / 1000, pending
+            pending = []
+    return total, sorted(children, reverse=True)
+
+def idle_probe():
+    # Chạy trong tiến trình riêng (bench.py --idle-probe): in JSON {module nặng đã nạp, lệnh Sheets đã gọi}
+    gc = FakeClient()
+    be.get_gspread_client = lambda secrets: gc
+    master = gc.open_by_key("BENCH_MASTER")
+    rows = master_rows("http://127.0.0.1:9", 1, 1, 1)
+    rows["manager_blocks"][1][3] = json.dumps({"loop_minutes": 60})
+    rows["manager_blocks"][1][5] = run_headless.get_now_vn().strftime("%H:%M:%S %d/%m/%Y")
+    for title, values in rows.items():
+        master.add_worksheet(title, 100, 20).rows = [list(r) for r in values]
+    SHEETS_CALLS.clear()
+    secrets = {"gcp_service_account": {}, "system": {"master_sheet_id": "BENCH_MASTER",
+                                                     "run_report": f"{tempfile.mkdtemp(prefix='bench_idle_')}/run_report.jsonl"}}
+    run_headless.load_secrets_local = lambda: secrets
+    with contextlib.redirect_stdout(io.StringIO()): run_headless.main()
+    print(json.dumps({"heavy": [m for m in HEAVY_MODULES if m in sys.modules], "sheets_calls": SHEETS_CALLS}))
+
+def check_imports(budget_ms):
+    runs = [import_times("run_headless") for _ in range(IMPORT_REPEAT)]
+    total, children = min(runs)
+    print(f"⏱️ import run_headless: {total:.1f} ms (ngân sách {budget_ms} ms, nhanh nhất / {IMPORT_REPEAT} lần)")
+    for ms, name in children[:8]: print(f"   {name:<28}{ms:>9.1f} ms")
+    out = subprocess.run([sys.executable, __file__, "--idle-probe"], capture_output=True, text=True)
+    if out.returncode != 0: raise RuntimeError(f"idle probe lỗi:\n{out.stderr}")
+    probe = json.loads(out.stdout.strip().splitlines()[-1])
+    reads, writes = sheets_totals(probe["sheets_calls"])
+    print(f"💤 Không có block đến hạn: đọc {reads} / ghi {writes} lệnh Sheets, module nặng: {', '.join(probe['heavy']) or '-'}")
+    ok = total <= budget_ms and reads == 1 and writes == 0 and not probe["heavy"]
+    print("✅ Đạt ngân sách import" if ok else "❌ Vượt ngân sách import")
+    return {"stage": "import", "import_ms": round(total, 1), "budget_ms": budget_ms, "idle_sheets_read": reads,
+            "idle_sheets_write": writes, "idle_heavy": probe["heavy"], "ok": ok}
+
+def run_sizes(args):
+    if args.backoff_base is not None: be.FETCH_BACKOFF_BASE = args.backoff_base
+    be.TAB_CACHE_DIR = tempfile.mkdtemp(prefix="bench_tabs_")
+    proc, base = start_fake_office({"latency": args.latency, "depth_latency": args.depth_latency, "error_rate": args.error_rate,
+                                    "throttle_rate": args.throttle_rate, "retry_after": args.retry_after, "seed": args.seed})
+    results = []
+    print(f"{'stage':<18}{'rows':>9}{'wall(s)':>9}{'rows/s':>10}{'peakMB':>9}{'http':>7}{'429':>6}{'err':>6}{'read':>7}{'write':>7}{'quota':>7}")
+    tracemalloc.start()
+    try:
+        for n in args.rows: run_size(n, base, args, results)
+    finally:
+        tracemalloc.stop()
+        proc.terminate()
+        be.close_http_sessions()
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark offline: server 1Office giả + Google Sheets giả")
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--latency", type=float, default=0.02, help="giây / request")
+    ap.add_argument("--depth-latency", type=float, default=0.0, help="giây cộng thêm cho mỗi trang sâu hơn")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="tỉ lệ HTTP 500")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="tỉ lệ HTTP 429")
+    ap.add_argument("--retry-after", type=float, default=0.0)
+    ap.add_argument("--backoff-base", type=float, default=None, help="ghi đè FETCH_BACKOFF_BASE (giây)")
+    ap.add_argument("--links", type=int, default=4, help="số link cho stage headless (chia đều số dòng)")
+    ap.add_argument("--files", type=int, default=2, help="số spreadsheet đích cho stage headless")
+    ap.add_argument("--workers", type=int, default=be.LINK_WORKERS)
+    ap.add_argument("--engine", choices=["pandas", "polars", "sqlite"], default=None)
+    ap.add_argument("--shard", choices=["day", "week", "month", "auto"], default=None)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default=None, help="ghi thêm kết quả (JSON lines) để so sánh giữa các lần")
+    ap.add_argument("--importtime", action="store_true", help="chỉ đo thời gian import + lượt không có block đến hạn")
+    ap.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS, help="ngân sách import run_headless (ms)")
+    ap.add_argument("--idle-probe", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.idle_probe: return idle_probe()
+
+    if args.importtime: results = [check_imports(args.import_budget)]
+    else: results = run_sizes(args)
+
+    if args.out:
+        try: rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+        except Exception: rev = ""
+        meta = {"time": datetime.now().isoformat(timespec="seconds"), "git": rev, "python": sys.version.split()[0],
+                "args": {k: v for k, v in vars(args).items() if k != "out"}}
+        with open(args.out, "a", encoding="utf-8") as f:
+            for r in results: f.write(json.dumps({**meta, **r}, ensure_ascii=False) + "\n")
+        print(f"📝 Đã ghi {len(results)} dòng vào {args.out}")
+    if not all(r.get("ok", True) for r in results): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
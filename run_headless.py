@@ -1,10 +1,14 @@
 import backend as be
-import pandas as pd
+import argparse
+import heapq
 import json
+import signal
+import threading
 import time
 from datetime import datetime, timedelta
 
 # --- CẤU HÌNH ---
+RUN_REPORT_PATH = "run_report.jsonl"  # secrets["system"]["run_report"] ghi đè; mỗi lần chạy nối thêm các dòng JSON
 WEEKDAY_MAP = {
     "Thứ 2": 0, "Thứ 3": 1, "Thứ 4": 2, "Thứ 5": 3, 
     "Thứ 6": 4, "Thứ 7": 5, "CN": 6, "Chủ Nhật": 6
@@ -35,14 +39,8 @@ def parse_time_str(time_str):
         except: return None
 
 def update_block_last_run(secrets, block_id, run_time_str):
-    try:
-        gc, _ = be.get_connection(secrets)
-        wks = gc.worksheet("manager_blocks")
-        cell = wks.find(block_id)
-        if cell:
-            wks.update_cell(cell.row, 6, run_time_str)
-    except Exception as e:
-        print(f"⚠️ Không thể update Last Run: {e}")
+    # Chỉ ghi nhận; be.commit_status_updates() ghi tất cả 1 lần ở cuối lần chạy
+    be.queue_block_last_run(secrets, block_id, run_time_str)
 
 def should_run_block(block, now):
     # (Logic kiểm tra giờ chạy - Giữ nguyên như cũ)
@@ -119,6 +117,36 @@ def should_run_block(block, now):
                     return True
     return False
 
+# --- KẾ HOẠCH CHẠY THEO NGÂN SÁCH THỜI GIAN ---
+# Nhiều block đến hạn cùng lúc: block lâu chưa chạy nhất đi trước (chưa chạy bao giờ = cũ nhất). Có ngân sách
+# (secrets["system"]["run_budget_minutes"]) thì ước tính chi phí mỗi block từ log_lan_thuc_thi (be.estimate_block_cost),
+# bằng độ cũ thì block rẻ hơn trước, cộng dồn tuần tự (ước tính thận trọng, bỏ qua chạy song song) tới hết ngân sách.
+# Block không vừa bị hoãn: không ghi Last Run -> lần chạy sau vẫn đến hạn (và cũ hơn nên được ưu tiên), log "Deferred".
+RUN_BUDGET_MINUTES = None  # None = không giới hạn
+
+def run_budget_seconds(secrets):
+    budget = secrets.get("system", {}).get("run_budget_minutes", RUN_BUDGET_MINUTES)
+    return float(budget) * 60 if budget not in (None, "") else None
+
+def plan_blocks(secrets, due_blocks, now, budget_s=None, min_one=True):
+    # Trả về (chạy, hoãn) = ([(block, giây ước tính | None)], [(block, giây ước tính)])
+    # min_one: luôn chạy block đầu tiên dù vượt ngân sách -> block lớn không bị hoãn mãi
+    if budget_s is None:
+        return [(b, None) for b in sorted(due_blocks, key=parse_last_run)], []
+    try: hist = be.load_link_history(secrets)
+    except Exception as e:
+        print(f"⚠️ Không đọc được lịch sử chạy ({e}) -> ước tính mặc định")
+        hist = {"runs": {}, "rate": None}
+    costs = [(b, be.estimate_block_cost(secrets, b, hist)) for b in due_blocks]
+    costs.sort(key=lambda x: (parse_last_run(x[0]), x[1]))
+    run, deferred, used = [], [], 0.0
+    for b, cost in costs:
+        if used + cost <= budget_s or (min_one and not run):
+            run.append((b, cost))
+            used += cost
+        else: deferred.append((b, cost))
+    return run, deferred
+
 # --- MAIN ---
 def main():
     print(">>> KINKIN AUTOMATION: STARTING HEADLESS RUN...")
@@ -129,8 +157,28 @@ def main():
         print("❌ CRITICAL: Không load được secrets. Dừng chương trình.")
         return
 
-    # 2. Lấy danh sách Block từ Backend
+    try: traced_run(secrets, lambda: run_once(secrets))
+    finally: be.close_http_sessions()
+    print("✅ HEADLESS RUN COMPLETED.")
+
+def traced_run(secrets, fn):
+    # Đo thời gian từng bước (span) của cả lần chạy -> run report (JSON lines) ở cuối, kể cả khi lỗi
+    be.reset_spans()
+    started = get_now_vn()
+    try:
+        with be.span_report("run", trigger="headless"): return fn()
+    finally:
+        path = secrets.get("system", {}).get("run_report") or RUN_REPORT_PATH
+        summary = be.write_run_report(path, trigger="Auto (Headless)", started=started.strftime("%H:%M:%S %d/%m/%Y"))
+        print(f"⏱️ Run report -> {path}")
+        for stage, st in sorted(summary.items(), key=lambda x: -x[1]["dur"]):
+            calls = ", ".join(f"{k}={v}" for k, v in sorted(st["calls"].items()))
+            print(f"   {stage:<14} x{st['count']:<4} {st['dur']:>9.2f}s (max {st['max']:.2f}s) {calls}")
+
+def run_once(secrets):
+    # 2. Lấy danh sách Block từ Backend (đọc manager_blocks + manager_links 1 lần cho cả lần chạy)
     try:
+        be.load_master_snapshot(secrets, refresh=True)
         blocks = be.get_all_blocks(secrets)
     except Exception as e:
         print(f"❌ Lỗi kết nối Backend: {e}")
@@ -142,51 +190,223 @@ def main():
 
     now = get_now_vn()
     print(f"🕒 Time Check (VN): {now.strftime('%H:%M:%S %d/%m/%Y')}")
+    due_blocks = [b for b in blocks if should_run_block(b, now)]
+    # Không có block đến hạn -> dừng ngay: chỉ 1 lần đọc master, không nạp pandas / gspread_dataframe
+    if not due_blocks:
+        print("💤 Không có block nào đến hạn.")
+        return
+    run_blocks(secrets, due_blocks, now, run_budget_seconds(secrets))
+
+def run_blocks(secrets, due_blocks, now, budget_s=None, min_one=True):
+    # Chạy các block đến hạn theo kế hoạch (plan_blocks); Last Run = now (giờ bắt đầu kiểm tra lịch) như trước.
+    # Trả về danh sách block bị hoãn (không ghi Last Run).
+    # Engine gộp dữ liệu cho lần chạy này: secrets["system"]["merge_engine"] = "pandas" | "polars" | "sqlite"
+    merge_engine = secrets.get("system", {}).get("merge_engine") or be.MERGE_ENGINE
+    # Số spreadsheet đích chạy song song: secrets["system"]["link_workers"] (1 = tuần tự như cũ)
+    link_workers = int(secrets.get("system", {}).get("link_workers") or be.LINK_WORKERS)
+    # Số trang gọi song song / host: secrets["system"]["fetch_concurrency_min" / "fetch_concurrency_max" / "fetch_latency_factor"]
+    be.configure_fetch(secrets)
+
+    planned, deferred = plan_blocks(secrets, due_blocks, now, budget_s, min_one)
+    due_blocks = [b for b, _ in planned]
+    if budget_s is not None:
+        print(f"🧮 Kế hoạch: chạy {len(planned)} block (~{sum(c for _, c in planned):.0f}s), hoãn {len(deferred)} block (ngân sách {budget_s:.0f}s)")
+
+    items = []
+    for block in due_blocks:
+        b_id, b_name = block.get("Block ID"), block.get("Block Name")
+        print(f"▶️ KÍCH HOẠT CHẠY BLOCK: {b_name}...")
+        for l in be.get_links_by_block(secrets, b_id):
+            items.append((b_id, b_name, l, l['Link Sheet']))
+
+    def report(res):
+        print(f"   ↳ {res['block_name']} / {res['sheet_name']}")
+        if res["status"] == "Success": print(f"     ✅ Success: {res['range']}")
+        elif res["stage"] == "write": print(f"     ❌ Write Error: {res['message']}")
+        else: print(f"     ❌ API Error: {res['message']}")
+
+    # Log gom trong RAM, ghi khi đủ lô / khi thoát (kể cả khi lỗi)
+    # Link cùng tab đích được gom: đọc - gộp - ghi tab 1 lần (be.run_link_jobs)
+    # Spreadsheet đích khác nhau chạy song song, cùng spreadsheet thì tuần tự; log in theo thứ tự cố định
+    # Last Range / Last Run gom lại, ghi 1 lần (batch_update) ở cuối lần chạy
+    with be.buffered_execution_logs(secrets):
+        for block, cost in deferred:
+            msg = f"Hoãn sang lần chạy sau: ước tính {cost:.0f}s, vượt ngân sách {budget_s:.0f}s"
+            print(f"⏭️ {block.get('Block Name')}: {msg}")
+            be.log_execution_history(secrets, block.get("Block Name"), "", "Auto (Headless)", "Deferred", "", msg)
+        try:
+            if items: be.run_link_jobs(secrets, items, "Auto (Headless)", merge_engine, report, workers=link_workers)
+            now_str = now.strftime("%H:%M:%S %d/%m/%Y")
+            for block in due_blocks:
+                update_block_last_run(secrets, block.get("Block ID"), now_str)
+                print(f"🏁 Đã ghi nhận Last Run cho {block.get('Block Name')}")
+        finally:
+            be.commit_status_updates(secrets)
+
+    for acc, st in be.get_sheets_quota_stats().items():
+        print(f"📊 Sheets quota ({acc}): đọc {st['read']['calls']} (chờ {st['read']['waited']}s) / ghi {st['write']['calls']} (chờ {st['write']['waited']}s)")
+    for host, st in be.get_http_pool_stats().items():
+        print(f"🔌 {host}: {st['requests']} request / {st['connections']} kết nối (tái sử dụng {st['reused']})")
+    return [b for b, _ in deferred]
+
+# --- DAEMON (CHẠY LIÊN TỤC, HÀNG ĐỢI THEO GIỜ ĐẾN HẠN) ---
+# python run_headless.py --daemon [--max-hours H]: giữ 1 tiến trình (client Google, kết nối HTTP, cache dùng lại).
+# Lịch của mỗi block được dịch 1 lần (compile_schedule) -> heap (giờ đến hạn kế tiếp, block); ngủ tới mục sớm nhất.
+# Cấu hình master được đọc lại mỗi DAEMON_RELOAD_MINUTES phút, chỉ khi file đã đổi (modifiedTime), và chỉ dịch lại
+# block có lịch / trạng thái / Last Run thay đổi. Lúc đến hạn vẫn kiểm tra lại bằng should_run_block -> cùng ngữ nghĩa Last Run.
+DAEMON_RELOAD_MINUTES = 5  # secrets["system"]["daemon_reload_minutes"] ghi đè
+DAEMON_MAX_SLEEP = 60  # Giây; ngủ tối đa 1 lần rồi kiểm tra lại (đồng hồ hệ thống nhảy, tín hiệu dừng)
+SCHEDULE_HORIZON_DAYS = 62  # Tìm giờ đến hạn kế tiếp trong từng này ngày (đủ cho lịch hàng tháng)
+
+def parse_last_run(block):
+    try: return datetime.strptime(str(block.get("Last Run", "")).strip(), "%H:%M:%S %d/%m/%Y")
+    except: return datetime.min
 
-    for block in blocks:
-        b_id = block.get("Block ID")
-        b_name = block.get("Block Name")
-        
-        if should_run_block(block, now):
-            print(f"▶️ KÍCH HOẠT CHẠY BLOCK: {b_name}...")
-            
-            links = be.get_links_by_block(secrets, b_id)
-            for l in links:
-                if l.get('Status') == "Đã chốt": continue
-                
-                sheet_name = l.get('Sheet Name')
-                print(f"   ↳ Xử lý sheet: {sheet_name}")
-                
-                ds, de = None, None
-                try:
-                    if l.get('Date Start'): ds = pd.to_datetime(l.get('Date Start'), dayfirst=True).date()
-                    if l.get('Date End'): de = pd.to_datetime(l.get('Date End'), dayfirst=True).date()
-                except: pass
-
-                data, msg = be.fetch_1office_data_smart(l['API URL'], l['Access Token'], 'GET', l['Filter Key'], ds, de, None)
-                
-                if msg == "Success":
-                    r_str, w_msg = be.process_data_final_v11(secrets, l['Link Sheet'], sheet_name, b_id, l['Link ID'], data, l.get('Status'))
-                    if "Error" not in w_msg:
-                        be.update_link_last_range(secrets, l['Link ID'], b_id, r_str)
-                        # GHI LOG
-                        be.log_execution_history(secrets, b_name, sheet_name, "Auto (Headless)", "Success", r_str, "OK")
-                        print(f"     ✅ Success: {r_str}")
-                    else:
-                        be.log_execution_history(secrets, b_name, sheet_name, "Auto (Headless)", "Error", "Fail", w_msg)
-                        print(f"     ❌ Write Error: {w_msg}")
+def compile_schedule(block):
+    # Dịch Schedule Config 1 lần: {"loop": phút | None, "slots": [(hàm ngày -> bool, giờ)]}; None = không tự chạy
+    b_name = block.get("Block Name")
+    sch_type = block.get("Schedule Type")
+    sch_config_str = block.get("Schedule Config", "{}")
+    if block.get("Status", "Active") != "Active" or sch_type == "Thủ công": return None
+    try:
+        config = json.loads(sch_config_str) if isinstance(sch_config_str, str) else sch_config_str
+    except:
+        print(f"⚠️ {b_name}: Config lỗi JSON")
+        return None
+
+    loop, slots = None, []
+    try:
+        if sch_type == "Hàng ngày":
+            if "loop_minutes" in config and config["loop_minutes"] > 0: loop = config["loop_minutes"]
+            if "fixed_time" in config:
+                t = parse_time_str(config["fixed_time"])
+                if t: slots.append((lambda d: True, t))
+        elif sch_type in ("Hàng tuần", "Hàng tháng"):
+            for key in ("run_1", "run_2"):
+                if key not in config: continue
+                r = config[key]
+                t = parse_time_str(r.get("time", ""))
+                if not t: continue
+                if sch_type == "Hàng tuần":
+                    wd = WEEKDAY_MAP.get(r.get("day", ""), -99)
+                    slots.append((lambda d, wd=wd: d.weekday() == wd, t))
                 else:
-                    be.log_execution_history(secrets, b_name, sheet_name, "Auto (Headless)", "Error", "Fail", msg)
-                    print(f"     ❌ API Error: {msg}")
-                
-                time.sleep(1)
+                    day = int(r.get("day", -1))
+                    slots.append((lambda d, day=day: d.day == day, t))
+    except Exception as e:
+        print(f"⚠️ {b_name}: Lịch không hợp lệ ({e})")
+        return None
+    if not loop and not slots: return None
+    return {"loop": loop, "slots": slots}
+
+def next_due(sched, last_run, now):
+    # Thời điểm sớm nhất >= now mà should_run_block trả True (Last Run giữ nguyên); None = không có trong tầm tìm
+    cands = []
+    if sched["loop"]: cands.append(max(now, last_run + timedelta(minutes=sched["loop"])))
+    for i in range(SCHEDULE_HORIZON_DAYS):
+        d = now.date() + timedelta(days=i)
+        # Lịch cố định: mỗi ngày tối đa 1 lần, từ giờ hẹn tới hết ngày, nếu ngày đó chưa chạy
+        if d == last_run.date(): continue
+        day = [max(now, datetime.combine(d, t)) for ok, t in sched["slots"] if ok(d)]
+        if day:
+            cands.append(min(day))
+            break
+    return min(cands) if cands else None
+
+def run_daemon(secrets, max_hours=None):
+    print(">>> KINKIN AUTOMATION: DAEMON MODE...")
+    reload_s = float(secrets.get("system", {}).get("daemon_reload_minutes") or DAEMON_RELOAD_MINUTES) * 60
+    deadline = time.monotonic() + max_hours * 3600 if max_hours else None
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *a: stop.set())
+
+    compiled, heap = {}, []  # compiled: Block ID -> {"fp", "sched", "ver", "block"}; heap: (giờ đến hạn, Block ID, ver)
+    state = {"modified": None, "next_reload": 0.0}
 
-            # Cập nhật Last Run cho Block
+    def schedule(block, now):
+        bid = str(block.get("Block ID"))
+        fp = tuple(str(block.get(k, "")) for k in ("Status", "Schedule Type", "Schedule Config", "Last Run"))
+        c = compiled.get(bid)
+        if c and c["fp"] == fp: c["block"] = block; return
+        ver = c["ver"] + 1 if c else 0
+        sched = compile_schedule(block)
+        compiled[bid] = {"fp": fp, "sched": sched, "ver": ver, "block": block}
+        due = next_due(sched, parse_last_run(block), now) if sched else None
+        if due:
+            heapq.heappush(heap, (due, bid, ver))
+            print(f"📅 {block.get('Block Name')}: lần chạy kế tiếp {due.strftime('%H:%M:%S %d/%m/%Y')}")
+
+    def reload(now):
+        # Chỉ đọc lại manager_blocks / manager_links khi file master đã đổi
+        try:
+            modified = be.open_spreadsheet(secrets, key=secrets["system"]["master_sheet_id"]).get_lastUpdateTime()
+        except Exception: modified = None
+        if modified is not None and modified == state["modified"]: return
+        be.load_master_snapshot(secrets, refresh=True)
+        state["modified"] = modified
+        blocks = be.get_all_blocks(secrets)
+        for b in blocks: schedule(b, now)
+        for bid in set(compiled) - {str(b.get("Block ID")) for b in blocks}: del compiled[bid]
+
+    while not stop.is_set():
+        if deadline and time.monotonic() >= deadline: break
+        now = get_now_vn()
+        if time.monotonic() >= state["next_reload"]:
+            try: reload(now)
+            except Exception as e: print(f"❌ Lỗi đọc cấu hình master: {e}")
+            state["next_reload"] = time.monotonic() + reload_s
+
+        due = []
+        while heap and heap[0][0] <= now:
+            _, bid, ver = heapq.heappop(heap)
+            c = compiled.get(bid)
+            if not c or c["ver"] != ver: continue  # Mục cũ (lịch đã đổi)
+            if should_run_block(c["block"], now): due.append(c["block"])
+            else:
+                c["fp"] = None  # Lệch ngữ nghĩa (hiếm) -> dịch lại, tính từ phút sau
+                schedule(c["block"], now + timedelta(minutes=1))
+        if due:
+            print(f"🕒 Time Check (VN): {now.strftime('%H:%M:%S %d/%m/%Y')}")
+            # Ngân sách = phần còn lại tới deadline nếu ít hơn ngân sách cấu hình; khi đó không ép chạy block vượt
+            budget, min_one = run_budget_seconds(secrets), True
+            if deadline and (budget is None or deadline - time.monotonic() < budget):
+                budget, min_one = deadline - time.monotonic(), False
+            # Handle Worksheet giữ từ lần chạy trước có thể đã cũ (tab bị sửa / tạo lại ngoài engine) -> lấy lại
+            be.invalidate_sheet_cache()
+            deferred = []
+            try: deferred = traced_run(secrets, lambda: run_blocks(secrets, due, now, budget, min_one)) or []
+            except Exception as e: print(f"❌ Lỗi lần chạy: {e}")
+            # Tính lịch kế tiếp từ Last Run vừa ghi (snapshot đã được commit_status_updates cập nhật);
+            # ghi Last Run lỗi -> lần đọc lại master sau sẽ thấy Last Run cũ và xếp lịch lại
             now_str = now.strftime("%H:%M:%S %d/%m/%Y")
-            update_block_last_run(secrets, b_id, now_str)
-            print(f"🏁 Đã cập nhật Last Run cho {b_name}")
+            ran = [b for b in due if not any(b is d for d in deferred)]
+            for b in ran: schedule(dict(b, **{"Last Run": now_str}), get_now_vn())
+            # Block bị hoãn: ngân sách theo cấu hình -> đến hạn lại ngay (lượt sau có đủ ngân sách mới);
+            # ngân sách theo deadline chỉ còn giảm -> không vừa được nữa, để tiến trình sau chạy
+            if min_one:
+                for b in deferred:
+                    c = compiled.get(str(b.get("Block ID")))
+                    if c: c["fp"] = None
+                    schedule(b, get_now_vn())
+            elif deferred: print(f"⏳ Không đủ thời gian còn lại cho {len(deferred)} block -> để lần chạy sau")
+            continue
 
-    print("✅ HEADLESS RUN COMPLETED.")
+        wait_s = DAEMON_MAX_SLEEP
+        if heap: wait_s = min(wait_s, (heap[0][0] - get_now_vn()).total_seconds())
+        wait_s = min(wait_s, state["next_reload"] - time.monotonic())
+        if deadline: wait_s = min(wait_s, deadline - time.monotonic())
+        stop.wait(max(wait_s, 0.5))
+    print("🛑 DAEMON DỪNG.")
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--daemon", action="store_true", help="chạy liên tục, tự đến hạn từng block (độ chính xác theo phút)")
+    ap.add_argument("--max-hours", type=float, default=None, help="daemon tự thoát sau từng này giờ")
+    args = ap.parse_args()
+    if not args.daemon: main()
+    else:
+        secrets = load_secrets_local()
+        if not secrets: print("❌ CRITICAL: Không load được secrets. Dừng chương trình.")
+        else:
+            try: run_daemon(secrets, args.max_hours)
+            finally: be.close_http_sessions()
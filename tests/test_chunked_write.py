@@ -0,0 +1,60 @@
+# Ghi theo khối hỏng giữa chừng phải trả tab về đúng dữ liệu cũ (không nửa mới nửa cũ)
+import pandas as pd
+import pytest
+
+import backend as be
+import bench
+
+
+@pytest.fixture
+def wks(monkeypatch):
+    monkeypatch.setattr(be, "WRITE_CHUNK_CELLS", 12)  # 3 dòng x 4 cột / khối
+    monkeypatch.setattr(be, "WRITE_CHUNK_RETRIES", 0)
+    monkeypatch.setattr(be.time, "sleep", lambda s: None)
+    sh = bench.FakeSpreadsheet("DEST")
+    w = sh.add_worksheet("Data", 30, 6)
+    old = pd.DataFrame({"id": [str(i) for i in range(10)], "v": ["old"] * 10, "f": ["=1+1"] * 10, "t": ["'x"] * 10})
+    be.write_frame_chunked(w, old)
+    return w
+
+
+def fail_on(w, n, applied=False):
+    # Lần gọi batch_update thứ n (và mọi lần ghi lại khối đó) lỗi; applied=True: Sheets đã nhận rồi mới lỗi (timeout)
+    real, calls, bad = w.batch_update, [0], []
+    def batch_update(data, **k):
+        calls[0] += 1
+        if calls[0] == n: bad.append(data[0]["range"])
+        if data[0]["range"] in bad and data[0]["values"][0][1] != "old":
+            if applied: real(data, **k)
+            raise RuntimeError("boom")
+        return real(data, **k)
+    w.batch_update = batch_update
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("applied", [False, True])
+def test_full_write_failure_restores_tab(wks, monkeypatch, workers, applied):
+    monkeypatch.setattr(be, "WRITE_WORKERS", workers)
+    before = wks._values()
+    fail_on(wks, 3, applied)
+    new = pd.DataFrame({"id": [str(i) for i in range(12)], "v": ["new"] * 12, "f": ["1"] * 12, "t": ["y"] * 12})
+    with pytest.raises(RuntimeError, match="khôi phục"):
+        be.write_frame_chunked(wks, new)
+    assert wks._values() == before
+
+
+def test_delta_write_failure_restores_tab(wks):
+    before = wks._values()
+    sheet_df = pd.DataFrame(before[1:], columns=before[0])
+    final_df = sheet_df.copy()
+    final_df.loc[[1, 2, 8], "v"] = "new"
+    fail_on(wks, 1)
+    with pytest.raises(RuntimeError):
+        be.apply_delta_writes(wks, be.plan_delta_writes(sheet_df, final_df))
+    assert wks._values() == before
+
+
+def test_write_ok_without_failure(wks):
+    new = pd.DataFrame({"id": ["1", "2"], "v": ["new", "new"]})
+    be.write_frame_chunked(wks, new)
+    assert wks._values() == [["id", "v"], ["1", "new"], ["2", "new"]]
@@ -0,0 +1,29 @@
+# Dữ liệu stream (từng lô) phải ra đúng frame như pd.DataFrame(list).astype(str) của đường không stream
+import random
+
+import pandas as pd
+import pytest
+
+import backend as be
+
+VALUES = [12, 7, None, 1.5, "x", True, "", {"a": 1}, [1], 0]
+
+
+def test_int_column_with_none_in_one_batch():
+    rows = [{"id": 12}, {"id": 13}, {"id": 14, "x": None}, {"id": None}]
+    ref = pd.DataFrame(rows).astype(str)
+    pd.testing.assert_frame_equal(be.frame_from_batches(iter([rows[:2], rows[2:]])), ref)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_same_as_single_frame(seed):
+    rng = random.Random(seed)
+    pool = rng.sample(VALUES, rng.randint(1, 4))
+    rows = [{k: rng.choice(pool) for k in rng.sample(["a", "b", "c"], rng.randint(1, 3))} for _ in range(rng.randint(1, 12))]
+    n = rng.randint(1, 5)
+    got = be.frame_from_batches(iter([rows[i:i + n] for i in range(0, len(rows), n)] + [[]]))
+    pd.testing.assert_frame_equal(got, pd.DataFrame(rows).astype(str))
+
+
+def test_empty():
+    assert be.frame_from_batches(iter([[], []])).empty
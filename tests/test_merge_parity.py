@@ -0,0 +1,100 @@
+# Engine polars phải cho đúng frame như engine pandas (merge_link_frames) ở cả 3 chế độ cập nhật
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backend as be
+
+pytest.importorskip("polars")
+
+MODES = ["Chưa chốt & đang cập nhật", "Cập nhật dữ liệu cũ", "Cập nhật dữ liệu mới", "Đã chốt"]
+PK = "id"
+
+
+def with_meta(df, tb, tl):
+    # Giống process_links_to_sheet: dữ liệu API (chuỗi) + cột meta của link
+    df = df.astype(str)
+    for c, v in zip(be.META_COLS, ["https://api/x", "Tab", tb, tl, "01/01/2026"]): df[c] = v
+    return df
+
+
+def old_frame(rows, cols):
+    # Giống tab đích đọc về: chuỗi + NaN ở ô trống
+    df = pd.DataFrame(rows, columns=cols, dtype=object)
+    return df.where(df.notna(), np.nan)
+
+
+def assert_same(old_df, new_df, tb, tl, mode, pk=PK):
+    a = be.merge_link_frames(old_df.copy(), new_df.copy(), tb, tl, pk, mode, engine="pandas")
+    b = be.merge_link_frames(old_df.copy(), new_df.copy(), tb, tl, pk, mode, engine="polars")
+    assert list(a.columns) == list(b.columns)
+    pd.testing.assert_frame_equal(a.reset_index(drop=True).astype(object), b.reset_index(drop=True).astype(object),
+                                  check_dtype=False)
+
+
+COLS = [PK, "name"] + be.META_COLS
+
+
+def base_old():
+    return old_frame([
+        ["1", "a", "u", "Tab", "B1", "1", "x"],
+        ["2", "b", "u", "Tab", "B1", "1.0", "x"],        # Link ID dạng '.0'
+        ["3", "c", "u", "Tab", "'B1", "'1", "x"],        # ID có dấu ' đầu
+        [np.nan, "d", "u", "Tab", "B1", "1", "x"],       # key NaN
+        ["9", "z", "u", "Tab", "B2", "2", "x"],          # link khác, phải giữ nguyên
+        ["8", "y", "u", "Tab", np.nan, np.nan, "x"],     # dòng không có meta
+    ], COLS)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_modes_with_dirty_ids(mode):
+    new = with_meta(pd.DataFrame({PK: ["2", "3", "4"], "name": ["B", "C", "D"]}), "B1", "1")
+    assert_same(base_old(), new, "B1", "1", mode)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_nan_keys_in_new(mode):
+    # Ô trống trong dữ liệu API thành chuỗi "nan" (astype(str)), giống process_links_to_sheet
+    new = with_meta(pd.DataFrame({PK: ["1", np.nan, None], "name": ["A", "E", "F"]}), "B1", "1")
+    assert_same(base_old(), new, "B1", "1", mode)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_extra_and_missing_columns(mode):
+    new = with_meta(pd.DataFrame({PK: ["1", "7"], "extra": ["e1", "e7"]}), "B1", "1")  # thiếu "name", thêm "extra"
+    assert_same(base_old(), new, "B1", "1", mode)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_empty_new(mode):
+    new = with_meta(pd.DataFrame(columns=[PK, "name"]), "B1", "1")
+    assert_same(base_old(), new, "B1", "1", mode)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_empty_old(mode):
+    new = with_meta(pd.DataFrame({PK: ["1", "2"], "name": ["A", "B"]}), "B1", "1")
+    assert_same(old_frame([], COLS), new, "B1", "1", mode)
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_no_rows_for_link(mode):
+    new = with_meta(pd.DataFrame({PK: ["1"], "name": ["A"]}), "B3", "5")
+    assert_same(base_old(), new, "B3", "5", mode)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random(seed):
+    rnd = random.Random(seed)
+    ids = ["1", "2", "3", "10", "1.0", "'2", " 3 ", None]
+    blocks, links = ["B1", "'B1", "B2", None], ["1", "1.0", "'1", "2", "x", None]
+    extra = rnd.sample(["c1", "c2", "c3"], rnd.randint(0, 3))
+    cols = [PK] + extra + be.META_COLS
+    old_rows = [[rnd.choice(ids)] + [rnd.choice(["v", "w", None]) for _ in extra]
+                + ["u", "Tab", rnd.choice(blocks), rnd.choice(links), "t"] for _ in range(rnd.randint(0, 12))]
+    new_cols = [PK] + rnd.sample(["c1", "c2", "c4"], rnd.randint(0, 3))
+    new = pd.DataFrame([[rnd.choice(ids[:-1])] + [rnd.choice(["n", "m"]) for _ in new_cols[1:]]
+                        for _ in range(rnd.randint(0, 8))], columns=new_cols)
+    assert_same(old_frame(old_rows, cols), with_meta(new, "B1", "1"), "B1", "1", rnd.choice(MODES))
@@ -0,0 +1,58 @@
+# Lưu link từ app mà không đổi cấu hình lấy dữ liệu phải giữ Watermark / Content Hash của link
+import pandas as pd
+import pytest
+
+import backend as be
+import bench
+
+SECRETS = {"gcp_service_account": {}, "system": {"master_sheet_id": "MASTER"}}
+HEADER = ["Link ID", "Block ID", "Method", "API URL", "Access Token", "Link Sheet", "Sheet Name", "Filter Key",
+          "Date Start", "Date End", "Status", "Last Range", "Watermark", "Content Hash"]
+
+
+@pytest.fixture
+def links_tab(monkeypatch):
+    gc = bench.FakeClient()
+    monkeypatch.setattr(be, "get_gspread_client", lambda secrets: gc)
+    be.invalidate_sheet_cache()
+    wks = gc.open_by_key("MASTER").add_worksheet("manager_links", 100, 20)
+    yield wks
+    be.invalidate_sheet_cache()
+
+
+def app_frame(date_end="2026-01-31"):
+    # Như bảng sửa link của app: cột ngày là Timestamp (pd.to_datetime), không có cột trạng thái
+    return pd.DataFrame({"Link ID": ["1", "2"], "Block ID": ["B1", "B1"], "Method": ["GET", "GET"],
+                         "API URL": ["https://x/api/a", "https://x/api/b"], "Access Token": ["'t1", "'t2"],
+                         "Link Sheet": ["https://docs.google.com/spreadsheets/d/D", "https://docs.google.com/spreadsheets/d/D"],
+                         "Sheet Name": ["A", "B"], "Filter Key": ["created", ""],
+                         "Date Start": pd.to_datetime(["2026-01-05", None]), "Date End": pd.to_datetime([date_end, None]),
+                         "Status": ["Cập nhật dữ liệu mới", "Chưa chốt & đang cập nhật"], "Last Range": ["2 - 10", ""]})
+
+
+def seed_state(wks, date_fmt):
+    # Tab như sau 1 lần chạy: Sheets hiển thị ngày theo định dạng của ô, engine đã ghi Watermark / Content Hash
+    wks.rows = [HEADER,
+                ["1", "B1", "GET", "https://x/api/a", "t1", "https://docs.google.com/spreadsheets/d/D", "A", "created",
+                 date_fmt("2026-01-05"), date_fmt("2026-01-31"), "Cập nhật dữ liệu mới", "2 - 10", "2026-01-20", "h1"],
+                ["2", "B1", "GET", "https://x/api/b", "t2", "https://docs.google.com/spreadsheets/d/D", "B", "",
+                 "", "", "Chưa chốt & đang cập nhật", "", "", "h2"]]
+
+
+def state(wks):
+    rows = wks.get_all_records()
+    return [(str(r["Link ID"]), str(r["Watermark"]), str(r["Content Hash"])) for r in rows]
+
+
+@pytest.mark.parametrize("date_fmt", [lambda d: d, lambda d: d + " 00:00:00",
+                                      lambda d: pd.Timestamp(d).strftime("%d/%m/%Y")])
+def test_save_without_changes_keeps_state(links_tab, date_fmt):
+    seed_state(links_tab, date_fmt)
+    assert be.save_links_bulk(SECRETS, "B1", app_frame())
+    assert state(links_tab) == [("1", "2026-01-20", "h1"), ("2", "", "h2")]
+
+
+def test_changed_date_drops_state(links_tab):
+    seed_state(links_tab, lambda d: d)
+    be.save_links_bulk(SECRETS, "B1", app_frame(date_end="2026-02-28"))
+    assert state(links_tab) == [("1", "", ""), ("2", "", "h2")]
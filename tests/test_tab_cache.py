@@ -0,0 +1,80 @@
+# Cache tab đích (parquet / staging SQLite) phải cho đúng kết quả như đọc lại tab từ Sheet
+import random
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import backend as be
+import bench
+
+pytest.importorskip("polars")
+
+URL = "https://docs.google.com/spreadsheets/d/DEST"
+TAB = "Data"
+SECRETS = {"gcp_service_account": {}, "system": {}}
+MODES = ["Chưa chốt & đang cập nhật", "Cập nhật dữ liệu cũ", "Cập nhật dữ liệu mới"]
+
+
+class FixedClock(datetime):
+    # "Thời gian điền" cố định -> so được nội dung tab của 2 thế giới
+    @classmethod
+    def utcnow(cls): return cls(2026, 1, 1)
+
+
+@pytest.fixture
+def world(tmp_path, monkeypatch):
+    monkeypatch.setattr(be, "datetime", FixedClock)
+    # Mỗi "thế giới" = 1 Sheets giả + 1 thư mục cache; chuyển qua lại bằng use(name, cache)
+    clients = {}
+    def use(name, cache):
+        gc = clients.setdefault(name, bench.FakeClient())
+        monkeypatch.setattr(be, "get_gspread_client", lambda secrets: gc)
+        monkeypatch.setattr(be, "TAB_CACHE", cache)
+        monkeypatch.setattr(be, "TAB_CACHE_DIR", str(tmp_path / name))
+        be.invalidate_sheet_cache()
+        return gc
+    yield use
+    be.invalidate_sheet_cache()
+
+
+def sheet_values(gc):
+    return gc.open_by_key("DEST").tabs[TAB]._values()
+
+
+def random_rows(rng, n):
+    # Có cột luôn trống, ô trống, key trống
+    rows = []
+    for _ in range(n):
+        rows.append({"id": rng.choice(["", str(rng.randint(1, 12))]), "name": rng.choice(["", "a", "b", "c"]),
+                     "ghi chu": "", rng.choice(["x", "y"]): rng.choice(["", "1", "2"])})
+    return rows
+
+
+def test_cache_hit_equals_fresh_read(world):
+    gc = world("a", True)
+    be.process_links_to_sheet(SECRETS, URL, TAB, [{"block_id": "B1", "link_id": "1", "data": random_rows(random.Random(1), 20),
+                                                   "status": MODES[0]}], "pandas")
+    _, cached, cached_cols, _ = be._read_dest_tab(SECRETS, URL, TAB)
+    assert be._tab_cache_manifest("DEST").get("tabs", {}).get(TAB)
+    be.TAB_CACHE = False
+    be.invalidate_sheet_cache()
+    _, fresh, fresh_cols, _ = be._read_dest_tab(SECRETS, URL, TAB)
+    assert "ghi chu" not in fresh.columns
+    assert cached_cols == fresh_cols
+    pd.testing.assert_frame_equal(cached, fresh)
+
+
+@pytest.mark.parametrize("engine", ["pandas", "polars", "sqlite"])
+@pytest.mark.parametrize("seed", range(10))
+def test_cached_runs_match_uncached(world, engine, seed):
+    rng = random.Random(seed)
+    for _ in range(6):
+        jobs = [{"block_id": "B1", "link_id": str(tl), "data": random_rows(rng, rng.randint(0, 8)), "status": rng.choice(MODES)}
+                for tl in rng.sample([1, 2, 3], rng.randint(1, 3))]
+        out = {}
+        for name, cache in (("cached", True), ("plain", False)):
+            gc = world(name, cache)
+            res = be.process_links_to_sheet(SECRETS, URL, TAB, [dict(j) for j in jobs], engine)
+            out[name] = (res, sheet_values(gc))
+        assert out["cached"] == out["plain"]